@@ -6,13 +6,16 @@ More a proof of concept and an APDU reference than a serious software.
 """
 
 import collections
+import functools
+import io
+import operator
+import os
+import queue
 import struct
+import sys
+import threading
 import time
 
-import hid
-
-import hut
-
 class InvalidActionError(Exception):
     pass
 
@@ -21,6 +24,9 @@ class ICL01QueryError(Exception):
         self.status = status
         super().__init__("Status 0 expected got {}".format(status))
 
+class ICL01TimeoutError(IOError):
+    pass
+
 ICL01Capabilities = collections.namedtuple('ICL01Capabilities', ('map_size', 'macros_buffer_size'))
 
 class ICL01Capabilities:
@@ -183,7 +189,7 @@ class ICL01Config:
 
     @classmethod
     def unpack(cls, data):
-        return cls.unpack_from(buffer)
+        return cls.unpack_from(data)
 
     @classmethod
     def iter_unpack(cls, data):
@@ -244,7 +250,7 @@ class Color:
 
     @classmethod
     def unpack_from(cls, buffer, offset = 0):
-        return cls(*cls.STRUCT.unpack_unpack_from(buffer, offset))
+        return cls(*cls.STRUCT.unpack_from(buffer, offset))
 
     @classmethod
     def unpack(cls, data):
@@ -266,44 +272,216 @@ class Color:
     def __repr__(self):
         return "{}(0x{:02x}, 0x{:02x}, 0x{:02x})".format(self.__class__.__name__, self.r, self.g, self.b)
 
+def _numpy():
+    """Return numpy module or None when it's not installed"""
+    global _numpy_module
+    if _numpy_module is False:
+        try:
+            import numpy
+            _numpy_module = numpy
+        except ImportError:
+            _numpy_module = None
+    return _numpy_module
+
+_numpy_module = False
+
+def _require_numpy(feature):
+    np = _numpy()
+    if np is None:
+        raise ImportError("numpy is required for {}".format(feature))
+    return np
+
+class ColorFrame:
+    """
+    Colors of consecutive keys stored packed as RGB bytes in a bytearray,
+    which is the device format. It behaves as a sequence of Color and its
+    data is handed to the device without packing.
+    Color operations work on the whole frame at once, through translation
+    tables or numpy when it's installed.
+    """
+    __slots__ = ('data', )
+
+    def __init__(self, data):
+        if isinstance(data, int):
+            data = bytearray(data * Color.size)
+        elif not isinstance(data, bytearray):
+            data = bytearray(data)
+        assert(len(data) % Color.size == 0)
+        self.data = data
+
+    @classmethod
+    def from_colors(cls, colors):
+        if isinstance(colors, ColorFrame):
+            return cls(bytearray(colors.data))
+        data = bytearray(len(colors) * Color.size)
+        offset = 0
+        for col in colors:
+            col.pack_into(data, offset)
+            offset += Color.size
+        return cls(data)
+
+    @classmethod
+    def filled(cls, count, color):
+        return cls(color.pack() * count)
+
+    @classmethod
+    def from_array(cls, array):
+        """Build from a (N, 3) array of uint8"""
+        np = _require_numpy("ColorFrame.from_array()")
+        return cls(np.ascontiguousarray(array, dtype=np.uint8).tobytes())
+
+    @classmethod
+    def from_palette(cls, palette, indices):
+        """Build a frame whose key i has color palette[indices[i]]"""
+        np = _numpy()
+        if np is not None:
+            pal = np.frombuffer(cls.from_colors(palette).data, dtype=np.uint8).reshape(-1, 3)
+            return cls.from_array(pal[np.asarray(indices, dtype=np.intp)])
+        packed = [col.pack() for col in palette]
+        return cls(b''.join(packed[i] for i in indices))
+
+    @property
+    def array(self):
+        """(N, 3) uint8 numpy view on the frame data"""
+        np = _require_numpy("ColorFrame.array")
+        return np.frombuffer(self.data, dtype=np.uint8).reshape(-1, 3)
+
+    def __len__(self):
+        return len(self.data) // Color.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return ColorFrame(self.data[start*Color.size:stop*Color.size])
+            return ColorFrame.from_colors([self[i] for i in range(start, stop, step)])
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("ColorFrame index out of range")
+        return Color.unpack_from(self.data, index * Color.size)
+
+    def __setitem__(self, index, color):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            assert(step == 1)
+            data = _pack_colors(color)
+            # The frame size is the keyboard one
+            if len(data) != max(0, stop - start) * Color.size:
+                raise ValueError("ColorFrame slice assignment can't change the frame size")
+            self.data[start*Color.size:stop*Color.size] = data
+            return
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("ColorFrame assignment index out of range")
+        color.pack_into(self.data, index * Color.size)
+
+    def __iter__(self):
+        return Color.iter_unpack(self.data)
+
+    def __eq__(self, other):
+        if isinstance(other, ColorFrame):
+            return self.data == other.data
+        return NotImplemented
+
+    def copy(self):
+        return ColorFrame(bytearray(self.data))
+
+    def roll(self, shift):
+        """Return a frame with colors moved by shift keys, wrapping around"""
+        shift = (shift % len(self)) * Color.size if self.data else 0
+        return ColorFrame(self.data[-shift:] + self.data[:-shift] if shift else bytearray(self.data))
+
+    def _map(self, table):
+        return ColorFrame(self.data.translate(table))
+
+    def scale(self, factor):
+        """Scale brightness of every channel by factor"""
+        return self._map(_scale_table(factor))
+
+    def gamma(self, gamma):
+        """Apply gamma correction to every channel"""
+        return self._map(_gamma_table(gamma))
+
+    def blend(self, other, alpha):
+        """Return (1 - alpha) * self + alpha * other"""
+        assert(len(self.data) == len(other.data))
+        np = _numpy()
+        if np is not None:
+            a = np.frombuffer(self.data, dtype=np.uint8).astype(np.float32)
+            b = np.frombuffer(other.data, dtype=np.uint8).astype(np.float32)
+            return ColorFrame(np.rint(a + (b - a) * alpha).astype(np.uint8).tobytes())
+        ia = 1. - alpha
+        return ColorFrame(bytes(int(x * ia + y * alpha + .5) for x, y in zip(self.data, other.data)))
+
+    def __repr__(self):
+        return "{}({!r})".format(self.__class__.__name__, bytes(self.data))
+
+@functools.lru_cache(maxsize=64)
+def _scale_table(factor):
+    return bytes(min(0xff, int(v * factor + .5)) for v in range(256))
+
+@functools.lru_cache(maxsize=16)
+def _gamma_table(gamma):
+    return bytes(min(0xff, int(0xff * (v / 0xff) ** gamma + .5)) for v in range(256))
+
+def _pack_colors(colors):
+    """Return colors, a ColorFrame, a bytes-like object or a list of Color, as bytes-like"""
+    if isinstance(colors, ColorFrame):
+        return colors.data
+    if isinstance(colors, (bytes, bytearray, memoryview)):
+        return colors
+    return ColorFrame.from_colors(colors).data
+
+def _readonly(name):
+    """Read-only property of the slot _name"""
+    return property(operator.attrgetter('_' + name))
+
 class Action:
-    __slots__ = ('type', )
+    """
+    Base of actions. Actions are immutable: their fields are read-only
+    properties set by the constructor.
+    Actions decoded from tables are interned: there is a single instance per
+    packed value, until INTERNED_MAX of them are cached.
+    Equality and hashing are based on the packed value, as written by pack().
+    """
+    __slots__ = ('_type', '_key')
+    type = _readonly('type')
     size = 3
 
+    STRUCT = struct.Struct('<BBB')
+    # Decoder by type byte, filled once all actions are defined
+    DECODERS = {}
+    # Interned actions by packed value as read, emptied when full
+    INTERNED = {}
+    INTERNED_MAX = 4096
+
+    @staticmethod
+    def intern(value):
+        """Return the shared instance of an Action or of a packed action"""
+        if isinstance(value, Action):
+            if not hasattr(value, 'pack'):
+                raise InvalidActionError("{} is only used in macros".format(value.__class__.__name__))
+            key = value.key()
+        else:
+            key = bytes(value)
+        action = Action.INTERNED.get(key)
+        if action is None:
+            type_, p1, p2 = Action.STRUCT.unpack(key)
+            decoder = Action.DECODERS.get(type_)
+            if decoder is None:
+                raise InvalidActionError("Invalid action type")
+            action = decoder(type_, p1, p2)
+            if len(Action.INTERNED) >= Action.INTERNED_MAX:
+                Action.INTERNED.clear()
+            Action.INTERNED[key] = action
+        return action
+
     @classmethod
     def unpack_from(cls, buffer, offset = 0):
-        blk = buffer[offset:offset+cls.size]
-        type_ = blk[0]
-        if type_ == 0x10:
-            return ActionMouseClick.unpack(blk)
-        elif type_ == 0x11:
-            return ActionMousePan.unpack(blk)
-        elif type_ == 0x12:
-            return ActionMouseWheel.unpack(blk)
-        elif type_ == 0x14:
-            return ActionMouseClickRepeat.unpack(blk)
-        elif type_ == 0x20:
-            return ActionKey.unpack(blk)
-        elif type_ == 0x21:
-            return ActionKeyRepeat.unpack(blk)
-        elif type_ == 0x30:
-            return ActionConsumer.unpack(blk)
-        elif type_ == 0x40:
-            return ActionSystem.unpack(blk)
-        elif type_ == 0x50:
-            return ActionConsumer.unpack(blk)
-        elif type_ == 0x60:
-            return ActionConsumer(0x223, 0x60) 
-        elif type_ == 0x70:
-            return ActionMacro.unpack(blk)
-        elif type_ == 0x71:
-            return ActionMacroRepeat.unpack(blk)
-        elif type_ == 0xa0:
-            return ActionFn.unpack(blk)
-        elif type_ == 0xb0:
-            return ActionKey.unpack(blk)
-        else:
-            raise InvalidActionError("Invalid action type")
+        key = bytes(buffer[offset:offset+Action.size])
+        return Action.INTERNED.get(key) or Action.intern(key)
 
     @classmethod
     def unpack(cls, data):
@@ -311,13 +489,45 @@ class Action:
 
     @classmethod
     def iter_unpack(cls, data):
-        sz = len(data)
-        offset = 0
-        while sz >= cls.size:
-            yield cls.unpack_from(data, offset)
-            offset += cls.size
-            sz -= cls.size
-        assert(sz == 0)
+        assert(len(data) % cls.size == 0)
+        data = bytes(data)
+        interned = Action.INTERNED
+        for offset in range(0, len(data), Action.size):
+            key = data[offset:offset+Action.size]
+            yield interned.get(key) or Action.intern(key)
+
+    @classmethod
+    def unpack_table(cls, data):
+        """Decode a whole mapping table"""
+        data = bytes(data)
+        interned = Action.INTERNED
+        get = interned.get
+        ret = [get(data[offset:offset+3]) for offset in range(0, len(data), 3)]
+        if None in ret:
+            # Some actions were never seen before
+            for i, action in enumerate(ret):
+                if action is None:
+                    ret[i] = Action.intern(data[i*3:i*3+3])
+        return ret
+
+    @staticmethod
+    def pack_table(actions):
+        """Encode a whole mapping table"""
+        if isinstance(actions, MappingTable):
+            return bytes(actions.data)
+        return b''.join([action._key or action.key() for action in actions])
+
+    def __new__(cls, *args, **kwargs):
+        self = super().__new__(cls)
+        self._key = None
+        return self
+
+    def key(self):
+        """Return the packed action, computed once"""
+        key = self._key
+        if key is None:
+            key = self._key = bytes(self.pack())
+        return key
 
     @classmethod
     def unpack_macro(cls, type_, param):
@@ -340,25 +550,36 @@ class Action:
             raise InvalidActionError("Invalid action type")
 
     def __eq__(self, other):
-        ret = ((self.__class__ == other.__class__) and
-                (self.type == other.type))
-        if not ret:
+        if self is other:
+            return True
+        if not isinstance(other, Action):
+            return NotImplemented
+        if self.__class__ != other.__class__:
             return False
-        
+        if hasattr(self, 'pack'):
+            return self.key() == other.key()
+
+        # Macro only actions
         for v in self.__slots__:
             if getattr(self, v) != getattr(other, v):
                 return False
         
         return True
+
+    def __hash__(self):
+        if hasattr(self, 'pack'):
+            return hash(self.key())
+        return hash((self.__class__, ) + tuple(getattr(self, v) for v in self.__slots__))
         
 class ActionMouseClick(Action):
-    __slots__ = ('buttons', )
+    __slots__ = ('_buttons', )
+    buttons = _readonly('buttons')
     STRUCT = struct.Struct('<BBB')
 
     def __init__(self, buttons):
         assert(buttons >= 0 and buttons <= 0xff)
-        self.type = 0x10
-        self.buttons = buttons
+        self._type = 0x10
+        self._buttons = buttons
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -370,6 +591,10 @@ class ActionMouseClick(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(p1)
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, self.buttons, 0)
 
@@ -378,13 +603,14 @@ class ActionMouseClick(Action):
 
     @classmethod
     def unpack_macro(cls, type_, param):
-        assert(type_ == 0x1)
+        assert(type_ & 0x7f == 0x1)
         return cls(param)
     
     def pack_macro(self):
         return (0x1, self.buttons)
 
     def __str__(self):
+        import hut
         buttons = []
         b = self.buttons
         for i in range(8):
@@ -401,15 +627,17 @@ class ActionMouseClick(Action):
         return "{}(0x{:02x})".format(self.__class__.__name__, self.buttons)
 
 class ActionMousePan(Action):
-    __slots__ = ('pan', 'delay')
+    __slots__ = ('_pan', '_delay')
+    pan = _readonly('pan')
+    delay = _readonly('delay')
     STRUCT = struct.Struct('<BBb')
 
     def __init__(self, pan, delay):
         assert(pan >= -128 and pan <= 127)
         assert(delay >= 0 and delay <= 0xf)
-        self.type = 0x11
-        self.pan = pan
-        self.delay = delay
+        self._type = 0x11
+        self._pan = pan
+        self._delay = delay
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -421,6 +649,10 @@ class ActionMousePan(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(_signed(p2), p1)
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, self.delay, self.pan)
 
@@ -444,13 +676,14 @@ class ActionMousePan(Action):
         return "{}({}, {})".format(self.__class__.__name__, self.pan, self.delay)
 
 class ActionMouseWheel(Action):
-    __slots__ = ('wheel', )
+    __slots__ = ('_wheel', )
+    wheel = _readonly('wheel')
     STRUCT = struct.Struct('<BBb')
 
     def __init__(self, wheel):
         assert(wheel >= -128 and wheel <= 127)
-        self.type = 0x12
-        self.wheel = wheel
+        self._type = 0x12
+        self._wheel = wheel
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -462,6 +695,10 @@ class ActionMouseWheel(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(_signed(p2))
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, 0, self.wheel)
 
@@ -484,14 +721,16 @@ class ActionMouseWheel(Action):
         return "{}({})".format(self.__class__.__name__, self.wheel)
 
 class ActionMouseClickRepeat(Action):
-    __slots__ = ('delay', 'count')
+    __slots__ = ('_delay', '_count')
+    delay = _readonly('delay')
+    count = _readonly('count')
     STRUCT = struct.Struct('<BBB')
 
     def __init__(self, delay, count):
         assert(delay >= 0 and count <= 0xff)
-        self.type = 0x14
-        self.delay = delay
-        self.count = count
+        self._type = 0x14
+        self._delay = delay
+        self._count = count
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -503,6 +742,10 @@ class ActionMouseClickRepeat(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(p1, p2)
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, self.delay, self.count)
 
@@ -516,14 +759,16 @@ class ActionMouseClickRepeat(Action):
         return "{}({}, {})".format(self.__class__.__name__, self.delay, self.count)
 
 class ActionMouseMove(Action):
-    __slots__ = ('deltaX', 'deltaY')
+    __slots__ = ('_deltaX', '_deltaY')
+    deltaX = _readonly('deltaX')
+    deltaY = _readonly('deltaY')
 
     def __init__(self, deltaX=0, deltaY=0):
         assert(deltaX == 0 or deltaY == 0)
         assert(deltaX >= -128 and deltaX <= 127)
         assert(deltaY >= -128 and deltaY <= 127)
-        self.deltaX = deltaX
-        self.deltaY = deltaY
+        self._deltaX = deltaX
+        self._deltaY = deltaY
 
     @classmethod
     def unpack_macro(cls, type_, param):
@@ -551,11 +796,15 @@ class ActionMouseMove(Action):
     
     def pack_macro(self):
         if self.deltaY == 0:
-            return (0x4, self.deltaY.to_bytes(1, 'little')[0])
+            type_, delta = 0x4, self.deltaX
         elif self.deltaX == 0:
-            return (0x5, self.deltaX.to_bytes(1, 'little')[0])
+            type_, delta = 0x5, self.deltaY
         else:
             raise InvalidActionError("Can't encode ActionMouseMove in macro")
+        # Negative moves are flagged and stored as their magnitude
+        if delta < 0:
+            return (type_ | 0x80, -delta)
+        return (type_, delta)
 
     def __str__(self):
         return "Mouse move dx: {} dy: {}".format(self.deltaX, self.deltaY)
@@ -564,16 +813,18 @@ class ActionMouseMove(Action):
         return "{}({}, {})".format(self.__class__.__name__, self.deltaX, self.deltaY)
 
 class ActionKey(Action):
-    __slots__ = ('modifiers', 'keycode')
+    __slots__ = ('_modifiers', '_keycode')
+    modifiers = _readonly('modifiers')
+    keycode = _readonly('keycode')
     STRUCT = struct.Struct('<BBB')
 
     def __init__(self, modifiers, keycode, type_=0x20):
         assert(type_ == 0x20 or type_ == 0xb0)
         assert(modifiers >= 0 and modifiers <= 0xff)
         assert(keycode >= 0 and keycode <= 0xff)
-        self.type = type_
-        self.modifiers = modifiers
-        self.keycode = keycode
+        self._type = type_
+        self._modifiers = modifiers
+        self._keycode = keycode
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -584,6 +835,10 @@ class ActionKey(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(p1, p2, type_)
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, self.modifiers, self.keycode)
 
@@ -609,6 +864,7 @@ class ActionKey(Action):
             raise InvalidActionError("Can't encode ActionKey in macro")
 
     def __str__(self):
+        import hut
         keys = []
         mod = self.modifiers
         for i in range(8):
@@ -627,15 +883,17 @@ class ActionKey(Action):
         return "{}(0x{:02x}, {})".format(self.__class__.__name__, self.modifiers, self.keycode)
 
 class ActionKeyRepeat(Action):
-    __slots__ = ('keycode', 'delay')
+    __slots__ = ('_keycode', '_delay')
+    keycode = _readonly('keycode')
+    delay = _readonly('delay')
     STRUCT = struct.Struct('<BBB')
 
     def __init__(self, keycode, delay):
         assert(keycode >= 0 and keycode <= 0xff)
         assert(delay >= 0 and delay <= 0xf)
-        self.type = 0x21
-        self.keycode = keycode
-        self.delay = delay
+        self._type = 0x21
+        self._keycode = keycode
+        self._delay = delay
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -647,6 +905,10 @@ class ActionKeyRepeat(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(p2, p1)
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, self.delay, self.keycode)
 
@@ -654,6 +916,7 @@ class ActionKeyRepeat(Action):
         return self.STRUCT.pack(self.type, self.delay, self.keycode)
 
     def __str__(self):
+        import hut
         return "{} (repeated every {} times)".format(
                 hut.KEYS.get(self.keycode, "Unknown"),
                 self.delay)
@@ -662,7 +925,8 @@ class ActionKeyRepeat(Action):
         return "{}({}, {})".format(self.__class__.__name__, self.keycode, self.delay)
 
 class ActionConsumer(Action):
-    __slots__ = ('keycode', )
+    __slots__ = ('_keycode', )
+    keycode = _readonly('keycode')
     STRUCT = struct.Struct('<BH')
 
     def __init__(self, keycode, type_=0x30):
@@ -670,8 +934,8 @@ class ActionConsumer(Action):
         assert(keycode >= 0 and keycode <= 0xffff)
         if type_ == 0x60:
             assert(keycode == 0x223)
-        self.type = type_
-        self.keycode = keycode
+        self._type = type_
+        self._keycode = keycode
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -682,6 +946,10 @@ class ActionConsumer(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(p1 | (p2 << 8), type_)
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, self.keycode)
 
@@ -689,20 +957,22 @@ class ActionConsumer(Action):
         return self.STRUCT.pack(self.type, self.keycode)
 
     def __str__(self):
+        import hut
         return hut.CONSUMER.get(self.keycode, "Unknown")
 
     def __repr__(self):
         return "{}({})".format(self.__class__.__name__, self.keycode)
 
 class ActionSystem(Action):
-    __slots__ = ('keys', )
+    __slots__ = ('_keys', )
+    keys = _readonly('keys')
     STRUCT = struct.Struct('<BH')
 
     def __init__(self, keys):
         # According to HID descriptor: only the 3 first bits are used
         assert(keys >= 0 and keys <= 0x7)
-        self.type = 0x40
-        self.keys = keys
+        self._type = 0x40
+        self._keys = keys
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -714,6 +984,10 @@ class ActionSystem(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(p1 | (p2 << 8))
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, self.keys)
 
@@ -721,6 +995,7 @@ class ActionSystem(Action):
         return self.STRUCT.pack(self.type, self.keys)
 
     def __str__(self):
+        import hut
         keys = []
         k = self.keys
         for i in range(3):
@@ -736,7 +1011,9 @@ class ActionSystem(Action):
         return "{}({:02x})".format(self.__class__.__name__, self.keys)
 
 class ActionMacro(Action):
-    __slots__ = ('macro', 'mode')
+    __slots__ = ('_macro', '_mode')
+    macro = _readonly('macro')
+    mode = _readonly('mode')
     STRUCT = struct.Struct('<BBB')
     MACRO_MODES = {
         0x00: "One-shot",
@@ -748,9 +1025,9 @@ class ActionMacro(Action):
     def __init__(self, macro, mode):
         assert(macro >= 0 and macro <= 0xff)
         assert(mode in self.MACRO_MODES)
-        self.type = 0x70
-        self.macro = macro
-        self.mode = mode
+        self._type = 0x70
+        self._macro = macro
+        self._mode = mode
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -762,6 +1039,10 @@ class ActionMacro(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(p1, p2)
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, self.macro, self.mode)
 
@@ -775,15 +1056,17 @@ class ActionMacro(Action):
         return "{}({}, {})".format(self.__class__.__name__, self.macro, self.mode)
 
 class ActionMacroRepeat(Action):
-    __slots__ = ('macro', 'repeat')
+    __slots__ = ('_macro', '_repeat')
+    macro = _readonly('macro')
+    repeat = _readonly('repeat')
     STRUCT = struct.Struct('<BBB')
 
     def __init__(self, macro, repeat):
         assert(macro >= 0 and macro <= 0xff)
         assert(repeat >= 0 and repeat <= 0xff)
-        self.type = 0x71
-        self.macro = macro
-        self.repeat = repeat
+        self._type = 0x71
+        self._macro = macro
+        self._repeat = repeat
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -795,6 +1078,10 @@ class ActionMacroRepeat(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(p1, p2)
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, self.macro, self.repeat)
 
@@ -808,7 +1095,9 @@ class ActionMacroRepeat(Action):
         return "{}({}, {})".format(self.__class__.__name__, self.macro, self.repeat)
 
 class ActionFn(Action):
-    __slots__ = ('mode', 'param')
+    __slots__ = ('_mode', '_param')
+    mode = _readonly('mode')
+    param = _readonly('param')
     STRUCT = struct.Struct('<BBB')
     FN_MODES = {
         0x01: "Fn",
@@ -834,9 +1123,9 @@ class ActionFn(Action):
 
     def __init__(self, mode, param):
         assert(mode in self.FN_MODES)
-        self.type = 0xA0
-        self.mode = mode
-        self.param = param
+        self._type = 0xA0
+        self._mode = mode
+        self._param = param
 
     @classmethod
     def unpack_from(cls, buffer, offset=0):
@@ -848,6 +1137,10 @@ class ActionFn(Action):
     def unpack(cls, data):
         return cls.unpack_from(data)
 
+    @classmethod
+    def decode(cls, type_, p1, p2):
+        return cls(p1, p2)
+
     def pack_into(self, buffer, offset):
         return self.STRUCT.pack_into(buffer, offset, self.type, self.mode, self.param)
 
@@ -860,6 +1153,113 @@ class ActionFn(Action):
     def __repr__(self):
         return "{}({})".format(self.__class__.__name__, self.mode)
 
+def _signed(byte):
+    return byte - 0x100 if byte & 0x80 else byte
+
+Action.DECODERS.update({
+    0x10: ActionMouseClick.decode,
+    0x11: ActionMousePan.decode,
+    0x12: ActionMouseWheel.decode,
+    0x14: ActionMouseClickRepeat.decode,
+    0x20: ActionKey.decode,
+    0x21: ActionKeyRepeat.decode,
+    0x30: ActionConsumer.decode,
+    0x40: ActionSystem.decode,
+    0x50: ActionConsumer.decode,
+    0x60: lambda type_, p1, p2: ActionConsumer(0x223, 0x60),
+    0x70: ActionMacro.decode,
+    0x71: ActionMacroRepeat.decode,
+    0xa0: ActionFn.decode,
+    0xb0: ActionKey.decode,
+})
+
+class MappingTable:
+    """
+    Mapping table kept as its raw 3-byte entries.
+    Actions are only decoded when accessed. Entries set in place are recorded
+    as dirty so write_current_mapping_table() only sends them.
+    data may be a read-only buffer if the table is not edited.
+    """
+    __slots__ = ('data', 'dirty')
+
+    def __init__(self, data):
+        if not isinstance(data, (bytearray, memoryview)):
+            data = bytearray(data)
+        assert(len(data) % Action.size == 0)
+        self.data = data
+        self.dirty = set()
+
+    @classmethod
+    def from_actions(cls, actions):
+        return cls(bytearray(Action.pack_table(actions)))
+
+    def __len__(self):
+        return len(self.data) // Action.size
+
+    def __getitem__(self, index):
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step == 1:
+                return MappingTable(bytearray(self.data[start*Action.size:stop*Action.size]))
+            return [self[i] for i in range(start, stop, step)]
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("MappingTable index out of range")
+        return Action.unpack_from(self.data, index * Action.size)
+
+    def __setitem__(self, index, action):
+        if index < 0:
+            index += len(self)
+        if index < 0 or index >= len(self):
+            raise IndexError("MappingTable index out of range")
+        offset = index * Action.size
+        packed = action.key()
+        if self.data[offset:offset+Action.size] != packed:
+            self.data[offset:offset+Action.size] = packed
+            self.dirty.add(index)
+
+    def __iter__(self):
+        return Action.iter_unpack(self.data)
+
+    def __eq__(self, other):
+        if isinstance(other, MappingTable):
+            return self.data == other.data
+        if isinstance(other, list):
+            return self.data == Action.pack_table(other)
+        return NotImplemented
+
+    def diff(self, other):
+        """Return the sorted indexes of keys mapped differently in other"""
+        if len(self.data) != len(other.data):
+            raise ValueError("Tables sizes differ")
+        if self.data == other.data:
+            return []
+        changed = _changed_bytes(self.data, other.data)
+        keys = []
+        pos = changed.find(1)
+        while pos != -1:
+            key = pos // Action.size
+            keys.append(key)
+            pos = changed.find(1, (key + 1) * Action.size)
+        return keys
+
+    def dirty_ranges(self):
+        """Return (first key, count) of dirty entries, contiguous ones merged"""
+        ranges = []
+        for key in sorted(self.dirty):
+            if ranges and ranges[-1][0] + ranges[-1][1] == key:
+                ranges[-1] = (ranges[-1][0], ranges[-1][1] + 1)
+            else:
+                ranges.append((key, 1))
+        return ranges
+
+    def pack(self):
+        return bytes(self.data)
+
+    def __repr__(self):
+        return "<{}: {} keys, {} dirty>".format(self.__class__.__name__, len(self), len(self.dirty))
+
 class MacrosBlock(list):
     HDR = struct.Struct('<HHH10x')
     WORD = struct.Struct('<H')
@@ -887,7 +1287,7 @@ class MacrosBlock(list):
     
     def size(self):
         sz = self.HDR.size + self.WORD.size*len(self)
-        for macro in self.macros:
+        for macro in self:
             sz += macro.size()
         return sz
     
@@ -897,14 +1297,15 @@ class MacrosBlock(list):
         offsetsoff = offset + self.HDR.size
         macrosoff = offsetsoff + wsz*len(self)
         for macro in self:
-            offsets.append(macrosoff)
+            # Offsets are relative to the block
+            offsets.append(macrosoff - offset)
             macrosoff += macro.pack_into(buffer, macrosoff)
         
         for off in offsets:
             self.WORD.pack_into(buffer, offsetsoff, off)
             offsetsoff += wsz
         
-        self.HDR.pack_into(buffer, offset, 0x55aa, macrosoff, len(self))
+        self.HDR.pack_into(buffer, offset, 0x55aa, macrosoff - offset, len(self))
 
     def pack(self):
         buffer = bytearray(self.size())
@@ -929,8 +1330,12 @@ class Macro(list):
             offset_ = offset + sz
             for i in range(count):
                 delay, action, param = cls.STRUCT.unpack_from(buffer, offset_)
-                pressed = (action & 0x80) != 0
                 act = Action.unpack_macro(action, param)
+                if type(act) is ActionMouseMove:
+                    # Moves have no pressed state, bit 7 is their sign
+                    pressed = act.deltaX < 0 or act.deltaY < 0
+                else:
+                    pressed = (action & 0x80) != 0
                 yield MacroEntry(delay, pressed, act)
                 offset_ += sz
 
@@ -947,9 +1352,11 @@ class Macro(list):
         sz = self.STRUCT.size
         self.STRUCT.pack_into(buffer, offset, len(self), 0, 0)
         off = sz
-        for delay, act in self:
+        for delay, pressed, act in self:
             action, param = act.pack_macro()
-            self.STRUCT.pack_into(buffer, offset + off, delay, action | 0x80, param)
+            if pressed and type(act) is not ActionMouseMove:
+                action |= 0x80
+            self.STRUCT.pack_into(buffer, offset + off, delay, action, param)
             off += sz
         return off
 
@@ -969,31 +1376,478 @@ class Macro(list):
 
 MacroEntry = collections.namedtuple('MacroEntry', ('delay', 'pressed', 'action'))
 
+def _changed_spans(old, new, span):
+    """
+    Return (offset, size) spans, at most span bytes long, covering every byte
+    differing between old and new (which must be the same size).
+    The fewest spans are used and each one is trimmed to its last change.
+    """
+    assert(len(old) == len(new))
+    size = len(old)
+    if size == 0 or old == new:
+        return []
+
+    changed = _changed_bytes(old, new)
+
+    spans = []
+    start = changed.find(1)
+    while start != -1:
+        end = changed.rfind(1, start, start + span) + 1
+        spans.append((start, end - start))
+        start = changed.find(1, start + span)
+    return spans
+
+def _changed_bytes(old, new):
+    """Return bytes of the same size as old and new set to 1 where they differ"""
+    # Non-zero bytes of the XOR are the changed ones
+    xor = (int.from_bytes(old, 'big') ^ int.from_bytes(new, 'big')).to_bytes(len(old), 'big')
+    return xor.translate(_CHANGED_TABLE)
+
+_CHANGED_TABLE = bytes([0] + [1] * 255)
+
+Transaction = collections.namedtuple('Transaction', ('cmd', 'offset', 'data'))
+
+class WritePlan(list):
+    """Transactions needed to bring a device to a DesiredState"""
+
+    @property
+    def bytes(self):
+        return sum(len(t.data) for t in self)
+
+    @property
+    def round_trips(self):
+        # Entering and leaving configure mode cost one round trip each
+        return len(self) + 2 if self else 0
+
+    def __str__(self):
+        s = "{} transactions, {} bytes, {} round trips\n".format(len(self), self.bytes, self.round_trips)
+        for t in self:
+            s += "    0x{:02x} @0x{:04x}: {} bytes\n".format(t.cmd, t.offset, len(t.data))
+        return s
+
+class DesiredState:
+    """
+    Configuration wanted on a device. Parts left to None are not touched.
+    global_config: ICL01GlobalConfig
+    mapping: list of Action for the current mapping table starting at key 0
+    custom_colors: list of up to 10 profiles, each one a list of Color or None
+    macros: MacrosBlock
+    """
+    __slots__ = ('global_config', 'mapping', 'custom_colors', 'macros')
+
+    def __init__(self, global_config=None, mapping=None, custom_colors=None, macros=None):
+        self.global_config = global_config
+        self.mapping = mapping
+        self.custom_colors = custom_colors
+        self.macros = macros
+
+class ShadowRegion:
+    """
+    Host copy of a device memory region read with read_cmd and written with
+    write_cmd. Changes are tracked by DATA_MAX aligned chunks.
+    """
+    __slots__ = ('read_cmd', 'write_cmd', 'size', 'data', 'dirty')
+
+    def __init__(self, read_cmd, write_cmd, size):
+        self.read_cmd = read_cmd
+        self.write_cmd = write_cmd
+        self.size = size
+        self.data = None
+        self.dirty = set()
+
+    def __repr__(self):
+        return "<{}: 0x{:02x}/0x{:02x} {} bytes, {} dirty chunks>".format(self.__class__.__name__,
+                self.read_cmd, self.write_cmd, self.size if self.valid else '?', len(self.dirty))
+
+    @property
+    def valid(self):
+        return self.data is not None
+
+    def load(self, data):
+        assert(len(data) == self.size)
+        self.data = bytearray(data)
+        self.dirty.clear()
+
+    def invalidate(self):
+        self.data = None
+        self.dirty.clear()
+
+    def update(self, offset, data):
+        """Store data at offset and mark the chunks actually changed as dirty"""
+        data = memoryview(data)
+        end = offset + len(data)
+        assert(offset >= 0 and end <= self.size)
+        view = memoryview(self.data)
+        step = ICL01Device.DATA_MAX
+        for chunk in range(offset // step, (end + step - 1) // step):
+            start = max(chunk * step, offset)
+            stop = min((chunk + 1) * step, end)
+            new = data[start - offset:stop - offset]
+            if view[start:stop] != new:
+                view[start:stop] = new
+                self.dirty.add(chunk)
+
+    def dirty_ranges(self):
+        """Return (offset, size) of dirty chunks, contiguous ones merged"""
+        ranges = []
+        step = ICL01Device.DATA_MAX
+        for chunk in sorted(self.dirty):
+            start = chunk * step
+            stop = min(start + step, self.size)
+            if ranges and ranges[-1][0] + ranges[-1][1] == start:
+                ranges[-1] = (ranges[-1][0], stop - ranges[-1][0])
+            else:
+                ranges.append((start, stop - start))
+        return ranges
+
+class ReportReader(threading.Thread):
+    """
+    Background reader of an opened interface.
+    Replies (report ID 4) expected by a query are queued in replies, the
+    unexpected ones are dropped and counted.
+    Every other report is handed to the subscribers from the reader thread.
+    Exceptions raised by subscribers are counted and reported to tracer as
+    'subscriber' errors, the reader keeps going.
+    When reading fails, the reader stops and get() raises its error.
+    Dropped replies and reports other than replies are reported to tracer as
+    discarded, when given.
+    """
+    def __init__(self, dev, poll=100, tracer=None):
+        super().__init__(daemon=True)
+        self.dev = dev
+        self.poll = poll
+        self.replies = queue.Queue()
+        self.subscribers = []
+        self.stats = collections.Counter()
+        self.error = None
+        self.tracer = tracer
+        self._expected = collections.Counter()
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+
+    def subscribe(self, callback):
+        self.subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self.subscribers.remove(callback)
+
+    def expect(self, cmd, offset):
+        """Must be called before sending the request"""
+        with self._lock:
+            self._expected[(cmd, offset)] += 1
+
+    def cancel(self):
+        """Forget about all the replies still expected"""
+        with self._lock:
+            self.stats['timeouts'] += sum(self._expected.values())
+            self._expected.clear()
+        while True:
+            try:
+                self.replies.get_nowait()
+            except queue.Empty:
+                break
+
+    def get(self, timeout):
+        """Return the next reply, None on timeout"""
+        if self.error is not None and self.replies.empty():
+            self._failed()
+        try:
+            reply = self.replies.get(timeout=timeout)
+        except queue.Empty:
+            return None
+        if reply is None:
+            # Wakes up the next waiter too
+            self.replies.put(None)
+            self._failed()
+        return reply
+
+    def _failed(self):
+        raise IOError("Report reader stopped: {}".format(self.error)) from self.error
+
+    def stop(self):
+        self._stopping.set()
+        if self.is_alive() and threading.current_thread() is not self:
+            self.join()
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                report = self.dev.read(64, self.poll)
+            except (IOError, ValueError) as e:
+                self.error = e
+                # Queries waiting for a reply fail at once
+                self.replies.put(None)
+                break
+            if not report:
+                continue
+
+            report = bytes(report)
+            if report[0] != 4:
+                self.stats['reports'] += 1
+                for callback in list(self.subscribers):
+                    try:
+                        callback(report)
+                    except Exception:
+                        # A broken subscriber must not stop the replies
+                        self.stats['subscriber_errors'] += 1
+                        if self.tracer is not None:
+                            self.tracer.error('subscriber', None, None)
+                # Not a reply, as on the path without reader
+                if self.tracer is not None:
+                    self.tracer.discarded(report)
+                continue
+
+            key = (report[3], int.from_bytes(report[5:7], 'little'))
+            with self._lock:
+                expected = self._expected[key] > 0
+                if expected:
+                    self._expected[key] -= 1
+                    if not self._expected[key]:
+                        del self._expected[key]
+            if expected:
+                self.stats['replies'] += 1
+                self.replies.put(report)
+            else:
+                self.stats['dropped'] += 1
+                if self.tracer is not None:
+                    self.tracer.discarded(report)
+
+class RetryPolicy:
+    """
+    Opt-in reliability layer of ICL01Device requests.
+    A request failing with a timeout or an invalid reply is sent again, up to
+    attempts times, once stale replies are discarded. Before each attempt,
+    the device waits backoff seconds, doubled at each attempt up to
+    max_backoff. Every ICL01 request is idempotent as it reads or writes at
+    an absolute offset or sets a mode.
+    When the device stays silent, it is rebooted once if reboot is set, then
+    configure mode is entered again and the request retried.
+    Status errors are not retried: the firmware would refuse the request again.
+    """
+    __slots__ = ('attempts', 'backoff', 'max_backoff', 'reboot', 'reboot_delay')
+
+    def __init__(self, attempts=3, backoff=0.01, max_backoff=0.2, reboot=True, reboot_delay=2.):
+        assert(attempts >= 0)
+        self.attempts = attempts
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.reboot = reboot
+        # Time given to the device to come back after a reboot
+        self.reboot_delay = reboot_delay
+
+    def delay(self, attempt):
+        return min(self.backoff * (1 << (attempt - 1)), self.max_backoff)
+
+class LatencyModel:
+    """
+    Reply latencies of a device by command, giving the timeout of requests.
+    The timeout is the latency percentile of the last SAMPLES replies
+    multiplied by factor, kept between floor and ceiling seconds.
+    Until min_samples replies of a command are seen, its timeout is its seed:
+    from seeds, SEEDS by default, else default. A fresh model thus waits for
+    the replies lost while warming up as long as the seeds say, so models
+    are best kept between runs (load() and save()).
+    A single missed reply is taken as lost. From the second one in a row, the
+    timeout doubles at each miss so a device getting slower is waited for
+    until its new latencies are learnt.
+    """
+    SAMPLES = 256
+    # Warm-up timeouts in seconds by command: reads and live colors are
+    # answered within a few ms, configure mode and flash writes can take
+    # much longer and keep default
+    SEEDS = {
+        0x03: .1, 0x05: .1, 0x07: .1, 0x08: .1, 0x0a: .1, 0x14: .1, 0x1b: .1,
+        0x12: .1, 0x13: .1, 0x1f: .1,
+    }
+
+    def __init__(self, factor=3., floor=0.02, ceiling=2., default=1., percentile=99, min_samples=20,
+            seeds=None):
+        assert(floor <= ceiling)
+        self.factor = factor
+        self.floor = floor
+        self.ceiling = ceiling
+        self.default = default
+        self.seeds = dict(self.SEEDS if seeds is None else seeds)
+        self.percentile = percentile
+        self.min_samples = min_samples
+        self.samples = {}
+        # Consecutive missed replies by command
+        self.missed_replies = collections.Counter()
+        # Timeouts by command, dropped when new samples come
+        self._timeouts = {}
+        self._lock = threading.Lock()
+
+    def record(self, cmd, latency):
+        with self._lock:
+            samples = self.samples.get(cmd)
+            if samples is None:
+                samples = self.samples[cmd] = collections.deque(maxlen=self.SAMPLES)
+            samples.append(latency)
+            self._timeouts.pop(cmd, None)
+            self.missed_replies.pop(cmd, None)
+
+    def missed(self, cmd):
+        """A reply didn't come in time"""
+        with self._lock:
+            self.missed_replies[cmd] += 1
+
+    def timeout(self, cmd):
+        """Timeout in seconds of a request with command cmd"""
+        timeout = self._timeouts.get(cmd)
+        if timeout is None:
+            timeout = self._learnt(cmd)
+        missed = self.missed_replies.get(cmd, 0)
+        if missed > 1:
+            timeout = min(timeout * (1 << (missed - 1)), self.ceiling)
+        return timeout
+
+    def _learnt(self, cmd):
+        with self._lock:
+            samples = self.samples.get(cmd)
+            if samples is None or len(samples) < self.min_samples:
+                return self.seeds.get(cmd, self.default)
+            lat = sorted(samples)
+            lat = lat[min(len(lat) - 1, len(lat) * self.percentile // 100)]
+            timeout = self._timeouts[cmd] = min(max(lat * self.factor, self.floor), self.ceiling)
+            return timeout
+
+    def to_dict(self):
+        with self._lock:
+            return {"0x{:02x}".format(cmd): list(samples) for cmd, samples in self.samples.items()}
+
+    @classmethod
+    def from_dict(cls, data, **kwargs):
+        model = cls(**kwargs)
+        for cmd, samples in data.items():
+            model.samples[int(cmd, 16)] = collections.deque(samples, maxlen=cls.SAMPLES)
+        return model
+
+    @classmethod
+    def load(cls, path, key, **kwargs):
+        """Model of the device key saved in the JSON file at path, a new one if missing"""
+        import json
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        return cls.from_dict(data.get(key, {}), **kwargs)
+
+    def save(self, path, key):
+        """Store the model as the one of device key in the JSON file at path"""
+        import json
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            data = {}
+        data[key] = self.to_dict()
+        # Replaced at once so concurrent readers never see a partial file
+        tmp = "{}.{}.tmp".format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+
+    def __str__(self):
+        return ", ".join("0x{:02x}: {:.1f} ms".format(cmd, self.timeout(cmd) * 1000.)
+                for cmd in sorted(self.samples))
+
 class ICL01Device:
     # 64 - 8 for header
     DATA_MAX = 56
     MSG_HDR = struct.Struct('<BHBBHB56s')
+    REQ_HDR = struct.Struct('<BHBBHB')
+    PADDING = memoryview(bytes(56))
+    # Regions which can be shadowed: read command to write command
+    SHADOW_REGIONS = {0x05: 0x06, 0x08: 0x09, 0x0a: 0x0b, 0x14: 0x15}
 
-    def __init__(self, paths):
+    def __init__(self, paths, window=1, backend=None, shadow=False, tracer=None, retry=None,
+            latency_model=None, serial=None, pool=None, location=None):
         assert(len(paths) == 2)
+        assert(window >= 1)
         self.paths = paths
+        self.serial = serial
+        # Physical USB path when the backend tells it
+        self.location = location
+        # icl01_registry.DevicePool sharing the interface handles, None to own them
+        self.pool = pool
+        # Module providing device(), hid by default
+        if backend is None:
+            import hid as backend
+        self.backend = backend
         self.devices = [None]*2
+        self.readers = [None]*2
         self.inconfig = False
         self.capabilities = None
+        # Number of requests kept in flight by read() and write()
+        # 1 means strict request/reply transfers
+        self.window = window
+        # Lower limit of requests in flight after repeated pipelining
+        # failures, None when window applies
+        self.inflight = None
+        # Consecutive failed and clean pipelined transfers
+        self._pipeline_failures = 0
+        self._pipeline_clean = 0
+        # Reused for every request sent
+        self._request = bytearray(self.MSG_HDR.size)
+        # ShadowRegion by read and write commands when shadowing is enabled
+        # Writes to shadowed regions are deferred until flush()
+        self.shadow = {} if shadow else None
+        # icl01_trace.Tracer hooks, None when not traced
+        self.tracer = tracer
+        # Requests sent so far
+        self.requests = 0
+        # RetryPolicy, True for the default one, None to fail on the first error
+        self.retry = RetryPolicy() if retry is True else retry
+        # Retries, resyncs, recoveries and failures of the retry layer
+        self.stats = collections.Counter()
+        # LatencyModel giving adaptive timeouts, True for a new one
+        # None keeps a fixed 1 s timeout
+        self.latency_model = LatencyModel() if latency_model is True else latency_model
 
     def __repr__(self):
         return "<{0}: {1!r}>".format(self.__class__.__name__, self.paths)
 
+    @property
+    def key(self):
+        """Identifier of the keyboard: its serial number or its path"""
+        if self.serial:
+            return self.serial
+        path = self.paths[0]
+        return path.decode('utf-8', 'replace') if isinstance(path, bytes) else str(path)
+
     def _get(self, intf):
         if self.devices[intf] is not None:
             return self.devices[intf]
 
-        d = hid.device()
-        d.open_path(self.paths[intf])
+        if self.pool is not None:
+            d = self.pool.acquire(self.paths[intf])
+        else:
+            d = self.backend.device()
+            d.open_path(self.paths[intf])
         self.devices[intf] = d
         return d
 
+    def _close_handles(self, discard=False):
+        for i, d in enumerate(self.devices):
+            if d is None:
+                continue
+            if self.pool is not None:
+                self.pool.release(self.paths[i], discard)
+            else:
+                d.close()
+            self.devices[i] = None
+
+    def close(self):
+        """Stop the readers and close the interfaces, they are reopened when needed"""
+        self.stop_readers()
+        self._close_handles()
+
     def reboot(self):
+        self.invalidate_shadow()
+        self._reboot()
+
+    def _reboot(self):
         dev = self._get(0)
 
         # Go to bootloader
@@ -1013,61 +1867,215 @@ class ICL01Device:
     def checksum(self, cmd, size, offset, status, data):
         if size is None:
             size = len(data)
-        checksum = 0
-        checksum = (checksum + cmd) & 0xffff
-        checksum = (checksum + size) & 0xffff
-        checksum = (checksum + (offset & 0xff)) & 0xffff
-        checksum = (checksum + (offset >> 8)) & 0xffff
-        checksum = (checksum + size) & 0xffff
-        for b in data:
-            checksum = (checksum + b) & 0xffff
-        return checksum
-
-    def query(self, cmd, offset = 0, size = None, data = None):
-        dev = self._get(1)
-
-        if data is None:
-            data = b''
-        if size is None:
-            size = len(data)
-
-        assert(size >= 0 and size <= self.DATA_MAX)
-        assert(offset >= 0 and offset <= 0xffff)
-
+        # Sum of 16-bit additions of cmd, size, offset bytes, size again and data
+        return (cmd + size + (offset & 0xff) + (offset >> 8) + size + sum(data)) & 0xffff
+
+    def start_reader(self, intf=1):
+        """
+        Start a background reader on interface intf and return it.
+        Once started on interface 1, queries get their replies from it.
+        """
+        reader = self.readers[intf]
+        if reader is None:
+            reader = ReportReader(self._get(intf), tracer=self.tracer)
+            reader.start()
+            self.readers[intf] = reader
+        return reader
+
+    def stop_readers(self):
+        for i, reader in enumerate(self.readers):
+            if reader is not None:
+                reader.stop()
+                self.readers[i] = None
+
+    def subscribe(self, callback, intf=1):
+        """Call callback with every input report received on interface intf except replies"""
+        self.start_reader(intf).subscribe(callback)
+
+    def _send(self, dev, cmd, offset, size, data):
         checksum = self.checksum(cmd, size, offset, 0, data)
-        request = self.MSG_HDR.pack(4, checksum, cmd, size, offset, 0, data)
+        reader = self.readers[1]
+        if reader is not None:
+            reader.expect(cmd, offset)
+        request = self._request
+        self.REQ_HDR.pack_into(request, 0, 4, checksum, cmd, size, offset, 0)
+        end = self.REQ_HDR.size + len(data)
+        request[self.REQ_HDR.size:end] = data
+        request[end:] = self.PADDING[:len(request) - end]
         dev.write(request)
+        self.requests += 1
+        return checksum
+
+    def _receive(self, dev, timeout=1000):
+        reader = self.readers[1]
+        if reader is not None:
+            reply = reader.get(timeout / 1000.)
+            if reply is None:
+                reader.cancel()
+                raise self._fail('timeout', "Timeout while reading data ({} replies lost so far)".format(reader.stats['timeouts']),
+                        error=ICL01TimeoutError)
+            return reply
 
         start = current = time.monotonic()
         while True:
             delta = int((current - start) * 1000.)
-            remaining = 1000 - delta
+            remaining = timeout - delta
             if remaining <= 0:
-                raise IOError("Timeout while reading data")
+                raise self._fail('timeout', "Timeout while reading data", error=ICL01TimeoutError)
             reply = dev.read(64, remaining)
             if reply and reply[0] == 4:
                 break
+            if reply and self.tracer is not None:
+                self.tracer.discarded(reply)
             current = time.monotonic()
 
-        report_id, rchecksum, rcmd, rsize, roffset, rstatus, rdata = self.MSG_HDR.unpack(bytes(reply))
+        return bytes(reply)
+
+    def _fail(self, kind, message, cmd=None, offset=None, error=IOError):
+        """Report an error of the given kind to the tracer and return its exception"""
+        if self.tracer is not None:
+            self.tracer.error(kind, cmd, offset)
+        return error(message)
+
+    def _check(self, reply, checksum, cmd, offset):
+        """Validate reply against the request and return a view on its data"""
+        report_id, rchecksum, rcmd, rsize, roffset, rstatus = self.REQ_HDR.unpack_from(reply)
 
         if report_id != 4:
-            raise IOError("Report ID 4 expected got {}".format(report_id))
+            raise self._fail('report_id', "Report ID 4 expected got {}".format(report_id), cmd, offset)
 
         # Keyboard doesn't recompute its checksum
         if checksum != rchecksum:
-            raise IOError("Checksum 0x{:04x} expected got 0x{:04x}".format(checksum, rchecksum))
+            raise self._fail('checksum', "Checksum 0x{:04x} expected got 0x{:04x}".format(checksum, rchecksum), cmd, offset)
 
         if cmd != rcmd:
-            raise IOError("Command 0x{:02x} expected got 0x{:02x}".format(cmd, rcmd))
+            raise self._fail('command', "Command 0x{:02x} expected got 0x{:02x}".format(cmd, rcmd), cmd, offset)
 
         if offset != roffset:
-            raise IOError("Offset 0x{:04x} expected got 0x{:04x}".format(offset, roffset))
+            raise self._fail('offset', "Offset 0x{:04x} expected got 0x{:04x}".format(offset, roffset), cmd, offset)
 
         if rstatus != 0:
+            if self.tracer is not None:
+                self.tracer.error('status', cmd, offset)
             raise ICL01QueryError(rstatus)
 
-        return rdata[:rsize]
+        rsize = min(rsize, self.DATA_MAX)
+        return memoryview(reply)[self.REQ_HDR.size:self.REQ_HDR.size + rsize]
+
+    def _drain(self, dev, timeout=50):
+        # Discard late replies of requests we gave up on
+        reader = self.readers[1]
+        if reader is not None:
+            time.sleep(timeout / 1000.)
+            reader.cancel()
+            return
+        while dev.read(64, timeout):
+            pass
+
+    def _query(self, cmd, offset, size, data):
+        assert(size >= 0 and size <= self.DATA_MAX)
+        assert(offset >= 0 and offset <= 0xffff)
+
+        if self.retry is not None:
+            return self._retried(cmd, offset, size, data)
+        return self._round_trip(cmd, offset, size, data)
+
+    def _timeout(self, cmd):
+        """Timeout of a reply to cmd in milliseconds"""
+        if self.latency_model is None:
+            return 1000
+        return max(1, int(self.latency_model.timeout(cmd) * 1000.))
+
+    def _round_trip(self, cmd, offset, size, data):
+        dev = self._get(1)
+        tracer = self.tracer
+        model = self.latency_model
+        if tracer is None and model is None:
+            checksum = self._send(dev, cmd, offset, size, data)
+            return self._check(self._receive(dev), checksum, cmd, offset)
+
+        start = time.perf_counter()
+        checksum = self._send(dev, cmd, offset, size, data)
+        try:
+            reply = self._receive(dev, self._timeout(cmd))
+        except ICL01TimeoutError:
+            if model is not None:
+                model.missed(cmd)
+            raise
+        end = time.perf_counter()
+        reply = self._check(reply, checksum, cmd, offset)
+        if model is not None:
+            model.record(cmd, end - start)
+        if tracer is not None:
+            tracer.round_trip(cmd, offset, size, start, end)
+        return reply
+
+    def _retried(self, cmd, offset, size, data):
+        policy = self.retry
+        recovered = False
+        attempt = 0
+        while True:
+            try:
+                return self._round_trip(cmd, offset, size, data)
+            except IOError as e:
+                attempt += 1
+                if attempt > policy.attempts:
+                    if recovered or not policy.reboot or not isinstance(e, ICL01TimeoutError):
+                        self.stats['failures'] += 1
+                        raise
+                    self._recover()
+                    recovered = True
+                    attempt = 0
+                    continue
+                self.stats['retries'] += 1
+                if self.tracer is not None:
+                    self.tracer.error('retry', cmd, offset)
+                time.sleep(policy.delay(attempt))
+                # Late replies of the failed attempt would be taken for the next one
+                self._drain(self._get(1), min(50, self._timeout(cmd)))
+                self.stats['resyncs'] += 1
+
+    def _recover(self):
+        """Reboot the silent device, reopen it and enter configure mode again"""
+        self.stats['recoveries'] += 1
+        if self.tracer is not None:
+            self.tracer.error('recovery', None, None)
+        readers = [reader is not None for reader in self.readers]
+        self.stop_readers()
+        # Unflushed changes of shadowed regions are kept and sent once back
+        self._reboot()
+        # Pooled handles are stale too
+        self._close_handles(discard=True)
+        time.sleep(self.retry.reboot_delay)
+        for i, running in enumerate(readers):
+            if running:
+                self.start_reader(i)
+        if self.inconfig:
+            self._round_trip(0x01, 0, 0, b'')
+
+    def _traced(self, op, cmd, offset, size, fn, *args):
+        """Call fn(*args) and report it as a transfer to the tracer"""
+        tracer = self.tracer
+        requests = self.requests
+        error = None
+        start = time.perf_counter()
+        try:
+            return fn(*args)
+        except Exception as e:
+            error = e
+            raise
+        finally:
+            tracer.transfer(op, cmd, offset, size, self.requests - requests, start, time.perf_counter(), error)
+
+    def query(self, cmd, offset = 0, size = None, data = None):
+        if data is None:
+            data = b''
+        if size is None:
+            size = len(data)
+
+        if self.tracer is not None:
+            return bytes(self._traced('query', cmd, offset, size, self._query, cmd, offset, size, data))
+        return bytes(self._query(cmd, offset, size, data))
 
     def begin_configure(self):
         if self.inconfig:
@@ -1078,28 +2086,333 @@ class ICL01Device:
     def end_configure(self, *args):
         if not self.inconfig:
             raise RuntimeError("Not in configure mode")
-        self.query(0x02)
-        self.inconfig = False
+        try:
+            self.flush()
+        finally:
+            # Leave configure mode even when changes were lost
+            try:
+                self.query(0x02)
+            finally:
+                self.inconfig = False
 
     __enter__ = begin_configure
     __exit__ = end_configure
 
-    def read(self, cmd, size, offset = 0):
-        ret = b''
-        while size > 0:
-            sz = min(size, self.DATA_MAX)
-            reply = self.query(cmd, offset, sz, None)
-            size -= len(reply)
-            offset += len(reply)
-            ret += reply
-        return ret
+    def _pipeline(self, cmd, requests, out=None, base=0):
+        """
+        Send (offset, size, data) requests keeping at most window of them in flight.
+        Replies are matched back to their request by command and offset.
+        When out is set, replies data are copied in it at their offset minus base.
+        """
+        dev = self._get(1)
+        pending = {}
+        try:
+            self._pipeline_loop(dev, cmd, iter(requests), pending, out, base)
+        except BaseException as e:
+            if pending:
+                self._discard_replies(dev, cmd, len(pending), e)
+            raise
+
+    def _pipeline_loop(self, dev, cmd, requests, pending, out, base):
+        tracer = self.tracer
+        model = self.latency_model
+        policy = self.retry
+        timed = tracer is not None or model is not None
+        window = self.window if self.inflight is None else min(self.inflight, self.window)
+        # Attempts of the requests sent again by offset
+        attempts = collections.Counter()
+        exhausted = False
+        while True:
+            while not exhausted and len(pending) < window:
+                req = next(requests, None)
+                if req is None:
+                    exhausted = True
+                    break
+                offset, size, data = req
+                assert(offset not in pending)
+                start = time.perf_counter() if timed else 0.
+                pending[offset] = (self._send(dev, cmd, offset, size, data), size, data, start)
+
+            if not pending:
+                return
+
+            try:
+                reply = self._receive(dev, self._timeout(cmd))
+            except ICL01TimeoutError:
+                if model is not None:
+                    model.missed(cmd)
+                if policy is None:
+                    raise
+                # Every other reply came: the pending ones are lost
+                self._resend(dev, cmd, pending, attempts)
+                continue
+            hdr = self.REQ_HDR.unpack_from(reply)
+            rcmd, roffset = hdr[2], hdr[4]
+            try:
+                if rcmd != cmd or roffset not in pending:
+                    raise self._fail('unexpected', "Unexpected reply for command 0x{:02x} at offset 0x{:04x}".format(rcmd, roffset), rcmd, roffset)
+                checksum, size, data, start = pending[roffset]
+                rdata = self._check(reply, checksum, cmd, roffset)
+                if len(rdata) != size:
+                    raise self._fail('short', "Short reply at offset 0x{:04x}: {} bytes expected got {}".format(roffset, size, len(rdata)), cmd, roffset)
+            except ICL01QueryError:
+                # Answered, the replies of the others are still expected
+                del pending[roffset]
+                raise
+            except IOError:
+                if policy is None:
+                    raise
+                # Ignored, its request times out and is sent again
+                continue
+            del pending[roffset]
+            if timed:
+                end = time.perf_counter()
+                if model is not None:
+                    model.record(cmd, end - start)
+                if tracer is not None:
+                    tracer.round_trip(cmd, roffset, size, start, end)
+            if out is not None:
+                out[roffset - base:roffset - base + size] = rdata
+
+    def _resend(self, dev, cmd, pending, attempts):
+        """
+        Send again the pending requests of a pipelined transfer whose replies
+        were lost, each of them up to retry.attempts times
+        """
+        policy = self.retry
+        attempt = 0
+        for offset in pending:
+            attempts[offset] += 1
+            attempt = max(attempt, attempts[offset])
+        if attempt > policy.attempts:
+            self.stats['failures'] += 1
+            raise self._fail('timeout', "Replies at offsets {} lost {} times".format(
+                ", ".join("0x{:04x}".format(offset) for offset in sorted(pending)), attempt - 1),
+                cmd, error=ICL01TimeoutError)
+        self.stats['retries'] += len(pending)
+        if self.tracer is not None:
+            for offset in pending:
+                self.tracer.error('retry', cmd, offset)
+        time.sleep(policy.delay(attempt))
+        # Late replies of the lost requests would be taken for the new ones
+        self._drain(dev, min(50, self._timeout(cmd)))
+        self.stats['resyncs'] += 1
+        timed = self.tracer is not None or self.latency_model is not None
+        for offset, (checksum, size, data, start) in list(pending.items()):
+            start = time.perf_counter() if timed else 0.
+            pending[offset] = (self._send(dev, cmd, offset, size, data), size, data, start)
+
+    def _discard_replies(self, dev, cmd, count, error):
+        """Drop the count replies still in flight when a pipelined transfer failed"""
+        if not isinstance(error, ICL01TimeoutError):
+            # The firmware still answers the requests sent after the failed one
+            try:
+                for i in range(count):
+                    self._receive(dev, self._timeout(cmd))
+                return
+            except IOError:
+                pass
+        self._drain(dev)
+
+    # Consecutive failed pipelined transfers halving the requests in flight
+    PIPELINE_FAILURES = 3
+    # Clean pipelined transfers doubling them back, up to window
+    PIPELINE_RECOVERY = 16
+
+    def _pipelined(self, cmd, requests, out=None, base=0):
+        """
+        Run requests through _pipeline. With a RetryPolicy, requests whose
+        replies are lost or invalid are sent again within the pipeline.
+        Returns False when the transfer failed anyway (lost or mismatched
+        replies): it must be redone in strict mode. After PIPELINE_FAILURES
+        failed transfers in a row, inflight is halved; it is doubled back
+        after PIPELINE_RECOVERY clean ones. Status errors are raised.
+        """
+        try:
+            self._pipeline(cmd, requests, out, base)
+        except IOError:
+            if self.tracer is not None:
+                self.tracer.error('fallback', cmd, None)
+            self._drain(self._get(1))
+            self._pipeline_clean = 0
+            self._pipeline_failures += 1
+            if self._pipeline_failures >= self.PIPELINE_FAILURES:
+                self._pipeline_failures = 0
+                window = self.window if self.inflight is None else self.inflight
+                self.inflight = max(1, window // 2)
+            return False
+
+        self._pipeline_failures = 0
+        if self.inflight is not None:
+            self._pipeline_clean += 1
+            if self._pipeline_clean >= self.PIPELINE_RECOVERY:
+                self._pipeline_clean = 0
+                self.inflight *= 2
+                if self.inflight >= self.window:
+                    self.inflight = None
+        return True
+
+    def _shadow_region(self, cmd):
+        if self.shadow is None:
+            return None
+        region = self.shadow.get(cmd)
+        if region is not None:
+            return region
+
+        if cmd in self.SHADOW_REGIONS:
+            read_cmd = cmd
+        else:
+            read_cmd = next((r for r, w in self.SHADOW_REGIONS.items() if w == cmd), None)
+            if read_cmd is None:
+                return None
+        write_cmd = self.SHADOW_REGIONS[read_cmd]
+
+        if read_cmd == 0x05:
+            size = ICL01GlobalConfig.size
+        elif read_cmd == 0x08:
+            size = self.read_capabilities().map_size * Action.size
+        elif read_cmd == 0x0a:
+            size = 10 * 512
+        elif read_cmd == 0x14:
+            size = self.read_capabilities().macros_buffer_size
+
+        region = ShadowRegion(read_cmd, write_cmd, size)
+        self.shadow[read_cmd] = self.shadow[write_cmd] = region
+        return region
+
+    def _shadow_load(self, region):
+        if not region.valid:
+            region.load(self._read(region.read_cmd, region.size))
+
+    def flush(self):
+        """
+        Send the changes made to shadowed regions to the device.
+        Regions which failed to be written are forgotten and the first error
+        raised once the others are sent.
+        """
+        if not self.shadow:
+            return
+        step = self.DATA_MAX
+        error = None
+        for read_cmd in self.SHADOW_REGIONS:
+            region = self.shadow.get(read_cmd)
+            if region is None or not region.dirty:
+                continue
+            view = memoryview(region.data)
+            try:
+                for offset, size in region.dirty_ranges():
+                    self._write(region.write_cmd, view[offset:offset+size], offset)
+                    for chunk in range(offset // step, (offset + size + step - 1) // step):
+                        region.dirty.discard(chunk)
+            except Exception as e:
+                # The device may not hold the data, it's read again when needed
+                region.invalidate()
+                if error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+    def invalidate_shadow(self, cmd=None):
+        """
+        Forget the shadow of the region accessed by cmd or of all regions.
+        Changes not flushed yet are lost.
+        """
+        if not self.shadow:
+            return
+        if cmd is None:
+            regions = self.shadow.values()
+        else:
+            regions = [self.shadow[cmd]] if cmd in self.shadow else []
+        for region in regions:
+            region.invalidate()
+
+    def refresh_shadow(self, cmd=None):
+        """Read again the shadowed regions from the device"""
+        self.invalidate_shadow(cmd)
+        if not self.shadow:
+            return
+        for read_cmd in self.SHADOW_REGIONS:
+            region = self.shadow.get(read_cmd)
+            if region is not None and (cmd is None or cmd in (region.read_cmd, region.write_cmd)):
+                self._shadow_load(region)
+
+    def read(self, cmd, size, offset = 0, out = None):
+        """
+        Read size bytes at offset using command cmd.
+        Data is stored in out when given (its size must be at least size) or
+        in a new bytearray. The buffer is returned.
+        Shadowed regions are read from the device only the first time.
+        """
+        if self.tracer is not None:
+            return self._traced('read', cmd, offset, size, self._read_shadowed, cmd, size, offset, out)
+        return self._read_shadowed(cmd, size, offset, out)
+
+    def _read_shadowed(self, cmd, size, offset, out):
+        region = self._shadow_region(cmd)
+        if region is None:
+            return self._read(cmd, size, offset, out)
+
+        assert(offset + size <= region.size)
+        self._shadow_load(region)
+        if out is None:
+            out = bytearray(size)
+        assert(len(out) >= size)
+        memoryview(out)[:size] = memoryview(region.data)[offset:offset+size]
+        return out
 
     def write(self, cmd, data, offset = 0):
-        while len(data) > 0:
-            sz = min(len(data), self.DATA_MAX)
-            self.query(cmd, offset, None, data[:sz])
-            data = data[sz:]
-            offset += sz
+        """
+        Write data at offset using command cmd.
+        For shadowed regions, only the chunks actually changed are sent, when
+        leaving configure mode or on flush().
+        """
+        if self.tracer is not None:
+            return self._traced('write', cmd, offset, len(data), self._write_shadowed, cmd, data, offset)
+        return self._write_shadowed(cmd, data, offset)
+
+    def _write_shadowed(self, cmd, data, offset):
+        region = self._shadow_region(cmd)
+        if region is None:
+            return self._write(cmd, data, offset)
+
+        self._shadow_load(region)
+        region.update(offset, data)
+        if not self.inconfig:
+            self.flush()
+
+    def _read(self, cmd, size, offset = 0, out = None):
+        if out is None:
+            out = bytearray(size)
+        assert(len(out) >= size)
+        view = memoryview(out)
+
+        if self.window > 1:
+            chunks = ((off, min(offset + size - off, self.DATA_MAX), b'')
+                    for off in range(offset, offset + size, self.DATA_MAX))
+            if self._pipelined(cmd, chunks, view, offset):
+                return out
+
+        pos = 0
+        while pos < size:
+            sz = min(size - pos, self.DATA_MAX)
+            reply = self._query(cmd, offset + pos, sz, b'')
+            view[pos:pos+len(reply)] = reply
+            pos += len(reply)
+        return out
+
+    def _write(self, cmd, data, offset = 0):
+        view = memoryview(data)
+        size = len(view)
+
+        if self.window > 1:
+            chunks = ((offset + pos, min(size - pos, self.DATA_MAX), view[pos:pos+self.DATA_MAX])
+                    for pos in range(0, size, self.DATA_MAX))
+            if self._pipelined(cmd, chunks):
+                return
+
+        for pos in range(0, size, self.DATA_MAX):
+            chunk = view[pos:pos+self.DATA_MAX]
+            self._query(cmd, offset + pos, len(chunk), chunk)
 
     def read_capabilities(self, force=False):
         if self.capabilities and not force:
@@ -1162,46 +2475,52 @@ class ICL01Device:
     def read_original_mapping_table(self):
         sz = self.read_capabilities().map_size * 3
         data = self.read(0x07, size=sz)
-        return [Action.unpack_from(data, offset) for offset in range(0, sz, 3)]
+        return MappingTable(data)
 
     def read_current_mapping_table(self):
         sz = self.read_capabilities().map_size * 3
         data = self.read(0x08, size=sz)
-        return [Action.unpack_from(data, offset) for offset in range(0, sz, 3)]
+        return MappingTable(data)
 
     def write_current_mapping_table(self, actions, start=0):
+        """
+        Write actions, a list of Action or a MappingTable, from key start.
+        When a MappingTable has dirty entries, only these are written.
+        """
         if not self.inconfig:
             raise RuntimeError("Device must be set in configure state first")
 
-        assert(start + len(actions) < self.read_capabilities().map_size)
+        assert(start + len(actions) <= self.read_capabilities().map_size)
 
-        data = bytearray(len(actions) * Action.size)
-        offset = 0
-        for action in actions:
-            action.pack_into(data, offset)
-            offset += Action.size
+        if isinstance(actions, MappingTable) and actions.dirty:
+            view = memoryview(actions.data)
+            for key, count in actions.dirty_ranges():
+                offset = key * Action.size
+                self.write(0x09, view[offset:offset+count*Action.size], offset=(start+key)*Action.size)
+            actions.dirty.clear()
+            return
 
-        self.write(0x09, data, offset=start*Action.size)
+        self.write(0x09, Action.pack_table(actions), offset=start*Action.size)
 
-    def read_custom_colors(self, profile=None):
+    def read_custom_colors(self, profile=None, out=None):
         if profile is None:
             sz = 10 * 512
+            offset = 0
         else:
-            assert(len(data) <= 512)
             assert(profile < 10)
             sz = 512
             offset = profile * 512
-        data = self.read(0x0a, size=sz)
+        data = memoryview(self.read(0x0a, size=sz, offset=offset, out=out))
         profile_size = self.read_capabilities().map_size * Color.size
         assert(profile_size < 512)
         if profile is None:
             ret = []
             for i in range(10):
                 d = data[i*512:i*512+profile_size]
-                ret.append(list(Color.iter_unpack(d)))
+                ret.append(ColorFrame(d))
         else:
             d = data[:profile_size]
-            ret = list(Color.iter_unpack(d))
+            ret = ColorFrame(d)
 
         return ret
 
@@ -1211,49 +2530,44 @@ class ICL01Device:
 
         if profile is None:
             # start is the profile number to begin to change
-            # colors is an array of array of 170 colors
-            assert(start + len(colors) < 10)
+            # colors is an array of up to 10 profiles of up to 170 colors
+            assert(start + len(colors) <= 10)
             data = bytearray(len(colors)*512)
             for i, col in enumerate(colors):
-                assert(len(col) == 170) # 512/3
-                offset = i * 512
-                for c in col:
-                    c.pack_into(data, offset)
-                    offset += c.size
+                col = _pack_colors(col)
+                assert(len(col) % Color.size == 0)
+                assert(len(col) // Color.size <= 170) # 512/3
+                data[i*512:i*512+len(col)] = col
             offset = start * 512
         else:
             # start is the color index in the profile to begin to change
             # colors is an array of colors
             assert(profile < 10)
-            assert((start+len(colors))*Color.size <= 512)
-            data = bytearray(len(colors)*Color.size)
-            offset = 0
-            for c in colors:
-                c.pack_into(data, offset)
-                offset += c.size
+            data = _pack_colors(colors)
+            assert(len(data) % Color.size == 0)
+            assert(start*Color.size + len(data) <= 512)
             offset = profile * 512 + start * Color.size
 
         self.write(0x0b, data, offset=offset)
 
     def reset(self):
         self.query(0x0d)
+        self.invalidate_shadow()
 
     def write_computer_colors(self, colors, start=0):
+        data = _pack_colors(colors)
+        assert(len(data) % Color.size == 0)
         sz = self.read_capabilities().map_size
-        assert(len(colors) <= sz - start)
-
-        data = b''
-        for col in colors:
-            data += col.pack()
+        assert(len(data) // Color.size <= sz - start)
 
         self.write(0x12, data, offset=start*Color.size)
 
     def cancel_computer_colors(self):
         self.query(0x13)
         
-    def read_macros(self):
+    def read_macros(self, out=None):
         sz = self.read_capabilities().macros_buffer_size
-        data = self.read(0x14, size=sz)
+        data = self.read(0x14, size=sz, out=out)
         return MacrosBlock.unpack_from(data)
 
     def write_macros(self, macros):
@@ -1269,6 +2583,124 @@ class ICL01Device:
         
         data = self.write(0x15, data, offset=0)
 
+    def plan(self, desired):
+        """
+        Compare desired, a DesiredState, with the device memory and return the
+        WritePlan of the smallest queries bringing the device to it.
+        """
+        regions = []
+
+        if desired.global_config is not None:
+            current = self.read(0x05, ICL01GlobalConfig.size)
+            wanted = bytearray(current)
+            # Packed over the current content to keep unknown bytes
+            desired.global_config.pack_into(wanted, 0)
+            regions.append((0x06, 0, current, wanted))
+
+        if desired.mapping is not None:
+            sz = len(desired.mapping) * Action.size
+            assert(sz <= self.read_capabilities().map_size * Action.size)
+            current = self.read(0x08, sz)
+            wanted = Action.pack_table(desired.mapping)
+            regions.append((0x09, 0, current, wanted))
+
+        if desired.custom_colors is not None:
+            assert(len(desired.custom_colors) <= 10)
+            current = self.read(0x0a, 10 * 512)
+            wanted = bytearray(current)
+            for i, colors in enumerate(desired.custom_colors):
+                if colors is None:
+                    continue
+                colors = _pack_colors(colors)
+                assert(len(colors) <= 512)
+                wanted[i*512:i*512+len(colors)] = colors
+            regions.append((0x0b, 0, current, wanted))
+
+        if desired.macros is not None:
+            wanted = desired.macros.pack()
+            assert(len(wanted) <= self.read_capabilities().macros_buffer_size)
+            current = self.read(0x14, len(wanted))
+            regions.append((0x15, 0, current, wanted))
+
+        return self._plan_regions(regions)
+
+    def _plan_regions(self, regions):
+        """Build the WritePlan of (write cmd, offset, current, wanted) regions"""
+        plan = WritePlan()
+        for cmd, base, current, wanted in regions:
+            wanted = memoryview(wanted)
+            for offset, size in _changed_spans(current, wanted, self.DATA_MAX):
+                plan.append(Transaction(cmd, base + offset, bytes(wanted[offset:offset+size])))
+        return plan
+
+    def apply(self, desired, dry_run=False):
+        """
+        Bring the device to desired, a DesiredState, in a single configure
+        session. Nothing is sent when the device already matches it or when
+        dry_run is set. Returns the WritePlan.
+        """
+        plan = self.plan(desired)
+        if not dry_run:
+            self._run_plan(plan)
+        return plan
+
+    def _run_plan(self, plan):
+        if not plan:
+            return
+
+        leave = not self.inconfig
+        if leave:
+            self.begin_configure()
+        try:
+            for t in plan:
+                self.write(t.cmd, t.data, t.offset)
+        finally:
+            if leave:
+                self.end_configure()
+
+    def dump_image(self):
+        """Read every memory region into a DeviceImage"""
+        caps = self.read_capabilities()
+        regions = {}
+        for cmd in DeviceImage.REGIONS:
+            regions[cmd] = self.read(cmd, DeviceImage.region_size(cmd, caps))
+        return DeviceImage(regions)
+
+    def restore_image(self, image, dry_run=False):
+        """
+        Write back the writable regions of image in a single configure session.
+        Only the bytes differing from the device are sent. Returns the WritePlan.
+        """
+        if 0x03 not in image.regions:
+            raise ValueError("Image has no capabilities region (0x03)")
+        caps = self.read_capabilities()
+        if (image.capabilities.map_size != caps.map_size or
+                image.capabilities.macros_buffer_size != caps.macros_buffer_size):
+            raise ValueError("Image was made on an incompatible device")
+
+        return self.apply_regions(image.regions, dry_run)
+
+    def apply_regions(self, regions, dry_run=False):
+        """
+        Write regions, raw data by read command (like DeviceImage.regions),
+        from their start in a single configure session. Only the bytes
+        differing from the device are sent and regions which can't be
+        written are ignored. Returns the WritePlan.
+        """
+        current = []
+        for cmd, write_cmd in DeviceImage.WRITABLE.items():
+            data = regions.get(cmd)
+            if data is None:
+                continue
+            if len(data) > DeviceImage.region_size(cmd, self.read_capabilities()):
+                raise ValueError("Region 0x{:02x} data is too large".format(cmd))
+            current.append((write_cmd, 0, self.read(cmd, len(data)), data))
+
+        plan = self._plan_regions(current)
+        if not dry_run:
+            self._run_plan(plan)
+        return plan
+
     def read_physical_map(self):
         sz = self.read_capabilities().map_size
         data = self.read(0x1b, size=sz)
@@ -1291,21 +2723,473 @@ class ICL01Device:
 
 assert(ICL01Device.MSG_HDR.size == 64)
 
-def enumerate_icl01():
-    interfaces = None
-    for d in hid.enumerate(0x320f, 0x5041):
-        if d['interface_number'] == 0:
-            if interfaces is not None:
-                assert(len(interfaces) == 2)
-                yield ICL01Device(interfaces)
-            interfaces = [d['path']]
+class DeviceImage:
+    """
+    Raw content of every memory region of a device, indexed by read command.
+    Binary format, little endian:
+        header: magic 'ICL01IMG', version (u16), regions count (u16)
+        then for each region: read command (u8), 3 reserved bytes, size (u32), data
+    """
+    __slots__ = ('regions', )
+    MAGIC = b'ICL01IMG'
+    VERSION = 1
+    HDR = struct.Struct('<8sHH')
+    REGION = struct.Struct('<B3xI')
+    # Capabilities, profiles, original and current mapping tables,
+    # custom colors, macros and physical map
+    REGIONS = (0x03, 0x05, 0x07, 0x08, 0x0a, 0x14, 0x1b)
+    # Regions restored and their write command
+    WRITABLE = {0x05: 0x06, 0x08: 0x09, 0x0a: 0x0b, 0x14: 0x15}
+
+    def __init__(self, regions):
+        self.regions = regions
+
+    @staticmethod
+    def region_size(cmd, caps):
+        if cmd == 0x03:
+            return ICL01Capabilities.size
+        if cmd == 0x05:
+            return ICL01GlobalConfig.size
+        if cmd in (0x07, 0x08):
+            return caps.map_size * Action.size
+        if cmd == 0x0a:
+            return 10 * 512
+        if cmd == 0x14:
+            return caps.macros_buffer_size
+        if cmd == 0x1b:
+            return caps.map_size
+        raise ValueError("Unknown region 0x{:02x}".format(cmd))
+
+    @classmethod
+    def unpack_from(cls, buffer, offset=0):
+        """Regions are views on buffer, nothing is copied"""
+        buffer = memoryview(buffer)
+        if offset + cls.HDR.size > len(buffer):
+            raise ValueError("Not an ICL01 image")
+        magic, version, count = cls.HDR.unpack_from(buffer, offset)
+        if magic != cls.MAGIC:
+            raise ValueError("Not an ICL01 image")
+        if version != cls.VERSION:
+            raise ValueError("Unsupported image version {}".format(version))
+        offset += cls.HDR.size
+        regions = {}
+        for i in range(count):
+            if offset + cls.REGION.size > len(buffer):
+                raise ValueError("Truncated image")
+            cmd, size = cls.REGION.unpack_from(buffer, offset)
+            offset += cls.REGION.size
+            if offset + size > len(buffer):
+                raise ValueError("Truncated image")
+            regions[cmd] = buffer[offset:offset+size]
+            offset += size
+        return cls(regions)
+
+    @classmethod
+    def unpack(cls, data):
+        return cls.unpack_from(data)
+
+    @classmethod
+    def read(cls, stream):
+        return cls.unpack(stream.read())
+
+    def size(self):
+        return self.HDR.size + sum(self.REGION.size + len(data) for data in self.regions.values())
+
+    def write(self, stream):
+        """Stream the image without assembling it in memory"""
+        stream.write(self.HDR.pack(self.MAGIC, self.VERSION, len(self.regions)))
+        for cmd, data in self.regions.items():
+            stream.write(self.REGION.pack(cmd, len(data)))
+            stream.write(data)
+
+    def pack(self):
+        buffer = io.BytesIO()
+        self.write(buffer)
+        return buffer.getvalue()
+
+    @property
+    def capabilities(self):
+        return ICL01Capabilities.unpack(self.regions[0x03])
+
+    @property
+    def global_config(self):
+        return ICL01GlobalConfig.unpack(self.regions[0x05])
+
+    @property
+    def original_mapping(self):
+        return MappingTable(self.regions[0x07])
+
+    @property
+    def current_mapping(self):
+        return MappingTable(self.regions[0x08])
+
+    @property
+    def custom_colors(self):
+        profile_size = self.capabilities.map_size * Color.size
+        data = self.regions[0x0a]
+        return [ColorFrame(data[i*512:i*512+profile_size]) for i in range(10)]
+
+    @property
+    def macros(self):
+        return MacrosBlock.unpack(self.regions[0x14])
+
+    @property
+    def physical_map(self):
+        return self.regions[0x1b]
+
+    def __repr__(self):
+        return "<{}: {}>".format(self.__class__.__name__,
+                ", ".join("0x{:02x}: {} bytes".format(cmd, len(data)) for cmd, data in self.regions.items()))
+
+class AsyncICL01Device:
+    """
+    asyncio front-end of an ICL01Device.
+    Blocking calls are run one at a time, in order, in a thread dedicated to
+    the device so the event loop is never blocked.
+
+    async with device:
+        ...
+    mirrors the synchronous configure mode context: end_configure is always
+    sent on the way out, even when the task gets cancelled.
+    """
+    def __init__(self, device):
+        from concurrent import futures
+        self.device = device
+        self._executor = futures.ThreadPoolExecutor(max_workers=1,
+                thread_name_prefix=repr(device))
+
+    def __repr__(self):
+        return "<{0}: {1!r}>".format(self.__class__.__name__, self.device.paths)
+
+    async def run(self, func, *args, **kwargs):
+        """Run a blocking func(*args, **kwargs) in the device thread"""
+        import asyncio
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, functools.partial(func, *args, **kwargs))
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+
+    async def query(self, cmd, offset = 0, size = None, data = None):
+        return await self.run(self.device.query, cmd, offset, size, data)
+
+    async def read(self, cmd, size, offset = 0, out = None):
+        return await self.run(self.device.read, cmd, size, offset, out)
+
+    async def write(self, cmd, data, offset = 0):
+        return await self.run(self.device.write, cmd, data, offset)
+
+    async def read_capabilities(self, force=False):
+        return await self.run(self.device.read_capabilities, force)
+
+    async def read_macros(self, out=None):
+        return await self.run(self.device.read_macros, out)
+
+    async def write_macros(self, macros):
+        return await self.run(self.device.write_macros, macros)
+
+    async def write_computer_colors(self, colors, start=0):
+        return await self.run(self.device.write_computer_colors, colors, start)
+
+    async def cancel_computer_colors(self):
+        return await self.run(self.device.cancel_computer_colors)
+
+    async def begin_configure(self):
+        return await self.run(self.device.begin_configure)
+
+    async def end_configure(self):
+        return await self.run(self.device.end_configure)
+
+    def _leave_configure(self):
+        if self.device.inconfig:
+            self.device.end_configure()
+
+    async def __aenter__(self):
+        import asyncio
+        try:
+            await self.begin_configure()
+        except asyncio.CancelledError:
+            # begin_configure may still complete in the device thread
+            await asyncio.shield(self.run(self._leave_configure))
+            raise
+        return self
+
+    async def __aexit__(self, *args):
+        import asyncio
+        # Shielded: a second cancellation must not skip end_configure
+        await asyncio.shield(self.run(self._leave_configure))
+
+class FrameDiffer:
+    """
+    Send live colors frames to a device, only transmitting the keys changed
+    since the previous frame. Changes are covered by the fewest queries, so
+    nearby changes share a query when it saves a round trip.
+    """
+    def __init__(self, device):
+        self.device = device
+        self.last = None
+        self.frames = 0
+        self.queries = 0
+        self.bytes_sent = 0
+        self.bytes_full = 0
+        self.last_sent = 0
+
+    @property
+    def bytes_saved(self):
+        return self.bytes_full - self.bytes_sent
+
+    @property
+    def saved_per_frame(self):
+        return self.bytes_saved / self.frames if self.frames else 0.
+
+    def reset(self):
+        """Forget the previous frame, the next one is sent in full"""
+        self.last = None
+
+    def push(self, colors):
+        # Copied as the caller may update its frame in place
+        data = bytes(_pack_colors(colors))
+
+        if self.last is None or len(self.last) != len(data):
+            spans = [(off, min(len(data) - off, self.device.DATA_MAX))
+                    for off in range(0, len(data), self.device.DATA_MAX)]
         else:
-            assert(interfaces is not None)
-            interfaces.append(d['path'])
-    
-    if interfaces is not None:
-        assert(len(interfaces) == 2)
-        yield ICL01Device(interfaces)
+            spans = _changed_spans(self.last, data, self.device.DATA_MAX)
+
+        view = memoryview(data)
+        sent = 0
+        try:
+            for offset, size in spans:
+                self.device.write(0x12, view[offset:offset+size], offset)
+                sent += size
+        except BaseException:
+            # Part of the frame may be shown, the next one is sent in full
+            self.reset()
+            raise
+        self.last = data
+
+        self.frames += 1
+        self.queries += len(spans)
+        self.last_sent = sent
+        self.bytes_sent += sent
+        self.bytes_full += len(data)
+        return sent
+
+    def __str__(self):
+        return "{} frames, {} queries, {} bytes sent, {:.1f} bytes saved per frame".format(
+                self.frames, self.queries, self.bytes_sent, self.saved_per_frame)
+
+class LightingStats:
+    """Frame statistics of a LightingEngine run"""
+    __slots__ = ('frames', 'dropped', 'elapsed', 'latencies')
+
+    def __init__(self):
+        self.frames = 0
+        self.dropped = 0
+        self.elapsed = 0.
+        self.latencies = []
+
+    @property
+    def fps(self):
+        return self.frames / self.elapsed if self.elapsed else 0.
+
+    def latency(self, percentile=50):
+        if not self.latencies:
+            return 0.
+        lat = sorted(self.latencies)
+        return lat[min(len(lat) - 1, len(lat) * percentile // 100)]
+
+    def __str__(self):
+        return "{} frames ({} dropped) in {:.3f} s: {:.1f} FPS, latency p50 {:.2f} ms, p99 {:.2f} ms".format(
+                self.frames, self.dropped, self.elapsed, self.fps,
+                self.latency(50) * 1000., self.latency(99) * 1000.)
+
+class LightingEngine:
+    """
+    Send live colors frames (0x12) at a steady frame rate.
+    render(index, t) is called at each frame with the frame index and the time
+    in seconds since the start. It returns the colors to send.
+    Frames are paced on monotonic deadlines: when the device falls behind, the
+    missed frames are dropped and merged in the next rendered one.
+    Live colors are cancelled when the engine stops.
+    When diff is set, frames are sent through a FrameDiffer.
+    """
+    def __init__(self, device, render, fps=30, diff=False):
+        assert(fps > 0)
+        self.device = device
+        self.render = render
+        self.fps = fps
+        self.stats = LightingStats()
+        self.differ = FrameDiffer(device) if diff else None
+        self._stopping = threading.Event()
+
+    def stop(self):
+        """Make run() return after the current frame, can be called from any thread"""
+        self._stopping.set()
+
+    def send(self, colors):
+        if self.differ is not None:
+            self.differ.push(colors)
+        else:
+            self.device.write_computer_colors(colors)
+
+    def run(self, duration=None, frames=None):
+        period = 1. / self.fps
+        stats = self.stats = LightingStats()
+        self._stopping.clear()
+        start = deadline = time.monotonic()
+        index = 0
+        failed = True
+        try:
+            while not self._stopping.is_set():
+                if frames is not None and stats.frames >= frames:
+                    break
+                now = time.monotonic()
+                if duration is not None and now - start >= duration:
+                    break
+                if now < deadline:
+                    # Wake up early if stopped
+                    if self._stopping.wait(deadline - now):
+                        break
+                    now = time.monotonic()
+                elif now - deadline >= period:
+                    missed = int((now - deadline) / period)
+                    stats.dropped += missed
+                    index += missed
+                    deadline += missed * period
+
+                colors = self.render(index, now - start)
+                self.send(colors)
+                stats.latencies.append(time.monotonic() - now)
+                stats.frames += 1
+                index += 1
+                deadline += period
+            failed = False
+        finally:
+            stats.elapsed = time.monotonic() - start
+            if self.differ is not None:
+                self.differ.reset()
+            try:
+                self.device.cancel_computer_colors()
+            except IOError:
+                # When the device went away, the error which stopped the loop is raised
+                if not failed:
+                    raise
+        return stats
+
+def enumerate_icl01(backend=None, **kwargs):
+    """
+    Yield an ICL01Device per connected keyboard.
+    backend is a module following hid API (enumerate() and device()), like
+    icl01_sim, and defaults to hid.
+    """
+    if backend is None:
+        import hid as backend
+    kwargs['backend'] = backend
+
+    for interfaces, serial, location in _enumerate_interfaces(backend):
+        yield ICL01Device(interfaces, serial=serial, location=location, **kwargs)
+
+def _enumerate_interfaces(backend):
+    """
+    Yield the interfaces paths, serial number and physical USB path of each
+    keyboard. Interfaces are paired on their USB path (usb_path) when the
+    backend gives it, else by order: interface 0 then its interface 1.
+    Keyboards with a missing interface, while being plugged, are skipped.
+    """
+    keyboards = {}
+    order = None
+    for d in backend.enumerate(0x320f, 0x5041):
+        intf = d['interface_number']
+        if intf not in (0, 1):
+            continue
+        location = d.get('usb_path')
+        if location is not None:
+            key = location
+        else:
+            if intf == 0:
+                order = 0 if order is None else order + 1
+            key = order
+            if key is None:
+                continue
+        kbd = keyboards.setdefault(key, [None, None, d.get('serial_number'), location])
+        kbd[intf] = d['path']
+
+    for intf0, intf1, serial, location in keyboards.values():
+        if intf0 is not None and intf1 is not None:
+            yield [intf0, intf1], serial, location
+
+FleetResult = collections.namedtuple('FleetResult', ('device', 'result', 'error', 'elapsed'))
+
+def run_fleet(devices, operation, *args, max_workers=8, timeout=None, configure=False, **kwargs):
+    """
+    Run operation on every device with at most max_workers of them at once.
+    operation is either a callable taking the device as first argument or the
+    name of an ICL01Device method, both called with args and kwargs.
+    When configure is set, the operation is run in configure mode.
+
+    Returns a FleetResult per device, in devices order. A failing device gets
+    its exception in error and doesn't affect the other ones. A device still
+    running timeout seconds after it started gets a TimeoutError and its
+    worker is given to the next device, so a hung device only delays the
+    others by timeout.
+    """
+    devices = list(devices)
+    if isinstance(operation, str):
+        operation = getattr(ICL01Device, operation)
+
+    cond = threading.Condition()
+    # Free workers, started time and result by device index
+    free = [min(max_workers, len(devices))]
+    started = [None] * len(devices)
+    results = [None] * len(devices)
+
+    def run(i, device):
+        with cond:
+            while not free[0]:
+                cond.wait()
+            free[0] -= 1
+            started[i] = start = time.monotonic()
+            cond.notify_all()
+        try:
+            if configure:
+                with device:
+                    result = operation(device, *args, **kwargs)
+            else:
+                result = operation(device, *args, **kwargs)
+            result = FleetResult(device, result, None, time.monotonic() - start)
+        except Exception as e:
+            result = FleetResult(device, None, e, time.monotonic() - start)
+        with cond:
+            # Already given up on when timed out
+            if results[i] is None:
+                results[i] = result
+                free[0] += 1
+            cond.notify_all()
+
+    for i, device in enumerate(devices):
+        # Daemon: a stuck device must not keep the process alive
+        threading.Thread(target=run, args=(i, device), name="fleet-{}".format(i), daemon=True).start()
+
+    with cond:
+        while None in results:
+            wait = None
+            if timeout is not None:
+                now = time.monotonic()
+                for i, start in enumerate(started):
+                    if start is None or results[i] is not None:
+                        continue
+                    left = start + timeout - now
+                    if left <= 0:
+                        results[i] = FleetResult(devices[i], None,
+                                TimeoutError("Operation still running after {} s".format(timeout)), now - start)
+                        free[0] += 1
+                        cond.notify_all()
+                    elif wait is None or left < wait:
+                        wait = left
+            if None in results:
+                cond.wait(wait)
+    return results
 
 def patchconfig(d):
     with d:
@@ -1320,18 +3204,18 @@ def patchconfig(d):
         
 def live_colors_snake(d):
     sz = d.read_capabilities().map_size
-    colors = [Color(0xff, 0, 0)] * sz
+    colors = ColorFrame.filled(sz, Color(0xff, 0, 0))
     colors[0] = Color(0xff, 0xff, 0xff)
+
+    def render(index, t):
+        return colors.roll(index)
+
+    engine = LightingEngine(d, render, fps=60, diff=True)
     try:
-        while True:
-            for i in range(sz):
-                d.write_computer_colors(colors)
-                time.sleep(0.01)
-                item = colors.pop()
-                colors.insert(0, item)
+        engine.run()
     except KeyboardInterrupt:
         pass
-    d.cancel_computer_colors()
+    print(engine.stats)
     
 def live_colors_test(d):
     d.write_computer_color(Color(0xff, 0xcc, 0x00))
@@ -1343,22 +3227,21 @@ def dump_mapping_table(d):
     physical = d.read_physical_map()
     orig = d.read_original_mapping_table()
     current = d.read_current_mapping_table()
+    changed = set(orig.diff(current))
     for key in physical:
         if key == 0xff:
             print("<Empty space>")
             continue
         
         o, c = orig[key], current[key]
-        if c != o:
+        if key in changed:
             print(str(o), "=>", str(c))
         else:
             print(str(o))
             
 
 
-for d in enumerate_icl01():
-    #print(d)
-    
+def info(d):
     print(d.read_capabilities())
     #print(d.read_physical_map())
 
@@ -1369,7 +3252,139 @@ for d in enumerate_icl01():
     #live_colors_test(d)
 
     dump_mapping_table(d)
-    
+
     print(d.read_macros())
 
     #d.reboot()
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Customize ICL01 keyboards")
+    parser.add_argument('--device', type=int, help="index of the keyboard to use, all of them by default")
+    parser.add_argument('--window', type=int, default=1, help="requests kept in flight (1 for strict transfers)")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--sim', action='store_true', help="use a simulated keyboard")
+    group.add_argument('--hidraw', action='store_true', help="talk to /dev/hidraw* directly instead of using hidapi")
+    parser.add_argument('--retry', action='store_true',
+            help="retry failed requests and reboot keyboards which stop answering")
+    parser.add_argument('--timeouts', metavar='FILE',
+            help="adapt timeouts to the latency of each keyboard, remembered in FILE")
+    parser.add_argument('--trace', metavar='FILE',
+            help="save a Chrome trace of the transfers and print their statistics")
+    sub = parser.add_subparsers(dest='command')
+    sub.add_parser('info', help="show capabilities, mapping table and macros")
+    p = sub.add_parser('dump', help="save the full device image")
+    p.add_argument('-o', '--output', default='-',
+            help="image file, {index} is replaced by the keyboard index (default: stdout)")
+    p.add_argument('-a', '--archive', help="append the images to this snapshot archive instead")
+    p = sub.add_parser('restore', help="write back a device image")
+    p.add_argument('image', help="image file or - for stdin")
+    p.add_argument('-n', '--dry-run', action='store_true', help="only show what would be written")
+    args = parser.parse_args(argv)
+
+    backend = None
+    if args.sim:
+        import icl01_sim
+        icl01_sim.add_keyboard()
+        backend = icl01_sim
+    elif args.hidraw:
+        import icl01_hidraw
+        backend = icl01_hidraw
+
+    tracer = None
+    if args.trace:
+        import icl01_trace
+        tracer = icl01_trace.ChromeTrace()
+    devices = list(enumerate_icl01(backend=backend, window=args.window, tracer=tracer,
+        retry=True if args.retry else None))
+    if args.device is not None:
+        devices = [devices[args.device]] if 0 <= args.device < len(devices) else []
+    if not devices:
+        parser.error("no keyboard found")
+    if args.timeouts:
+        for d in devices:
+            d.latency_model = LatencyModel.load(args.timeouts, d.key)
+
+    try:
+        return run_command(args, parser, devices)
+    except BrokenPipeError:
+        # Output piped to a command which exited early (head...), silence
+        # the flush at exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return 1
+    finally:
+        for d in devices:
+            d.close()
+        if args.timeouts:
+            for d in devices:
+                d.latency_model.save(args.timeouts, d.key)
+        if tracer is not None:
+            with open(args.trace, 'w') as f:
+                tracer.export(f)
+            print(tracer, end='', file=sys.stderr)
+
+def run_command(args, parser, devices):
+    if args.command is None or args.command == 'info':
+        for d in devices:
+            info(d)
+        return 0
+
+    if args.command == 'dump' and args.archive:
+        import icl01_archive
+        status = 0
+        with icl01_archive.SnapshotArchive(args.archive) as arc:
+            for r in run_fleet(devices, 'dump_image'):
+                if r.error is not None:
+                    print("{!r}: {}".format(r.device, r.error), file=sys.stderr)
+                    status = 1
+                    continue
+                arc.append(icl01_archive.device_key(r.device), r.result)
+        return status
+
+    if args.command == 'dump':
+        if len(devices) > 1 and '{index}' not in args.output:
+            parser.error("dumping several keyboards needs {index} in output")
+        if args.output == '-' and sys.stdout.isatty():
+            parser.error("refusing to write a binary image to a terminal")
+        status = 0
+        for i, r in enumerate(run_fleet(devices, 'dump_image')):
+            if r.error is not None:
+                print("{!r}: {}".format(r.device, r.error), file=sys.stderr)
+                status = 1
+                continue
+            if args.output == '-':
+                r.result.write(sys.stdout.buffer)
+                sys.stdout.buffer.flush()
+            else:
+                with open(args.output.format(index=i), 'wb') as f:
+                    r.result.write(f)
+            print("{!r}: dumped {} bytes in {:.2f} s".format(r.device, r.result.size(), r.elapsed), file=sys.stderr)
+        return status
+
+    if args.command == 'restore':
+        try:
+            if args.image == '-':
+                image = DeviceImage.read(sys.stdin.buffer)
+            else:
+                with open(args.image, 'rb') as f:
+                    image = DeviceImage.read(f)
+        except (OSError, ValueError) as e:
+            parser.error("{}: {}".format(args.image, e))
+        present = ", ".join("0x{:02x}".format(cmd) for cmd in sorted(image.regions)) or "none"
+        if 0x03 not in image.regions:
+            parser.error("{}: no capabilities region (0x03) to check the keyboard against "
+                    "(regions: {})".format(args.image, present))
+        if not any(cmd in image.regions for cmd in DeviceImage.WRITABLE):
+            parser.error("{}: no writable region (regions: {})".format(args.image, present))
+        status = 0
+        for r in run_fleet(devices, 'restore_image', image, dry_run=args.dry_run):
+            if r.error is not None:
+                print("{!r}: {}".format(r.device, r.error), file=sys.stderr)
+                status = 1
+                continue
+            print("{!r}: restored in {:.2f} s, {}".format(r.device, r.elapsed, r.result), end='', file=sys.stderr)
+        return status
+
+if __name__ == '__main__':
+    raise SystemExit(main())
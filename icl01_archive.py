@@ -0,0 +1,243 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Append-only archive of ICL01 device images.
+Many snapshots, keyed by device (serial number, or HID path without one) and
+timestamp, are stored in a single file which is memory mapped: images decode
+straight from the mapping without being copied. Several processes can append
+to the same archive.
+
+    with icl01_archive.SnapshotArchive('nightly.arc') as arc:
+        for d in icl01.enumerate_icl01():
+            arc.append(icl01_archive.device_key(d), d.dump_image())
+        print(arc.remapped())
+"""
+
+import bisect
+import collections
+import contextlib
+import fcntl
+import mmap
+import os
+import struct
+import time
+
+from icl01 import DeviceImage, MappingTable
+
+Snapshot = collections.namedtuple('Snapshot', ('key', 'timestamp', 'offset', 'size'))
+
+def device_key(device):
+    """
+    Default key of a device: its serial number, which stays the same across
+    ports and reboots, or the path of its first interface without one.
+    """
+    return device.key
+
+class SnapshotArchive:
+    """
+    Binary format, little endian:
+        header: magic 'ICL01ARC', version (u16), 6 reserved bytes
+        then for each snapshot: tag 'SNAP', image size (u32), timestamp (f64),
+        key size (u16), key (UTF-8), DeviceImage
+    Appends are serialized between processes by an exclusive flock() on the
+    file. Records appended by other processes are indexed by the next
+    append(), or by refresh().
+    A record left incomplete by a crash is dropped when the archive is opened
+    for writing.
+    """
+    MAGIC = b'ICL01ARC'
+    VERSION = 1
+    HDR = struct.Struct('<8sH6x')
+    RECORD = struct.Struct('<4sIdH')
+    TAG = b'SNAP'
+
+    def __init__(self, path, writable=True):
+        self.path = path
+        self.writable = writable
+        if writable:
+            # Not truncated: another process may be creating it too
+            self._file = os.fdopen(os.open(path, os.O_RDWR | os.O_CREAT, 0o666), 'r+b')
+        else:
+            self._file = open(path, 'rb')
+        self._map = None
+        self._view = None
+        # Snapshots of each key sorted by timestamp
+        self.index = {}
+        self._timestamps = {}
+        self.end = 0
+        if writable:
+            with self._locked():
+                if os.fstat(self._file.fileno()).st_size == 0:
+                    self._file.write(self.HDR.pack(self.MAGIC, self.VERSION))
+                    self._file.flush()
+                self._sync()
+        else:
+            self.end = self._scan()
+
+    @contextlib.contextmanager
+    def _locked(self):
+        fcntl.flock(self._file.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(self._file.fileno(), fcntl.LOCK_UN)
+
+    def _sync(self):
+        """
+        Index the records appended since the last scan and drop an incomplete
+        one left by a crash. Called with the lock held.
+        """
+        self.end = self._scan(self.end or None)
+        if self.end != os.fstat(self._file.fileno()).st_size:
+            self._file.truncate(self.end)
+
+    def refresh(self):
+        """Index the records appended by other processes"""
+        self.end = self._scan(self.end)
+
+    def _buffer(self, size=0):
+        """View on the mapping, remapped when the file grew"""
+        if self._view is None or len(self._view) < max(self.end, size):
+            # Views handed out keep the previous mapping alive
+            self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+            self._view = memoryview(self._map)
+        return self._view
+
+    def _scan(self, offset=None):
+        """
+        Index the complete records from offset, from the header by default.
+        Returns the end of the last one.
+        """
+        size = os.fstat(self._file.fileno()).st_size
+        if offset is None:
+            if size < self.HDR.size:
+                raise ValueError("Not an ICL01 archive")
+            buffer = self._buffer(size)
+            magic, version = self.HDR.unpack_from(buffer)
+            if magic != self.MAGIC:
+                raise ValueError("Not an ICL01 archive")
+            if version != self.VERSION:
+                raise ValueError("Unsupported archive version {}".format(version))
+            offset = self.HDR.size
+        elif size <= offset:
+            return offset
+
+        buffer = self._buffer(size)
+        while offset + self.RECORD.size <= size:
+            tag, image_size, timestamp, key_size = self.RECORD.unpack_from(buffer, offset)
+            start = offset + self.RECORD.size + key_size
+            if tag != self.TAG or start + image_size > size:
+                break
+            key = bytes(buffer[offset+self.RECORD.size:start]).decode('utf-8')
+            self._add(Snapshot(key, timestamp, start, image_size))
+            offset = start + image_size
+        return offset
+
+    def _add(self, snapshot):
+        snapshots = self.index.setdefault(snapshot.key, [])
+        timestamps = self._timestamps.setdefault(snapshot.key, [])
+        i = bisect.bisect_right(timestamps, snapshot.timestamp)
+        snapshots.insert(i, snapshot)
+        timestamps.insert(i, snapshot.timestamp)
+
+    def append(self, key, image, timestamp=None):
+        """Store image, a DeviceImage, and return its Snapshot"""
+        if not self.writable:
+            raise IOError("Archive is opened read-only")
+        if timestamp is None:
+            timestamp = time.time()
+        encoded = key.encode('utf-8')
+        size = image.size()
+        with self._locked():
+            self._sync()
+            self._file.seek(self.end)
+            self._file.write(self.RECORD.pack(self.TAG, size, timestamp, len(encoded)))
+            self._file.write(encoded)
+            image.write(self._file)
+            self._file.flush()
+        snapshot = Snapshot(key, timestamp, self.end + self.RECORD.size + len(encoded), size)
+        self.end = snapshot.offset + size
+        self._add(snapshot)
+        return snapshot
+
+    def image(self, snapshot):
+        """DeviceImage of snapshot, its regions are views on the mapping"""
+        buffer = self._buffer()
+        return DeviceImage.unpack_from(buffer[snapshot.offset:snapshot.offset+snapshot.size])
+
+    def keys(self):
+        return list(self.index)
+
+    def snapshots(self, key=None):
+        """Snapshots of key, or of every key, in timestamp order"""
+        if key is not None:
+            return list(self.index.get(key, ()))
+        return sorted((s for snapshots in self.index.values() for s in snapshots),
+                key=lambda s: s.timestamp)
+
+    def latest(self, key, before=None):
+        """Last snapshot of key taken at or before the given timestamp"""
+        snapshots = self.index.get(key)
+        if not snapshots:
+            return None
+        if before is None:
+            return snapshots[-1]
+        i = bisect.bisect_right(self._timestamps[key], before)
+        return snapshots[i-1] if i else None
+
+    def __len__(self):
+        return sum(len(snapshots) for snapshots in self.index.values())
+
+    def __iter__(self):
+        return iter(self.snapshots())
+
+    def remapped(self, snapshots=None):
+        """
+        Return {key: [key indexes]} of the snapshots whose current mapping
+        table differs from the original one. Defaults to the latest snapshot
+        of every device.
+        """
+        if snapshots is None:
+            snapshots = [s[-1] for s in self.index.values()]
+        ret = {}
+        for snapshot in snapshots:
+            regions = self.image(snapshot).regions
+            original, current = regions.get(0x07), regions.get(0x08)
+            if original is None or current is None or original == current:
+                continue
+            ret[snapshot.key] = MappingTable(original).diff(MappingTable(current))
+        return ret
+
+    def close(self):
+        # The mapping itself is released with the last view on it
+        self._view = None
+        self._map = None
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect an ICL01 snapshot archive")
+    parser.add_argument('archive')
+    parser.add_argument('--remapped', action='store_true',
+            help="only list devices whose mapping differs from the original one")
+    args = parser.parse_args(argv)
+
+    with SnapshotArchive(args.archive, writable=False) as arc:
+        if args.remapped:
+            for key, keys in sorted(arc.remapped().items()):
+                print("{}: {} keys remapped ({})".format(key, len(keys), ", ".join(str(k) for k in keys)))
+            return 0
+        for s in arc:
+            print("{} {}: {} bytes".format(time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(s.timestamp)),
+                s.key, s.size))
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
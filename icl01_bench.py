@@ -0,0 +1,467 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Benchmarks of icl01: codecs, transfers and live colors.
+Transfers run against icl01_sim with a fixed latency so results are
+reproducible. Run with: python icl01_bench.py [--json results.json]
+"""
+
+import json
+import os
+import platform
+import socket
+import subprocess
+import sys
+import threading
+import time
+import timeit
+import tracemalloc
+
+import icl01
+import icl01_hidraw
+import icl01_sim
+from icl01 import (Action, ActionConsumer, ActionFn, ActionKey, ActionKeyRepeat,
+        ActionMacro, ActionMacroRepeat, ActionMouseClick, ActionMouseClickRepeat,
+        ActionMousePan, ActionMouseWheel, ActionSystem, Color, ColorFrame, DeviceImage,
+        FrameDiffer, ICL01Config, ICL01GlobalConfig, InvalidActionError, Macro,
+        MacroEntry, MacrosBlock, MappingTable)
+
+# Version of the JSON results layout
+RESULTS_VERSION = 2
+
+def bench(stmt, number):
+    """Return the best time of a call to stmt in seconds"""
+    return min(timeit.repeat(stmt, number=number, repeat=5)) / number
+
+def bench_fresh(fn, make, number):
+    """Return the best time of fn(arg) in seconds, each call getting a new make() argument"""
+    times = []
+    for i in range(5):
+        args = [make() for j in range(number)]
+        start = time.perf_counter()
+        for arg in args:
+            fn(arg)
+        times.append((time.perf_counter() - start) / number)
+    return min(times)
+
+def sample_table(size=126):
+    """A mapping table mixing every kind of action"""
+    actions = [
+        ActionKey(0, 0x04),
+        ActionKey(0x02, 0x1e),
+        ActionKey(0, 0x39, 0xb0),
+        ActionKeyRepeat(0x2c, 3),
+        ActionConsumer(0xe9),
+        ActionConsumer(0x223, 0x60),
+        ActionSystem(0x1),
+        ActionMouseClick(0x1),
+        ActionMousePan(-3, 2),
+        ActionMouseWheel(1),
+        ActionMacro(2, 1),
+        ActionMacroRepeat(1, 5),
+        ActionFn(0x01, 0),
+    ]
+    # Mostly plain keys like a real board
+    return [actions[i % len(actions)] if i % 4 == 0 else ActionKey(0, 0x04 + i % 0x60) for i in range(size)]
+
+def legacy_unpack_from(buffer, offset=0):
+    """Action decoder before the dispatch table"""
+    blk = buffer[offset:offset+3]
+    type_ = blk[0]
+    if type_ == 0x10:
+        return ActionMouseClick.unpack(blk)
+    elif type_ == 0x11:
+        return ActionMousePan.unpack(blk)
+    elif type_ == 0x12:
+        return ActionMouseWheel.unpack(blk)
+    elif type_ == 0x14:
+        return ActionMouseClickRepeat.unpack(blk)
+    elif type_ == 0x20:
+        return ActionKey.unpack(blk)
+    elif type_ == 0x21:
+        return ActionKeyRepeat.unpack(blk)
+    elif type_ == 0x30:
+        return ActionConsumer.unpack(blk)
+    elif type_ == 0x40:
+        return ActionSystem.unpack(blk)
+    elif type_ == 0x50:
+        return ActionConsumer.unpack(blk)
+    elif type_ == 0x60:
+        return ActionConsumer(0x223, 0x60)
+    elif type_ == 0x70:
+        return ActionMacro.unpack(blk)
+    elif type_ == 0x71:
+        return ActionMacroRepeat.unpack(blk)
+    elif type_ == 0xa0:
+        return ActionFn.unpack(blk)
+    elif type_ == 0xb0:
+        return ActionKey.unpack(blk)
+    else:
+        raise InvalidActionError("Invalid action type")
+
+def legacy_decode_table(data):
+    return [legacy_unpack_from(data, offset) for offset in range(0, len(data), 3)]
+
+def legacy_encode_table(actions):
+    data = bytearray(len(actions) * Action.size)
+    offset = 0
+    for action in actions:
+        action.pack_into(data, offset)
+        offset += Action.size
+    return data
+
+def bench_action_codec():
+    actions = sample_table()
+    data = Action.pack_table(actions)
+    assert(legacy_encode_table(actions) == data)
+    assert([a.pack() for a in Action.unpack_table(data)] == [a.pack() for a in legacy_decode_table(data)])
+
+    # Fresh actions have no packed value cached yet, both encoders pack them
+    # all (cold). Actions encoded before, like the decoded ones, are warm.
+    Action.pack_table(actions)
+    results = {
+        'decode_legacy': bench(lambda: legacy_decode_table(data), 200),
+        'decode': bench(lambda: Action.unpack_table(data), 200),
+        'encode_legacy': bench_fresh(legacy_encode_table, sample_table, 200),
+        'encode': bench_fresh(Action.pack_table, sample_table, 200),
+        'encode_warm': bench(lambda: Action.pack_table(actions), 200),
+    }
+    return results
+
+def allocated(build):
+    """Return the object built by build() and the bytes it allocated"""
+    tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        obj = build()
+        return obj, tracemalloc.get_traced_memory()[0] - before
+    finally:
+        tracemalloc.stop()
+
+def legacy_diff(old, new):
+    """Keys mapped differently in two lists of Action"""
+    return [i for i, (a, b) in enumerate(zip(old, new)) if a != b]
+
+def bench_mapping_table(edits=8):
+    """
+    Mapping tables kept as lists of Action against MappingTable: bytes
+    allocated to decode one, with the interned actions freed first, and
+    time to find the keys changed by edits edits
+    """
+    data = Action.pack_table(sample_table())
+    Action.INTERNED.clear()
+    old_list, list_bytes = allocated(lambda: Action.unpack_table(data))
+    old_table, table_bytes = allocated(lambda: MappingTable(data))
+
+    new_list = list(old_list)
+    new_table = MappingTable(bytearray(data))
+    step = len(new_list) // edits
+    for key in range(0, edits * step, step):
+        new_list[key] = new_table[key] = ActionKey(0x01, 0x2c)
+    assert(legacy_diff(old_list, new_list) == old_table.diff(new_table))
+    assert(len(new_table.dirty_ranges()) == edits)
+
+    return {
+        'memory_list': list_bytes,
+        'memory_table': table_bytes,
+        'diff_list': bench(lambda: legacy_diff(old_list, new_list), 2000),
+        'diff_table': bench(lambda: old_table.diff(new_table), 2000),
+        'dirty_ranges_table': bench(new_table.dirty_ranges, 2000),
+    }
+
+def sample_macros(count=8, length=24):
+    """A macros block typing count words of length / 2 letters"""
+    macros = MacrosBlock()
+    for m in range(count):
+        macro = Macro()
+        for i in range(length // 2):
+            key = ActionKey(0, 0x04 + (m + i) % 26)
+            macro.append(MacroEntry(10, True, key))
+            macro.append(MacroEntry(20, False, key))
+        macros.append(macro)
+    return macros
+
+def bench_codecs():
+    """Decoding and encoding of the structures read from and written to the device"""
+    macros = sample_macros()
+    macros_data = macros.pack()
+    macro_data = macros[0].pack()
+    config_data = bytearray(ICL01GlobalConfig.size)
+    for i in range(ICL01GlobalConfig.PROFILES_COUNT):
+        config_data[i*0x40+1:i*0x40+9] = bytes((6, 4, 2, 0, 0, 0xff, 0xff, 0xff))
+    config = ICL01GlobalConfig.unpack(config_data)
+    profile = config.profiles[0]
+    profile_data = profile.pack()
+
+    results = bench_action_codec()
+    results.update({
+        'macro_decode': bench(lambda: Macro.unpack(macro_data), 2000),
+        'macro_encode': bench(lambda: macros[0].pack(), 2000),
+        'macros_block_decode': bench(lambda: MacrosBlock.unpack(macros_data), 200),
+        'macros_block_encode': bench(lambda: macros.pack(), 200),
+        'config_decode': bench(lambda: ICL01Config.unpack(profile_data), 5000),
+        'config_encode': bench(lambda: profile.pack(), 5000),
+        'global_config_decode': bench(lambda: ICL01GlobalConfig.unpack(config_data), 2000),
+        'global_config_encode': bench(lambda: config.pack(), 2000),
+    })
+    return results
+
+def sim_device(latency, window, **kwargs):
+    """A fresh simulated keyboard and its ICL01Device"""
+    icl01_sim.clear()
+    icl01_sim.add_keyboard(latency=latency, **kwargs)
+    d, = icl01.enumerate_icl01(backend=icl01_sim, window=window)
+    return d
+
+def best(fn, repeat):
+    """Return the best time of fn() over repeat runs in seconds"""
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+# Full region transfers: read command and write command
+TRANSPORT_REGIONS = ((0x05, 0x06), (0x08, 0x09), (0x0a, 0x0b), (0x14, 0x15), (None, 0x12))
+
+def bench_transport(latency=0.001, window=1, repeat=3):
+    """Full region reads and writes, keyed by command"""
+    d = sim_device(latency, window)
+    caps = d.read_capabilities()
+    results = {}
+    for read_cmd, write_cmd in TRANSPORT_REGIONS:
+        if read_cmd is None:
+            # Live colors can only be written
+            size = caps.map_size * Color.size
+        else:
+            size = DeviceImage.region_size(read_cmd, caps)
+            out = bytearray(size)
+            results['read_0x{:02x}'.format(read_cmd)] = best(lambda: d.read(read_cmd, size, out=out), repeat)
+        data = bytes(i & 0xff for i in range(size))
+        # Configure mode is entered once, its round trips aren't measured
+        if write_cmd != 0x12:
+            d.begin_configure()
+        results['write_0x{:02x}'.format(write_cmd)] = best(lambda: d.write(write_cmd, data), repeat)
+        if write_cmd != 0x12:
+            d.end_configure()
+        else:
+            d.cancel_computer_colors()
+    return results
+
+def bench_live_colors(latency=0.001, window=1, frames=100):
+    """Seconds per frame of a moving dot, sent in full and through a FrameDiffer"""
+    d = sim_device(latency, window)
+    size = d.read_capabilities().map_size
+    frame = ColorFrame.filled(size, Color(0, 0, 0x40))
+    frame[0] = Color(0xff, 0, 0)
+
+    def full():
+        for i in range(frames):
+            d.write_computer_colors(frame.roll(i))
+
+    differ = FrameDiffer(d)
+    def diff():
+        differ.reset()
+        for i in range(frames):
+            differ.push(frame.roll(i))
+
+    results = {
+        'frame_full': best(full, 3) / frames,
+        'frame_diff': best(diff, 3) / frames,
+    }
+    d.cancel_computer_colors()
+    return results
+
+def bench_lost_replies(latency=0.002, drop_rate=.1, seed=1):
+    """
+    Seconds to read the custom colors with retries while drop_rate of the
+    replies are lost: with the fixed 1 s timeout, with fresh latency models
+    (flat 1 s or seeded warm-up timeouts) and with a model already warmed up
+    """
+    warm = icl01.LatencyModel()
+    d = sim_device(latency, 1)
+    d.latency_model = warm
+    size = DeviceImage.region_size(0x0a, None)
+    d.read(0x0a, size)
+    d.close()
+
+    models = (('fixed', None), ('fresh_flat', icl01.LatencyModel(seeds={})),
+            ('fresh_seeded', icl01.LatencyModel()), ('warm', warm))
+    results = {}
+    for name, model in models:
+        d = sim_device(latency, 1, drop_rate=drop_rate, seed=seed)
+        d.retry = icl01.RetryPolicy()
+        d.latency_model = model
+        start = time.perf_counter()
+        d.read(0x0a, size)
+        results[name] = time.perf_counter() - start
+        d.close()
+    return results
+
+class SocketHidraw:
+    """
+    Backend opening icl01_hidraw devices on a socketpair instead of a
+    hidraw node. A thread answers on the other end with the simulated firmware.
+    """
+    def __init__(self):
+        self.firmware = icl01_sim.SimulatedICL01()
+        self.local, self.remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        threading.Thread(target=self._serve, daemon=True).start()
+
+    def _serve(self):
+        while True:
+            request = self.remote.recv(icl01_sim.REPORT_SIZE)
+            if not request:
+                return
+            if request[0] == 4:
+                self.remote.send(self.firmware.process(request))
+
+    def device(self):
+        return icl01_hidraw.HidrawDevice(lambda path: os.dup(self.local.fileno()))
+
+    def close(self):
+        self.local.close()
+
+def bench_backends(number=2000):
+    """Seconds per query of the backends without any latency of their own"""
+    def query_time(d):
+        d.read_capabilities()
+        return bench(lambda: d.query(0x03, 0, 8), number)
+
+    results = {'sim': query_time(sim_device(0., 1))}
+    backend = SocketHidraw()
+    results['hidraw_socketpair'] = query_time(icl01.ICL01Device([b'', b''], backend=backend))
+    backend.close()
+
+    # hidapi against hidraw needs a keyboard: measured when one is plugged
+    try:
+        import hid
+    except ImportError:
+        hid = None
+    for name, module in (('hidapi', hid), ('hidraw', icl01_hidraw)):
+        if module is None:
+            continue
+        devices = list(icl01.enumerate_icl01(backend=module))
+        try:
+            if devices:
+                results[name] = query_time(devices[0])
+        except OSError:
+            # No access to the hidraw nodes
+            pass
+        finally:
+            for d in devices:
+                d.close()
+    return results
+
+IMPORT_PROBE = """
+import json, sys, time
+start = time.perf_counter()
+import icl01
+elapsed = time.perf_counter() - start
+print(json.dumps({'elapsed': elapsed, 'loaded': [m for m in ('hid', 'hut', 'asyncio', 'numpy') if m in sys.modules]}))
+"""
+
+def bench_import(repeat=5):
+    """Import icl01 in fresh interpreters and check it loads nothing optional"""
+    here = os.path.dirname(os.path.abspath(__file__))
+    runs = []
+    for i in range(repeat):
+        out = subprocess.run([sys.executable, '-c', IMPORT_PROBE], cwd=here,
+                check=True, capture_output=True, text=True).stdout
+        runs.append(json.loads(out))
+    return {
+        'import': min(r['elapsed'] for r in runs),
+        'loaded': sorted(set(m for r in runs for m in r['loaded'])),
+    }
+
+def git_revision():
+    here = os.path.dirname(os.path.abspath(__file__))
+    try:
+        return subprocess.run(['git', 'describe', '--always', '--dirty'], cwd=here,
+                check=True, capture_output=True, text=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_suite(latency=0.001, windows=(1, 8), repeat=3):
+    """
+    Run every benchmark and return the JSON serializable results.
+    Times are in seconds, lower is better.
+    """
+    results = {
+        'version': RESULTS_VERSION,
+        'revision': git_revision(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'latency': latency,
+        'import': bench_import(),
+        'codecs': bench_codecs(),
+        'mapping_table': bench_mapping_table(),
+        'backends': bench_backends(),
+        'transport': {},
+        'live_colors': {},
+        'lost_replies': bench_lost_replies(),
+    }
+    for window in windows:
+        results['transport'][str(window)] = bench_transport(latency, window, repeat)
+        results['live_colors'][str(window)] = bench_live_colors(latency, window)
+    icl01_sim.clear()
+    return results
+
+def report(results):
+    print("Import: {:.1f} ms, optional modules loaded: {}".format(results['import']['import'] * 1e3,
+        ", ".join(results['import']['loaded']) or "none"))
+
+    codecs = results['codecs']
+    print("Full mapping table ({} keys)".format(len(sample_table())))
+    for op, name, legacy in (('decode', 'decode', 'decode_legacy'), ('encode', 'encode cold', 'encode_legacy'),
+            ('encode_warm', 'encode warm', 'encode_legacy')):
+        old, new = codecs[legacy], codecs[op]
+        print("    {}: {:.1f} us -> {:.1f} us ({:.2f}x)".format(name, old * 1e6, new * 1e6, old / new))
+    table = results['mapping_table']
+    print("    memory: list {} bytes, MappingTable {} bytes".format(table['memory_list'], table['memory_table']))
+    print("    changed keys: list {:.1f} us, MappingTable diff {:.1f} us, dirty ranges {:.1f} us".format(
+        table['diff_list'] * 1e6, table['diff_table'] * 1e6, table['dirty_ranges_table'] * 1e6))
+    print("Codecs")
+    for name in sorted(codecs):
+        if not name.startswith(('decode', 'encode')):
+            print("    {}: {:.1f} us".format(name, codecs[name] * 1e6))
+
+    print("Query overhead: {}".format(", ".join("{} {:.1f} us".format(name, t * 1e6)
+        for name, t in sorted(results['backends'].items()))))
+
+    print("Transfers with {:.1f} ms latency".format(results['latency'] * 1e3))
+    for window, transport in sorted(results['transport'].items(), key=lambda i: int(i[0])):
+        print("    window {}: {}".format(window, ", ".join("{} {:.1f} ms".format(name, t * 1e3)
+            for name, t in sorted(transport.items()))))
+    print("Live colors frames")
+    for window, frames in sorted(results['live_colors'].items(), key=lambda i: int(i[0])):
+        print("    window {}: full {:.0f} FPS, diff {:.0f} FPS".format(window,
+            1. / frames['frame_full'], 1. / frames['frame_diff']))
+    print("Custom colors read with 10% of replies lost: {}".format(", ".join("{} {:.2f} s".format(name, t)
+        for name, t in sorted(results['lost_replies'].items()))))
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Benchmark icl01")
+    parser.add_argument('--json', metavar='FILE', help="write the results as JSON to FILE (- for stdout)")
+    parser.add_argument('--latency', type=float, default=1., help="simulated reply latency in ms (default: 1)")
+    parser.add_argument('--window', type=int, action='append',
+            help="transfer window to benchmark, may be repeated (default: 1 and 8)")
+    parser.add_argument('--repeat', type=int, default=3, help="runs of each transfer, the best is kept")
+    args = parser.parse_args(argv)
+
+    results = run_suite(args.latency / 1000., tuple(args.window or (1, 8)), args.repeat)
+    if args.json == '-':
+        json.dump(results, sys.stdout, indent=2, sort_keys=True)
+        print()
+        return 0
+    report(results)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(results, f, indent=2, sort_keys=True)
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
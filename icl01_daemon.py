@@ -0,0 +1,426 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+A daemon owning the ICL01 keyboards, serving them on a local Unix socket.
+Devices stay opened with their capabilities known so requests take a round
+trip to the keyboard, and requests on a keyboard are serialized so clients
+can't mix their configure sessions.
+
+    python icl01_daemon.py &
+
+    with icl01_daemon.Client() as c:
+        key = c.devices()[0]['key']
+        table = c.read_mapping(key)
+        frames = c.frames(key)
+        frames.push(colors)
+
+Messages in both directions are a header (JSON size and payload size, u32
+little endian), a JSON object and a raw payload carrying regions or colors.
+Live colors frames go through a shared memory channel: the client writes
+them in place and only a notification goes through the socket.
+"""
+
+import json
+import mmap
+import os
+import socket
+import socketserver
+import struct
+import sys
+import tempfile
+import threading
+
+import icl01
+import icl01_registry
+from icl01 import DeviceImage, FrameDiffer, ICL01GlobalConfig, MacrosBlock, MappingTable
+
+HDR = struct.Struct('<II')
+# Largest JSON object and payload accepted, a device image is below 64 KiB
+JSON_MAX = 1 << 16
+PAYLOAD_MAX = 1 << 20
+
+# Regions by name: read command
+REGIONS = {
+    'capabilities': 0x03,
+    'config': 0x05,
+    'original_mapping': 0x07,
+    'mapping': 0x08,
+    'custom_colors': 0x0a,
+    'macros': 0x14,
+    'physical_map': 0x1b,
+}
+
+def default_socket():
+    runtime = os.environ.get('XDG_RUNTIME_DIR')
+    if runtime:
+        return os.path.join(runtime, 'icl01.sock')
+    return os.path.join(tempfile.gettempdir(), 'icl01-{}.sock'.format(os.getuid()))
+
+class DaemonError(Exception):
+    pass
+
+def _recv_exact(sock, size, fds=None):
+    """Receive size bytes, file descriptors sent along are appended to fds"""
+    buffer = bytearray(size)
+    view = memoryview(buffer)
+    pos = 0
+    while pos < size:
+        if fds is not None and pos == 0:
+            data, received, flags, addr = socket.recv_fds(sock, size, 1)
+            fds.extend(received)
+            if not data:
+                raise EOFError("Connection closed")
+            view[:len(data)] = data
+            pos = len(data)
+            continue
+        n = sock.recv_into(view[pos:])
+        if not n:
+            raise EOFError("Connection closed")
+        pos += n
+    return buffer
+
+def _recv_message(sock, fds=None):
+    jsize, psize = HDR.unpack(_recv_exact(sock, HDR.size, fds))
+    # Checked before allocating, the connection can't be used anymore
+    if jsize > JSON_MAX or psize > PAYLOAD_MAX:
+        raise DaemonError("Message too large ({} + {} bytes)".format(jsize, psize))
+    message = json.loads(_recv_exact(sock, jsize)) if jsize else {}
+    payload = _recv_exact(sock, psize) if psize else b''
+    return message, payload
+
+def _send_message(sock, message, payload=b'', fds=None):
+    data = json.dumps(message).encode()
+    header = HDR.pack(len(data), len(payload)) + data
+    if fds:
+        socket.send_fds(sock, [header], fds)
+    else:
+        sock.sendall(header)
+    if payload:
+        sock.sendall(payload)
+
+class FrameChannel:
+    """
+    Shared memory of a live colors channel: slots frames of slot_size bytes.
+    The client fills a slot then asks the daemon to send it.
+    """
+    def __init__(self, slot_size, slots=2, fd=None):
+        self.slot_size = slot_size
+        self.slots = slots
+        if fd is None:
+            if hasattr(os, 'memfd_create'):
+                fd = os.memfd_create('icl01-frames')
+            else:
+                f = tempfile.TemporaryFile()
+                fd = os.dup(f.fileno())
+                f.close()
+            os.ftruncate(fd, slot_size * slots)
+        self.fd = fd
+        self.map = mmap.mmap(fd, slot_size * slots)
+        self.view = memoryview(self.map)
+
+    def slot(self, index):
+        return self.view[index*self.slot_size:(index+1)*self.slot_size]
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # Unmapped with the last slot view still held
+            pass
+        os.close(self.fd)
+
+class Handler(socketserver.BaseRequestHandler):
+    """Requests of a client connection, answered one after the other"""
+
+    def setup(self):
+        self.channels = {}
+
+    def handle(self):
+        sock = self.request
+        while True:
+            try:
+                message, payload = _recv_message(sock)
+            except (EOFError, ConnectionError, DaemonError, ValueError):
+                # Closed, or out of sync after a malformed message
+                return
+            fds = None
+            try:
+                # Valid JSON, the connection is still in sync
+                if not isinstance(message, dict) or not isinstance(message.get('args', {}), dict):
+                    raise DaemonError("Messages must be JSON objects with object args")
+                method = getattr(self, 'do_' + message.get('method', ''), None)
+                if method is None:
+                    raise DaemonError("Unknown method {!r}".format(message.get('method')))
+                result = method(payload, **message.get('args', {}))
+                reply = {'result': result}
+                out = b''
+                if isinstance(result, tuple):
+                    result, out, fds = result
+                    reply['result'] = result
+            except Exception as e:
+                reply = {'error': "{}: {}".format(e.__class__.__name__, e)}
+                out = b''
+            _send_message(sock, reply, out, fds)
+
+    def finish(self):
+        for channel in self.channels.values():
+            channel[0].close()
+
+    def use(self, device):
+        return self.server.registry.pool.use(self.server.find(device))
+
+    def do_devices(self, payload):
+        return [{
+            'key': self.server.registry.device_key(d),
+            'serial': d.serial,
+            'location': d.location,
+            'paths': [p.decode('utf-8', 'replace') if isinstance(p, bytes) else str(p) for p in d.paths],
+        } for d in self.server.registry.devices.values()]
+
+    def do_read(self, payload, device=None, region='config'):
+        cmd = REGIONS[region]
+        with self.use(device) as d:
+            caps = d.read_capabilities()
+            data = d.read(cmd, DeviceImage.region_size(cmd, caps))
+        return None, data, None
+
+    def do_write(self, payload, device=None, region='config', dry_run=False):
+        if REGIONS[region] not in DeviceImage.WRITABLE:
+            raise DaemonError("Region {} can't be written".format(region))
+        with self.use(device) as d:
+            plan = d.apply_regions({REGIONS[region]: payload}, dry_run)
+        return {'transactions': len(plan), 'bytes': plan.bytes}
+
+    def do_dump(self, payload, device=None):
+        with self.use(device) as d:
+            image = d.dump_image()
+        return None, image.pack(), None
+
+    def do_restore(self, payload, device=None, dry_run=False):
+        image = DeviceImage.unpack(payload)
+        with self.use(device) as d:
+            plan = d.restore_image(image, dry_run)
+        return {'transactions': len(plan), 'bytes': plan.bytes}
+
+    def do_colors(self, payload, device=None, start=0):
+        if len(payload) % icl01.Color.size:
+            raise DaemonError("{} bytes of colors aren't RGB triplets".format(len(payload)))
+        count = len(payload) // icl01.Color.size
+        with self.use(device) as d:
+            keys = d.read_capabilities().map_size
+            if start < 0 or start + count > keys:
+                raise DaemonError("{} colors from key {} don't fit in {} keys".format(count, start, keys))
+            d.write_computer_colors(icl01.ColorFrame(payload), start)
+
+    def do_cancel_colors(self, payload, device=None):
+        with self.use(device) as d:
+            d.cancel_computer_colors()
+
+    def do_reboot(self, payload, device=None, timeout=10.):
+        # Key of the keyboard once back, None if it didn't re-enumerate in time
+        registry = self.server.registry
+        d = self.server.find(device)
+        key = registry.device_key(d)
+        after = registry.generation(key)
+        with registry.pool.use(d):
+            d.reboot()
+        # Not waited under the device lock: the registry closes the old device
+        return None if registry.wait_for(key, timeout, after) is None else key
+
+    def do_frames(self, payload, device=None, diff=True, slots=2):
+        d = self.server.find(device)
+        with self.server.registry.pool.use(d):
+            size = d.read_capabilities().map_size * icl01.Color.size
+        channel = FrameChannel(size, slots)
+        index = len(self.channels)
+        self.channels[index] = (channel, d, FrameDiffer(d) if diff else None)
+        return {'channel': index, 'slot_size': size, 'slots': slots}, b'', [channel.fd]
+
+    def do_frame(self, payload, channel=0, slot=0):
+        channel, d, differ = self.channels[channel]
+        frame = channel.slot(slot)
+        with self.server.registry.pool.use(d):
+            if differ is not None:
+                return differ.push(frame)
+            d.write(0x12, frame)
+            return len(frame)
+
+    def do_close_frames(self, payload, channel=0):
+        self.channels.pop(channel)[0].close()
+
+class Server(socketserver.ThreadingUnixStreamServer):
+    daemon_threads = True
+
+    def __init__(self, path, registry):
+        self.registry = registry
+        if os.path.exists(path):
+            os.unlink(path)
+        # Only the user running the daemon may connect
+        umask = os.umask(0o177)
+        try:
+            super().__init__(path, Handler)
+        finally:
+            os.umask(umask)
+
+    def find(self, key):
+        """Device of key, the only keyboard when key is None"""
+        if key is None:
+            devices = list(self.registry.devices.values())
+            if len(devices) != 1:
+                raise DaemonError("{} keyboards connected, one must be chosen".format(len(devices)))
+            return devices[0]
+        d = self.registry.get(key)
+        if d is None:
+            raise KeyError(key)
+        return d
+
+    def server_close(self):
+        super().server_close()
+        try:
+            os.unlink(self.server_address)
+        except OSError:
+            pass
+
+class Frames:
+    """Client side of a frame channel, slots are used in turn"""
+
+    def __init__(self, client, info, fd):
+        self.client = client
+        self.index = info['channel']
+        self.channel = FrameChannel(info['slot_size'], info['slots'], fd)
+        self.next = 0
+
+    def buffer(self):
+        """Slot to fill with the next frame, packed RGB colors"""
+        return self.channel.slot(self.next)
+
+    def send(self):
+        """Send the frame written in buffer() and return the bytes sent to the keyboard"""
+        sent = self.client.call('frame', channel=self.index, slot=self.next)[0]
+        self.next = (self.next + 1) % self.channel.slots
+        return sent
+
+    def push(self, colors):
+        """Copy colors (a ColorFrame, bytes-like object or list of Color) in the next slot and send it"""
+        data = icl01._pack_colors(colors)
+        self.buffer()[:len(data)] = data
+        return self.send()
+
+    def close(self):
+        self.client.call('close_frames', channel=self.index)
+        self.channel.close()
+
+class Client:
+    def __init__(self, path=None):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(path or default_socket())
+        self._lock = threading.Lock()
+
+    def call(self, method, payload=b'', fds=None, **args):
+        """Return the result and payload of method"""
+        with self._lock:
+            _send_message(self.sock, {'method': method, 'args': args}, payload)
+            reply, out = _recv_message(self.sock, fds)
+        if 'error' in reply:
+            raise DaemonError(reply['error'])
+        return reply['result'], out
+
+    def devices(self):
+        return self.call('devices')[0]
+
+    def read_region(self, region, device=None):
+        return self.call('read', device=device, region=region)[1]
+
+    def write_region(self, region, data, device=None, dry_run=False):
+        return self.call('write', bytes(data), device=device, region=region, dry_run=dry_run)[0]
+
+    def read_global_config(self, device=None):
+        return ICL01GlobalConfig.unpack(self.read_region('config', device))
+
+    def write_global_config(self, config, device=None):
+        return self.write_region('config', config.pack(), device)
+
+    def read_mapping(self, device=None):
+        return MappingTable(self.read_region('mapping', device))
+
+    def write_mapping(self, table, device=None):
+        if not isinstance(table, MappingTable):
+            table = MappingTable.from_actions(table)
+        return self.write_region('mapping', table.data, device)
+
+    def read_macros(self, device=None):
+        return MacrosBlock.unpack(self.read_region('macros', device))
+
+    def write_macros(self, macros, device=None):
+        return self.write_region('macros', macros.pack(), device)
+
+    def dump(self, device=None):
+        return DeviceImage.unpack(self.call('dump', device=device)[1])
+
+    def restore(self, image, device=None, dry_run=False):
+        return self.call('restore', image.pack(), device=device, dry_run=dry_run)[0]
+
+    def write_computer_colors(self, colors, device=None, start=0):
+        self.call('colors', bytes(icl01._pack_colors(colors)), device=device, start=start)
+
+    def cancel_computer_colors(self, device=None):
+        self.call('cancel_colors', device=device)
+
+    def reboot(self, device=None, timeout=10.):
+        """Key of the keyboard once back, None if it didn't re-enumerate within timeout"""
+        return self.call('reboot', device=device, timeout=timeout)[0]
+
+    def frames(self, device=None, diff=True):
+        """Open a shared memory channel for live colors frames"""
+        fds = []
+        info = self.call('frames', fds=fds, device=device, diff=diff)[0]
+        if not fds:
+            raise DaemonError("No shared memory received")
+        return Frames(self, info, fds[0])
+
+    def close(self):
+        self.sock.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def main(argv=None):
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Serve the ICL01 keyboards on a local socket")
+    parser.add_argument('--socket', default=default_socket(), help="socket path (default: %(default)s)")
+    parser.add_argument('--window', type=int, default=8, help="requests kept in flight")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument('--sim', action='store_true', help="use a simulated keyboard")
+    group.add_argument('--hidraw', action='store_true', help="talk to /dev/hidraw* directly instead of using hidapi")
+    parser.add_argument('--retry', action='store_true', help="retry failed requests and recover hung keyboards")
+    args = parser.parse_args(argv)
+
+    backend = None
+    if args.sim:
+        import icl01_sim
+        # Re-enumerates after a reboot like a real keyboard
+        icl01_sim.add_keyboard(reboot_time=.5)
+        backend = icl01_sim
+    elif args.hidraw:
+        import icl01_hidraw
+        backend = icl01_hidraw
+
+    with icl01_registry.DeviceRegistry(backend=backend, window=args.window,
+            retry=True if args.retry else None, latency_model=True) as registry:
+        server = Server(args.socket, registry)
+        print("Serving {} keyboards on {}".format(len(registry.devices), args.socket), file=sys.stderr)
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+    return 0
+
+if __name__ == '__main__':
+    raise SystemExit(main())
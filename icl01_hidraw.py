@@ -0,0 +1,204 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+A pure Python Linux backend talking to /dev/hidrawN directly.
+This module mimics the hid module API (enumerate() and device()) so it can be
+used as a drop-in backend for icl01 on hosts without hidapi:
+
+    for d in icl01.enumerate_icl01(backend=icl01_hidraw):
+        ...
+
+Reports go through os.read() and os.write() on the device node without any
+thread, readiness is waited on with poll() and feature reports are sent with
+the HIDIOCSFEATURE ioctl.
+"""
+
+import fcntl
+import os
+import select
+import socket
+import threading
+
+SYSFS_HIDRAW = '/sys/class/hidraw'
+REPORT_SIZE = 64
+NETLINK_KOBJECT_UEVENT = 15
+
+def _ioc(direction, type_, nr, size):
+    return (direction << 30) | (size << 16) | (ord(type_) << 8) | nr
+
+_IOC_WRITE = 1
+_IOC_READ = 2
+
+def HIDIOCSFEATURE(size):
+    return _ioc(_IOC_WRITE | _IOC_READ, 'H', 0x06, size)
+
+def _uevent(sysfs, name):
+    """HID properties of a hidraw node from its parent uevent file"""
+    props = {}
+    try:
+        with open(os.path.join(sysfs, name, 'device', 'uevent')) as f:
+            for line in f:
+                key, _, value = line.rstrip('\n').partition('=')
+                props[key] = value
+    except OSError:
+        pass
+    return props
+
+def _interface_number(phys):
+    # HID_PHYS looks like usb-0000:00:14.0-1/input1
+    _, _, intf = phys.rpartition('/input')
+    return int(intf) if intf.isdigit() else -1
+
+def enumerate(vendor_id=0, product_id=0, sysfs=SYSFS_HIDRAW):
+    """Like hid.enumerate(), from the hidraw nodes listed in sysfs"""
+    try:
+        names = os.listdir(sysfs)
+    except OSError:
+        return []
+    ret = []
+    for name in names:
+        props = _uevent(sysfs, name)
+        try:
+            # HID_ID is bus:vendor:product in hex
+            bus, vid, pid = (int(v, 16) for v in props['HID_ID'].split(':'))
+        except (KeyError, ValueError):
+            continue
+        if vendor_id not in (0, vid) or product_id not in (0, pid):
+            continue
+        phys = props.get('HID_PHYS', '')
+        ret.append({
+            'path': os.path.join('/dev', name).encode(),
+            'vendor_id': vid,
+            'product_id': pid,
+            'serial_number': props.get('HID_UNIQ', ''),
+            'product_string': props.get('HID_NAME', ''),
+            'interface_number': _interface_number(phys),
+            # Interfaces of a keyboard share their physical path
+            'usb_path': phys.rpartition('/')[0],
+        })
+    # Keyboards one after the other, interface 0 first
+    ret.sort(key=lambda d: (d['usb_path'], d['interface_number']))
+    return ret
+
+def parse_uevent(message):
+    """
+    Return (action, path) of a kernel uevent adding or removing a hidraw
+    node, None for any other event
+    """
+    # action@devpath then KEY=VALUE fields, all NUL terminated
+    fields = message.split(b'\0')
+    props = dict(f.decode('utf-8', 'replace').partition('=')[::2] for f in fields[1:] if b'=' in f)
+    if props.get('SUBSYSTEM') != 'hidraw' or props.get('ACTION') not in ('add', 'remove'):
+        return None
+    if not props.get('DEVNAME'):
+        return None
+    return props['ACTION'], os.path.join('/dev', props['DEVNAME']).encode()
+
+class UeventMonitor(threading.Thread):
+    """
+    Thread listening to the kernel uevents of hidraw nodes and calling
+    callback(action, path) for each of them, action being 'add' or 'remove'.
+    """
+    def __init__(self, callback):
+        super().__init__(name='icl01-uevents', daemon=True)
+        self.callback = callback
+        self.sock = socket.socket(socket.AF_NETLINK, socket.SOCK_DGRAM | socket.SOCK_CLOEXEC,
+                NETLINK_KOBJECT_UEVENT)
+        # Group 1 carries the kernel events
+        self.sock.bind((0, 1))
+        self._wakeup = os.pipe()
+
+    def run(self):
+        try:
+            while True:
+                ready, _, _ = select.select((self.sock, self._wakeup[0]), (), ())
+                if self._wakeup[0] in ready:
+                    return
+                self._dispatch(self.sock.recv(8192))
+        finally:
+            self.sock.close()
+            for fd in self._wakeup:
+                os.close(fd)
+
+    def _dispatch(self, message):
+        event = parse_uevent(message)
+        if event is not None:
+            self.callback(*event)
+
+    def stop(self):
+        os.write(self._wakeup[1], b'\0')
+
+def watch(callback):
+    """
+    Call callback(action, path) when a hidraw node is added or removed.
+    Returns a function stopping the watch.
+    """
+    monitor = UeventMonitor(callback)
+    monitor.start()
+    return monitor.stop
+
+def _open(path):
+    return os.open(path, os.O_RDWR | os.O_CLOEXEC)
+
+class HidrawDevice:
+    """
+    Implements the subset of hid.device used by icl01.
+    opener(path) returns the file descriptor of an opened node, os.open() by
+    default. Any descriptor carrying a report per read and write, like a
+    SOCK_SEQPACKET socket, can stand for a hidraw node.
+    """
+
+    def __init__(self, opener=None):
+        self.opener = _open if opener is None else opener
+        self.fd = None
+        self._poll = select.poll()
+        # Replies are read in this buffer, copied out once
+        self._buffer = bytearray(REPORT_SIZE)
+        self._view = memoryview(self._buffer)
+
+    def open_path(self, path):
+        fd = self.opener(path)
+        # Non blocking so a spurious wakeup never blocks read()
+        os.set_blocking(fd, False)
+        self.fd = fd
+        self._poll.register(fd, select.POLLIN)
+
+    def close(self):
+        if self.fd is not None:
+            self._poll.unregister(self.fd)
+            os.close(self.fd)
+            self.fd = None
+
+    def _fd(self):
+        if self.fd is None:
+            raise IOError("Device is not opened")
+        return self.fd
+
+    def write(self, data):
+        # First byte is the report ID, like hidapi
+        fd = self._fd()
+        try:
+            return os.write(fd, data)
+        except BlockingIOError:
+            select.select((), (fd, ), ())
+            return os.write(fd, data)
+
+    def read(self, max_length, timeout_ms=0):
+        """Read a report, waiting timeout_ms at most (forever if not positive)"""
+        fd = self._fd()
+        if not self._poll.poll(timeout_ms if timeout_ms > 0 else None):
+            return b''
+        try:
+            size = os.readv(fd, (self._view[:max_length], ))
+        except BlockingIOError:
+            # Spurious wakeup, seen as a timeout
+            return b''
+        return bytes(self._view[:size])
+
+    def send_feature_report(self, data):
+        buffer = bytearray(data)
+        fcntl.ioctl(self._fd(), HIDIOCSFEATURE(len(buffer)), buffer)
+        return len(buffer)
+
+def device(opener=None):
+    return HidrawDevice(opener)
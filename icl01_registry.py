@@ -0,0 +1,365 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Sharing of ICL01 devices by long running processes.
+A DevicePool keeps the interfaces of the keyboards open across
+enumerations, a DeviceRegistry follows the keyboards as they come and go.
+
+    with icl01_registry.DeviceRegistry(window=8) as registry:
+        d = registry.wait_for(location, timeout=5)
+        d = registry.reboot(d)
+"""
+
+import collections
+import sys
+import threading
+import time
+
+from icl01 import ICL01Device, _enumerate_interfaces
+
+def _matches(device, key):
+    """Whether key is device or its serial number, one of its paths or its location"""
+    return key is device or key == device.key or key in device.paths or (
+            device.location is not None and key == device.location)
+
+class _DeviceLease:
+    __slots__ = ('device', 'lock')
+
+    def __init__(self, device, lock):
+        self.device = device
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquire()
+        return self.device
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.lock.release()
+
+class DevicePool:
+    """
+    Devices and interface handles shared by the threads of a long running
+    process. Each interface path is opened once, handles are reference
+    counted and stay open while idle so later operations don't pay the open
+    cost again. enumerate() keeps the ICL01Device of keyboards still
+    connected, with their state (capabilities, latency model, shadow...),
+    and closes the ones of keyboards which are gone.
+    kwargs are given to the ICL01Device created.
+    """
+    def __init__(self, backend=None, **kwargs):
+        if backend is None:
+            import hid as backend
+        self.backend = backend
+        self.kwargs = kwargs
+        # Handle and users count by path
+        self._handles = {}
+        # ICL01Device and the lock giving exclusive use of it by key
+        self._devices = {}
+        self._lock = threading.Lock()
+
+    def acquire(self, path):
+        """Return the handle of path, opened on first use"""
+        with self._lock:
+            entry = self._handles.get(path)
+            if entry is None:
+                d = self.backend.device()
+                d.open_path(path)
+                entry = self._handles[path] = [d, 0]
+            entry[1] += 1
+            return entry[0]
+
+    def release(self, path, discard=False):
+        """
+        Give back the handle of path. It stays open for the next user unless
+        discard is set, for instance once the device rebooted.
+        """
+        with self._lock:
+            entry = self._handles.get(path)
+            if entry is None:
+                return
+            entry[1] -= 1
+            if discard:
+                del self._handles[path]
+                entry[0].close()
+
+    def enumerate(self, stale=()):
+        """
+        Return the ICL01Device of the connected keyboards.
+        Devices with a path in stale, known to have been unplugged since,
+        are replaced even if the same paths came back.
+        """
+        found = {}
+        for interfaces, serial, location in _enumerate_interfaces(self.backend):
+            found[tuple(interfaces)] = (serial, location)
+
+        with self._lock:
+            gone = [key for key in self._devices if key not in found or any(p in stale for p in key)]
+            entries = [self._devices.pop(key) for key in gone]
+            for interfaces, (serial, location) in found.items():
+                if interfaces not in self._devices:
+                    d = ICL01Device(list(interfaces), serial=serial, location=location,
+                            backend=self.backend, pool=self, **self.kwargs)
+                    self._devices[interfaces] = (d, threading.RLock())
+            devices = [d for d, lock in self._devices.values()]
+
+        for d, lock in entries:
+            with lock:
+                d.close()
+            self._discard(d.paths)
+        return devices
+
+    def _discard(self, paths):
+        # Handles of vanished keyboards are closed even if still referenced
+        with self._lock:
+            for path in paths:
+                entry = self._handles.pop(path, None)
+                if entry is not None:
+                    entry[0].close()
+
+    def get(self, key):
+        """ICL01Device of the keyboard with the given serial number, path or location"""
+        with self._lock:
+            for d, lock in self._devices.values():
+                if _matches(d, key):
+                    return d
+        return None
+
+    def use(self, key):
+        """
+        Context giving exclusive use of the ICL01Device of key among the
+        threads using the pool. Raises KeyError when it's not connected.
+        """
+        with self._lock:
+            entry = next(((d, lock) for d, lock in self._devices.values() if _matches(d, key)), None)
+        if entry is None:
+            raise KeyError(key)
+        return _DeviceLease(*entry)
+
+    @property
+    def devices(self):
+        with self._lock:
+            return [d for d, lock in self._devices.values()]
+
+    def close(self):
+        """Close every device and handle"""
+        with self._lock:
+            entries = list(self._devices.values())
+            self._devices.clear()
+        for d, lock in entries:
+            with lock:
+                d.close()
+        with self._lock:
+            handles = list(self._handles.values())
+            self._handles.clear()
+        for d, count in handles:
+            d.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+def _resolve(future, device):
+    if not future.done():
+        future.set_result(device)
+
+class DeviceRegistry:
+    """
+    Map of the connected keyboards kept up to date as they come and go.
+    Keyboards are keyed by their physical USB path, else by serial number or
+    path. Plug and unplug events come from the backend watch() function, or
+    from kernel uevents on Linux, else the keyboards are enumerated every
+    poll seconds. Devices are handed by a DevicePool, given or created
+    with kwargs.
+    Subscribers are called with ('add' or 'remove', key, device) from the
+    registry thread.
+    """
+    def __init__(self, backend=None, pool=None, poll=2., **kwargs):
+        self.pool = DevicePool(backend, **kwargs) if pool is None else pool
+        self._own_pool = pool is None
+        self.poll = poll
+        self.devices = {}
+        # Arrivals count by key, to wait for a keyboard coming back
+        self.generations = collections.Counter()
+        self._cond = threading.Condition()
+        self._changed = threading.Event()
+        # Paths removed since the last scan
+        self._removed = set()
+        # arrival() futures: (key, after, loop, future)
+        self._waiters = []
+        self._subscribers = []
+        self._unwatch = None
+        self._thread = None
+        self._stopping = False
+
+    @staticmethod
+    def device_key(device):
+        return device.location if device.location is not None else device.key
+
+    def subscribe(self, callback):
+        self._subscribers.append(callback)
+
+    def unsubscribe(self, callback):
+        self._subscribers.remove(callback)
+
+    def _watch(self):
+        backend = self.pool.backend
+        watch = getattr(backend, 'watch', None)
+        if watch is None and sys.platform.startswith('linux'):
+            import icl01_hidraw
+            watch = icl01_hidraw.watch
+        if watch is None:
+            return None
+        try:
+            return watch(self._event)
+        except OSError:
+            return None
+
+    def _event(self, action, path):
+        if action == 'remove':
+            with self._cond:
+                self._removed.add(path)
+        self._changed.set()
+
+    def start(self):
+        """Enumerate the keyboards and start watching them"""
+        if self._thread is not None:
+            return self
+        self._stopping = False
+        self._unwatch = self._watch()
+        self.rescan()
+        self._thread = threading.Thread(target=self._run, name='icl01-registry', daemon=True)
+        self._thread.start()
+        return self
+
+    def _run(self):
+        # Without events, keyboards are enumerated every poll seconds
+        timeout = None if self._unwatch is not None else self.poll
+        while True:
+            self._changed.wait(timeout)
+            if self._stopping:
+                return
+            self._changed.clear()
+            self.rescan()
+
+    def stop(self):
+        if self._thread is None:
+            return
+        self._stopping = True
+        self._changed.set()
+        self._thread.join()
+        self._thread = None
+        if self._unwatch is not None:
+            self._unwatch()
+            self._unwatch = None
+
+    def close(self):
+        self.stop()
+        if self._own_pool:
+            self.pool.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def rescan(self):
+        """Enumerate the keyboards and notify the changes"""
+        with self._cond:
+            stale, self._removed = self._removed, set()
+        devices = {self.device_key(d): d for d in self.pool.enumerate(stale)}
+        with self._cond:
+            removed = [(k, d) for k, d in self.devices.items() if devices.get(k) is not d]
+            added = [(k, d) for k, d in devices.items() if self.devices.get(k) is not d]
+            self.devices = devices
+            for key, d in added:
+                self.generations[key] += 1
+            self._cond.notify_all()
+            for waiter in list(self._waiters):
+                key, after, loop, future = waiter
+                d = self._arrived(key, after)
+                if d is not None:
+                    self._waiters.remove(waiter)
+                    try:
+                        loop.call_soon_threadsafe(_resolve, future, d)
+                    except RuntimeError:
+                        # Loop closed, nobody is waiting anymore
+                        pass
+
+        for key, d in removed:
+            for callback in list(self._subscribers):
+                callback('remove', key, d)
+        for key, d in added:
+            for callback in list(self._subscribers):
+                callback('add', key, d)
+
+    def get(self, key):
+        """Connected ICL01Device of key, or of its serial number, path or location"""
+        with self._cond:
+            d = self.devices.get(key)
+            if d is None:
+                d = next((d for d in self.devices.values() if _matches(d, key)), None)
+            return d
+
+    def generation(self, key):
+        with self._cond:
+            return self.generations[key]
+
+    def wait_for(self, key, timeout=None, after=None):
+        """
+        Wait until the keyboard key is connected and return its ICL01Device,
+        None on timeout. When after is given, it must arrive again since
+        generation(key) returned after.
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while True:
+                d = self._arrived(key, after)
+                if d is not None:
+                    return d
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._cond.wait(remaining)
+
+    def _arrived(self, key, after):
+        # Called with _cond held
+        d = self.devices.get(key)
+        if d is not None and (after is None or self.generations[key] > after):
+            return d
+        return None
+
+    async def arrival(self, key, timeout=None, after=None):
+        """
+        Coroutine version of wait_for(). No thread is blocked while waiting:
+        rescan() resolves a future in the loop of the caller.
+        """
+        import asyncio
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        waiter = (key, after, loop, future)
+        with self._cond:
+            d = self._arrived(key, after)
+            if d is not None:
+                return d
+            self._waiters.append(waiter)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            with self._cond:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+
+    def reboot(self, device, timeout=10.):
+        """
+        Reboot device and return its ICL01Device once it's back, None if it
+        didn't come back in time.
+        """
+        key = self.device_key(device)
+        after = self.generation(key)
+        device.reboot()
+        return self.wait_for(key, timeout, after)
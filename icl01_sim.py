@@ -0,0 +1,365 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+An in-process ICL01 firmware simulator.
+This module mimics the hid module API (enumerate() and device()) so it can be
+used as a drop-in backend for icl01 on machines without a keyboard:
+
+    kbd = icl01_sim.add_keyboard(latency=0.001)
+    for d in icl01.enumerate_icl01(backend=icl01_sim):
+        ...
+"""
+
+import builtins
+import collections
+import random
+import struct
+import threading
+import time
+
+VENDOR_ID = 0x320f
+PRODUCT_ID = 0x5041
+
+MSG_HDR = struct.Struct('<BHBBHB56s')
+CAPABILITIES = struct.Struct('<H3xBB5xBHH47x')
+REPORT_SIZE = 64
+
+# Status codes put in rstatus by the simulated firmware
+STATUS_OK = 0x00
+STATUS_UNKNOWN_COMMAND = 0x01
+STATUS_OUT_OF_RANGE = 0x02
+STATUS_NOT_CONFIGURING = 0x03
+STATUS_BAD_CHECKSUM = 0x04
+
+# Feature reports sent on interface 0 by ICL01Device.reboot()
+BOOTLOADER_REPORT = b'\xAA\x55\xA5\x5A\xFF\x00\x33\xCC'
+FIRMWARE_REPORT = b'\x07\xAA\x55'
+
+Reply = collections.namedtuple('Reply', ('ready', 'report'))
+
+class SimulatedICL01:
+    """
+    Model of the ICL01 firmware: memory regions, configure mode and timings.
+
+    Each report takes service_time seconds to be processed by the firmware
+    (one at a time) and its reply comes back latency seconds later, plus up to
+    jitter seconds. Up to queue_depth requests can wait for processing, the
+    other ones are silently lost like on a firmware unable to queue them.
+    Faults are injected with the given probabilities per reply.
+    """
+    # Commands reading a region and commands writing it
+    READ_REGIONS = {
+        0x03: 'capabilities',
+        0x05: 'global_config',
+        0x07: 'original_mapping',
+        0x08: 'current_mapping',
+        0x0a: 'custom_colors',
+        0x14: 'macros',
+        0x1b: 'physical_map',
+    }
+    WRITE_REGIONS = {
+        0x04: 'capabilities',
+        0x06: 'global_config',
+        0x09: 'current_mapping',
+        0x0b: 'custom_colors',
+        0x12: 'computer_colors',
+        0x15: 'macros',
+    }
+    # Writes refused outside of configure mode
+    CONFIGURE_ONLY = {0x04, 0x06, 0x09, 0x0b, 0x15}
+
+    def __init__(self, map_size=126, macros_buffer_size=0x1000,
+            latency=0., service_time=0., jitter=0., queue_depth=None,
+            drop_rate=0., corrupt_rate=0., noise_rate=0., seed=0, reboot_time=None):
+        assert(map_size * 3 < 512)
+        assert(macros_buffer_size % 0x80 == 0)
+        self.map_size = map_size
+        self.macros_buffer_size = macros_buffer_size
+        self.latency = latency
+        self.service_time = service_time
+        self.jitter = jitter
+        self.queue_depth = queue_depth
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.noise_rate = noise_rate
+        self.random = random.Random(seed)
+        # When set, the keyboard is unplugged for reboot_time seconds when it
+        # reboots, like the real one re-enumerating on USB
+        self.reboot_time = reboot_time
+        self.unplugged = False
+
+        self.inconfig = False
+        self.live = False
+        # When hung, firmware doesn't answer anymore until rebooted
+        self.hung = False
+        self.stats = collections.Counter()
+
+        self._cond = threading.Condition()
+        self._queues = (collections.deque(), collections.deque())
+        self._busy_until = 0.
+
+        self.capabilities = bytearray(CAPABILITIES.pack(0x55aa, map_size,
+            macros_buffer_size // 0x80, 0, 0, 0))
+        self.original_mapping = bytearray()
+        for i in range(map_size):
+            # Plain keys without modifier
+            self.original_mapping += bytes((0x20, 0, (0x04 + i) & 0xff))
+        self.physical_map = bytearray(range(map_size))
+        self.computer_colors = bytearray(map_size * 3)
+        self.factory_reset()
+
+    def factory_reset(self):
+        self.global_config = bytearray(3 * 0x40)
+        for i in range(3):
+            profile = memoryview(self.global_config)[i*0x40:(i+1)*0x40]
+            # Normal mode, full brightness, white
+            profile[1:9] = bytes((6, 4, 2, 0, 0, 0xff, 0xff, 0xff))
+        self.current_mapping = bytearray(self.original_mapping)
+        self.custom_colors = bytearray(10 * 512)
+        self.macros = bytearray(self.macros_buffer_size)
+
+    def region(self, name):
+        return getattr(self, name)
+
+    def inject(self, report, interface=1, delay=0.):
+        """Queue an unsolicited input report as if the keyboard sent it"""
+        report = bytes(report).ljust(REPORT_SIZE, b'\x00')
+        with self._cond:
+            self._queues[interface].append(Reply(time.monotonic() + delay, report))
+            self._cond.notify_all()
+
+    def hang(self):
+        """Stop answering until the next reboot"""
+        self.hung = True
+
+    def pending(self, interface=1):
+        with self._cond:
+            return len(self._queues[interface])
+
+    def process(self, request):
+        """Execute a request report and return its reply report"""
+        report_id, checksum, cmd, size, offset, status, data = MSG_HDR.unpack(request)
+        self.stats[cmd] += 1
+        # 0x1f carries its color outside of the announced size
+        data = data[:3] if cmd == 0x1f else data[:size]
+
+        computed = (cmd + size + (offset & 0xff) + (offset >> 8) + size + sum(data)) & 0xffff
+        if computed != checksum:
+            return self._reply(checksum, cmd, size, offset, STATUS_BAD_CHECKSUM, b'')
+
+        if cmd == 0x01:
+            self.inconfig = True
+        elif cmd == 0x02:
+            self.inconfig = False
+        elif cmd == 0x0d:
+            self.factory_reset()
+        elif cmd == 0x13:
+            self.live = False
+        elif cmd == 0x1f:
+            self.computer_colors[:] = data * self.map_size
+            self.live = True
+        elif cmd in self.READ_REGIONS:
+            region = self.region(self.READ_REGIONS[cmd])
+            if offset + size > len(region):
+                return self._reply(checksum, cmd, size, offset, STATUS_OUT_OF_RANGE, b'')
+            data = bytes(region[offset:offset+size])
+        elif cmd in self.WRITE_REGIONS:
+            if cmd in self.CONFIGURE_ONLY and not self.inconfig:
+                return self._reply(checksum, cmd, size, offset, STATUS_NOT_CONFIGURING, b'')
+            region = self.region(self.WRITE_REGIONS[cmd])
+            if offset + size > len(region):
+                return self._reply(checksum, cmd, size, offset, STATUS_OUT_OF_RANGE, b'')
+            region[offset:offset+size] = data
+            if cmd == 0x12:
+                self.live = True
+        else:
+            return self._reply(checksum, cmd, size, offset, STATUS_UNKNOWN_COMMAND, b'')
+
+        return self._reply(checksum, cmd, size, offset, STATUS_OK, data)
+
+    def _reply(self, checksum, cmd, size, offset, status, data):
+        # Firmware mirrors the request checksum instead of computing a new one
+        return MSG_HDR.pack(4, checksum, cmd, size, offset, status, data)
+
+    def _write(self, interface, data):
+        data = bytes(data)
+        if interface != 1 or len(data) != REPORT_SIZE or data[0] != 4:
+            # Not an ICL01 request, ignored by the firmware
+            return len(data)
+
+        with self._cond:
+            now = time.monotonic()
+            if self.hung:
+                return len(data)
+            queue = self._queues[1]
+            if self.queue_depth is not None:
+                waiting = sum(1 for r in queue if r.report[0] == 4 and r.ready - self.latency > now)
+                if waiting >= self.queue_depth:
+                    self.stats['overflow'] += 1
+                    return len(data)
+
+            reply = self.process(data)
+            self._busy_until = max(now, self._busy_until) + self.service_time
+            ready = self._busy_until + self.latency
+            if self.jitter:
+                ready += self.random.uniform(0, self.jitter)
+
+            if self.noise_rate and self.random.random() < self.noise_rate:
+                # Evision notification report spamming the interface
+                queue.append(Reply(ready, b'\x03\x05\x04'.ljust(REPORT_SIZE, b'\x00')))
+            if self.drop_rate and self.random.random() < self.drop_rate:
+                self.stats['dropped'] += 1
+            else:
+                if self.corrupt_rate and self.random.random() < self.corrupt_rate:
+                    self.stats['corrupted'] += 1
+                    reply = bytearray(reply)
+                    reply[1] ^= 0xff
+                    reply = bytes(reply)
+                queue.append(Reply(ready, reply))
+            self._cond.notify_all()
+        return len(data)
+
+    def _read(self, interface, max_length, timeout):
+        queue = self._queues[interface]
+        with self._cond:
+            now = time.monotonic()
+            deadline = None if timeout is None else now + timeout
+            while True:
+                if queue and queue[0].ready <= now:
+                    return list(queue.popleft().report[:max_length])
+                wait = None
+                if queue:
+                    wait = queue[0].ready - now
+                if deadline is not None:
+                    if now >= deadline:
+                        return []
+                    wait = deadline - now if wait is None else min(wait, deadline - now)
+                self._cond.wait(wait)
+                now = time.monotonic()
+
+    def _feature(self, interface, data):
+        data = bytes(data)
+        # Strip report ID
+        report = data[1:]
+        if report.startswith(BOOTLOADER_REPORT) or report.startswith(FIRMWARE_REPORT):
+            with self._cond:
+                self.inconfig = False
+                self.live = False
+                self.hung = False
+                self._busy_until = 0.
+                for q in self._queues:
+                    q.clear()
+            self.stats['reboot'] += report.startswith(FIRMWARE_REPORT)
+            if report.startswith(FIRMWARE_REPORT) and self.reboot_time is not None:
+                _replug(self, self.reboot_time)
+        return len(data)
+
+class SimulatedHIDDevice:
+    """Implements the subset of hid.device used by icl01"""
+
+    def __init__(self):
+        self.firmware = None
+        self.interface = None
+
+    def open_path(self, path):
+        self.firmware, self.interface = _lookup(path)
+
+    def close(self):
+        self.firmware = None
+
+    def _firmware(self):
+        if self.firmware is None:
+            raise IOError("Device is not opened")
+        if self.firmware.unplugged:
+            raise IOError("Device is unplugged")
+        return self.firmware
+
+    def write(self, data):
+        return self._firmware()._write(self.interface, data)
+
+    def read(self, max_length, timeout_ms=0):
+        timeout = timeout_ms / 1000. if timeout_ms > 0 else None
+        return self._firmware()._read(self.interface, max_length, timeout)
+
+    def send_feature_report(self, data):
+        return self._firmware()._feature(self.interface, data)
+
+_keyboards = []
+# Callbacks of watch()
+_watchers = []
+
+def _path(index, interface):
+    return 'sim:{}:{}'.format(index, interface).encode('ascii')
+
+def _lookup(path):
+    try:
+        prefix, index, interface = path.decode('ascii').split(':')
+        fw = _keyboards[int(index)]
+    except (ValueError, IndexError, UnicodeDecodeError):
+        fw = None
+    if fw is None or prefix != 'sim' or fw.unplugged:
+        raise IOError("No simulated device at {!r}".format(path))
+    return fw, int(interface)
+
+def _notify(action, index):
+    for intf in range(2):
+        for callback in list(_watchers):
+            callback(action, _path(index, intf))
+
+def watch(callback):
+    """
+    Call callback(action, path) when an interface is plugged ('add') or
+    unplugged ('remove'). Returns a function removing the callback.
+    """
+    _watchers.append(callback)
+    return lambda: _watchers.remove(callback)
+
+def add_keyboard(**kwargs):
+    """Plug a new simulated keyboard and return its firmware"""
+    fw = SimulatedICL01(**kwargs)
+    _keyboards.append(fw)
+    _notify('add', len(_keyboards) - 1)
+    return fw
+
+def remove_keyboard(fw):
+    """Unplug a simulated keyboard"""
+    index = _keyboards.index(fw)
+    _keyboards[index] = None
+    _notify('remove', index)
+
+def _replug(fw, delay):
+    index = _keyboards.index(fw)
+    fw.unplugged = True
+    _notify('remove', index)
+
+    def plug():
+        fw.unplugged = False
+        _notify('add', index)
+    threading.Timer(delay, plug).start()
+
+def clear():
+    plugged = [i for i, fw in builtins.enumerate(_keyboards) if fw is not None and not fw.unplugged]
+    del _keyboards[:]
+    for index in plugged:
+        _notify('remove', index)
+
+def enumerate(vendor_id=0, product_id=0):
+    if vendor_id not in (0, VENDOR_ID) or product_id not in (0, PRODUCT_ID):
+        return []
+    ret = []
+    for i, fw in builtins.enumerate(_keyboards):
+        if fw is None or fw.unplugged:
+            continue
+        for intf in range(2):
+            ret.append({
+                'path': _path(i, intf),
+                'vendor_id': VENDOR_ID,
+                'product_id': PRODUCT_ID,
+                'serial_number': 'SIM{:04d}'.format(i),
+                'interface_number': intf,
+                'usb_path': 'sim-{}'.format(i),
+            })
+    return ret
+
+def device():
+    return SimulatedHIDDevice()
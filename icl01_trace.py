@@ -0,0 +1,173 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+"""
+Tracing of the transfers of ICL01 devices.
+A Tracer given as tracer to an ICL01Device, or to enumerate_icl01(), gets
+its round trips, transfers and errors:
+
+    tracer = icl01_trace.ChromeTrace()
+    for d in icl01.enumerate_icl01(tracer=tracer):
+        d.dump_image()
+    print(tracer)
+    with open('trace.json', 'w') as f:
+        tracer.export(f)
+"""
+
+import bisect
+import collections
+import threading
+import time
+
+class Tracer:
+    """
+    Hooks called by an ICL01Device whose tracer attribute is set.
+    Times come from time.perf_counter(), error kinds are 'timeout',
+    'report_id', 'checksum', 'command', 'offset', 'status', 'short',
+    'unexpected', 'fallback' (pipelined transfer redone in strict mode),
+    'retry', 'recovery' (device rebooted by its RetryPolicy) and
+    'subscriber' (ReportReader subscriber raised).
+    Hooks may be called from several threads when a tracer is shared.
+    """
+    def round_trip(self, cmd, offset, size, start, end):
+        """A request of size bytes got its reply"""
+
+    def transfer(self, op, cmd, offset, size, chunks, start, end, error):
+        """query(), read() or write() (op) returned or raised error"""
+
+    def discarded(self, report):
+        """
+        A report was dropped by the requests: a report without ID 4 read
+        while waiting for a reply or by the ReportReader (once handed to its
+        subscribers), or a reply no request expects (stale or duplicated)
+        read by the ReportReader
+        """
+
+    def error(self, kind, cmd, offset):
+        """A reply was rejected, cmd and offset are None when unknown"""
+
+class LatencyStats(Tracer):
+    """Per command round trip latency histograms and transfer counters"""
+    # Upper bounds in seconds of the histogram buckets, the last one is unbounded
+    BUCKETS = (50e-6, 100e-6, 200e-6, 500e-6, 1e-3, 2e-3, 5e-3, 10e-3, 20e-3, 50e-3, 100e-3, 200e-3, 500e-3, 1.)
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        # By command
+        self.histograms = {}
+        self.round_trips = collections.Counter()
+        self.latency = collections.Counter()
+        # By (op, cmd)
+        self.transfers = collections.Counter()
+        self.bytes = collections.Counter()
+        self.chunks = collections.Counter()
+        self.elapsed = collections.Counter()
+        self.discarded_reports = 0
+        self.errors = collections.Counter()
+
+    def round_trip(self, cmd, offset, size, start, end):
+        latency = end - start
+        with self._lock:
+            histogram = self.histograms.get(cmd)
+            if histogram is None:
+                histogram = self.histograms[cmd] = [0] * (len(self.BUCKETS) + 1)
+            histogram[bisect.bisect_left(self.BUCKETS, latency)] += 1
+            self.round_trips[cmd] += 1
+            self.latency[cmd] += latency
+
+    def transfer(self, op, cmd, offset, size, chunks, start, end, error):
+        key = (op, cmd)
+        with self._lock:
+            self.transfers[key] += 1
+            self.bytes[key] += size
+            self.chunks[key] += chunks
+            self.elapsed[key] += end - start
+
+    def discarded(self, report):
+        with self._lock:
+            self.discarded_reports += 1
+
+    def error(self, kind, cmd, offset):
+        with self._lock:
+            self.errors[kind] += 1
+
+    def percentile(self, cmd, percentile=50):
+        """Upper bound of the bucket holding the given latency percentile"""
+        histogram = self.histograms.get(cmd)
+        if not histogram:
+            return 0.
+        rank = sum(histogram) * percentile / 100.
+        seen = 0
+        for i, count in enumerate(histogram):
+            seen += count
+            if count and seen >= rank:
+                return self.BUCKETS[i] if i < len(self.BUCKETS) else float('inf')
+        return float('inf')
+
+    def __str__(self):
+        s = ""
+        for cmd in sorted(self.round_trips):
+            s += "0x{:02x}: {} round trips, mean {:.2f} ms, p50 <= {:.2f} ms, p99 <= {:.2f} ms\n".format(
+                    cmd, self.round_trips[cmd], self.latency[cmd] / self.round_trips[cmd] * 1000.,
+                    self.percentile(cmd, 50) * 1000., self.percentile(cmd, 99) * 1000.)
+        for op, cmd in sorted(self.transfers):
+            key = (op, cmd)
+            s += "{} 0x{:02x}: {} calls, {} bytes, {} chunks in {:.3f} s\n".format(
+                    op, cmd, self.transfers[key], self.bytes[key], self.chunks[key], self.elapsed[key])
+        if self.discarded_reports:
+            s += "{} reports discarded\n".format(self.discarded_reports)
+        if self.errors:
+            s += "errors: {}\n".format(", ".join("{} {}".format(n, kind) for kind, n in sorted(self.errors.items())))
+        return s
+
+class ChromeTrace(LatencyStats):
+    """
+    LatencyStats also recording every event for chrome://tracing or Perfetto.
+    Each thread gets its own track, run_fleet() thus shows one per device.
+    """
+    def __init__(self):
+        super().__init__()
+        self.origin = time.perf_counter()
+        self.events = []
+        self._threads = set()
+
+    def _event(self, name, cat, ph, start, end=None, args=None):
+        thread = threading.current_thread()
+        event = {'name': name, 'cat': cat, 'ph': ph, 'pid': 1, 'tid': thread.ident,
+                'ts': (start - self.origin) * 1e6}
+        if end is not None:
+            event['dur'] = (end - start) * 1e6
+        else:
+            event['s'] = 't'
+        if args:
+            event['args'] = args
+        with self._lock:
+            if thread.ident not in self._threads:
+                self._threads.add(thread.ident)
+                self.events.append({'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': thread.ident,
+                    'args': {'name': thread.name}})
+            self.events.append(event)
+
+    def round_trip(self, cmd, offset, size, start, end):
+        super().round_trip(cmd, offset, size, start, end)
+        self._event("0x{:02x} @0x{:04x}".format(cmd, offset), 'round_trip', 'X', start, end, {'size': size})
+
+    def transfer(self, op, cmd, offset, size, chunks, start, end, error):
+        super().transfer(op, cmd, offset, size, chunks, start, end, error)
+        args = {'cmd': "0x{:02x}".format(cmd), 'offset': offset, 'size': size, 'chunks': chunks}
+        if error is not None:
+            args['error'] = repr(error)
+        self._event("{} 0x{:02x}".format(op, cmd), 'transfer', 'X', start, end, args)
+
+    def discarded(self, report):
+        super().discarded(report)
+        self._event('discarded', 'report', 'i', time.perf_counter(), args={'report': bytes(report[:8]).hex()})
+
+    def error(self, kind, cmd, offset):
+        super().error(kind, cmd, offset)
+        self._event(kind, 'error', 'i', time.perf_counter(), args={'cmd': cmd, 'offset': offset})
+
+    def export(self, stream):
+        """Write the trace events JSON to a text stream"""
+        import json
+        with self._lock:
+            json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, stream)
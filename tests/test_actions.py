@@ -0,0 +1,123 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import unittest
+
+import icl01
+from icl01 import (Action, ActionConsumer, ActionFn, ActionKey, ActionKeyRepeat,
+        ActionMacro, ActionMouseClick, ActionMouseMove, ActionMousePan, ActionSystem,
+        InvalidActionError, Macro, MacroEntry, MacrosBlock, MappingTable)
+
+ACTIONS = [
+    ActionKey(0, 0x04),
+    ActionKey(0x02, 0x1e),
+    ActionKey(0, 0x39, 0xb0),
+    ActionKeyRepeat(0x2c, 3),
+    ActionConsumer(0xe9),
+    ActionConsumer(0x223, 0x60),
+    ActionSystem(0x1),
+    ActionMouseClick(0x1),
+    ActionMousePan(-3, 2),
+    ActionMacro(2, 1),
+    ActionFn(0x01, 0),
+]
+
+class ActionTest(unittest.TestCase):
+    def test_table_round_trip(self):
+        data = Action.pack_table(ACTIONS)
+        self.assertEqual(len(data), len(ACTIONS) * Action.size)
+        decoded = Action.unpack_table(data)
+        self.assertEqual(decoded, ACTIONS)
+        self.assertEqual(Action.pack_table(decoded), data)
+        self.assertEqual(list(Action.iter_unpack(data)), ACTIONS)
+
+    def test_decoded_actions_are_shared(self):
+        data = Action.pack_table(ACTIONS)
+        self.assertIs(Action.unpack_table(data)[0], Action.unpack(data[:3]))
+        self.assertIs(Action.intern(ActionKey(0, 0x04)), Action.unpack(data[:3]))
+
+    def test_immutable(self):
+        action = ActionKey(0, 0x04)
+        with self.assertRaises(AttributeError):
+            action.keycode = 0x05
+        with self.assertRaises(AttributeError):
+            action.type = 0xb0
+        # Hashing has no side effect
+        table = {action: 1}
+        self.assertEqual(table[ActionKey(0, 0x04)], 1)
+        self.assertEqual(action.keycode, 0x04)
+
+    def test_unused_bytes_are_ignored(self):
+        self.assertEqual(Action.unpack(b'\x10\x01\x05'), ActionMouseClick(0x1))
+        self.assertEqual(hash(Action.unpack(b'\x10\x01\x05')), hash(ActionMouseClick(0x1)))
+        self.assertEqual(Action.unpack(b'\x60\x00\x00'), ActionConsumer(0x223, 0x60))
+        self.assertNotEqual(Action.unpack(b'\x10\x02\x05'), ActionMouseClick(0x1))
+
+    def test_invalid_actions(self):
+        with self.assertRaises(InvalidActionError):
+            Action.unpack(b'\x99\x00\x00')
+        with self.assertRaises(InvalidActionError):
+            Action.intern(ActionMouseMove(1, 0))
+
+    def test_interned_cache_is_bounded(self):
+        saved = Action.INTERNED_MAX
+        Action.INTERNED_MAX = 16
+        try:
+            for keycode in range(0x100):
+                self.assertEqual(Action.unpack(bytes((0x20, 0, keycode))).keycode, keycode)
+                self.assertLessEqual(len(Action.INTERNED), 16)
+        finally:
+            Action.INTERNED_MAX = saved
+            Action.INTERNED.clear()
+
+    def test_macro_only_actions(self):
+        self.assertEqual(ActionMouseMove(-3, 0), ActionMouseMove(-3, 0))
+        self.assertEqual(hash(ActionMouseMove(-3, 0)), hash(ActionMouseMove(-3, 0)))
+        self.assertNotEqual(ActionMouseMove(-3, 0), ActionMouseMove(0, -3))
+
+    def test_macros_round_trip(self):
+        macro = Macro([
+            MacroEntry(10, True, ActionKey(0, 0x04)),
+            MacroEntry(20, False, ActionKey(0, 0x04)),
+            MacroEntry(5, False, ActionMouseMove(0, 3)),
+            MacroEntry(5, True, ActionMouseMove(-3, 0)),
+            MacroEntry(5, True, ActionMouseClick(0x1)),
+            MacroEntry(5, False, ActionMouseClick(0x1)),
+        ])
+        block = MacrosBlock([macro, macro])
+        decoded = MacrosBlock.unpack(block.pack())
+        self.assertEqual(decoded, block)
+        self.assertEqual(decoded.pack(), block.pack())
+
+    def test_macro_mouse_moves(self):
+        for pressed in (False, True):
+            for delta in (-128, -3, 0, 3, 127):
+                for move in (ActionMouseMove(delta, 0), ActionMouseMove(0, delta)):
+                    data = Macro([MacroEntry(5, pressed, move)]).pack()
+                    # Bit 7 only carries the sign
+                    self.assertEqual(data[6] & 0x80, 0x80 if delta < 0 else 0)
+                    entry, = Macro.unpack(data)
+                    self.assertEqual(entry.action, move)
+                    self.assertEqual(entry.pressed, delta < 0)
+                    self.assertEqual(Macro([entry]).pack(), data)
+
+class MappingTableTest(unittest.TestCase):
+    def test_sequence(self):
+        table = MappingTable.from_actions(ACTIONS)
+        self.assertEqual(len(table), len(ACTIONS))
+        self.assertEqual(table[-1], ACTIONS[-1])
+        self.assertEqual(list(table), ACTIONS)
+        self.assertEqual(table, ACTIONS)
+        self.assertEqual(table[1:3], MappingTable.from_actions(ACTIONS[1:3]))
+
+    def test_dirty_and_diff(self):
+        original = MappingTable.from_actions(ACTIONS)
+        table = MappingTable(bytearray(original.data))
+        table[0] = ACTIONS[0]
+        self.assertEqual(table.dirty, set())
+        table[3] = table[4] = ActionKey(0, 0x05)
+        table[8] = ActionKey(0, 0x06)
+        self.assertEqual(table.dirty_ranges(), [(3, 2), (8, 1)])
+        self.assertEqual(original.diff(table), [3, 4, 8])
+
+if __name__ == '__main__':
+    unittest.main()
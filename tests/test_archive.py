@@ -0,0 +1,104 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import icl01
+import icl01_archive
+import icl01_sim
+from icl01 import DeviceImage
+from icl01_archive import SnapshotArchive
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def sample_image(seed):
+    return DeviceImage({0x03: bytes([seed]*8), 0x08: bytes(range(seed, seed + 30))})
+
+APPEND = """
+import sys
+import icl01_archive
+from icl01 import DeviceImage
+with icl01_archive.SnapshotArchive(sys.argv[1]) as arc:
+    for i in range(int(sys.argv[3])):
+        arc.append(sys.argv[2], DeviceImage({0x03: bytes(1000 + i)}), timestamp=i)
+"""
+
+class SnapshotArchiveTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'test.arc')
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def test_round_trip(self):
+        with SnapshotArchive(self.path) as arc:
+            for i in range(3):
+                arc.append('SIM0000', sample_image(i), timestamp=10 + i)
+            arc.append('SIM0001', sample_image(7), timestamp=11)
+        with SnapshotArchive(self.path, writable=False) as arc:
+            self.assertEqual(len(arc), 4)
+            self.assertEqual(sorted(arc.keys()), ['SIM0000', 'SIM0001'])
+            self.assertEqual(arc.latest('SIM0000', before=11.5).timestamp, 11)
+            image = arc.image(arc.latest('SIM0001'))
+            self.assertEqual(bytes(image.regions[0x08]), bytes(sample_image(7).regions[0x08]))
+
+    def test_incomplete_record_is_dropped(self):
+        with SnapshotArchive(self.path) as arc:
+            arc.append('SIM0000', sample_image(1), timestamp=1)
+            end = arc.end
+        with open(self.path, 'ab') as f:
+            f.write(b'SNAP\x00\x01')
+        with SnapshotArchive(self.path) as arc:
+            self.assertEqual(os.path.getsize(self.path), end)
+            arc.append('SIM0000', sample_image(2), timestamp=2)
+            self.assertEqual(len(arc), 2)
+
+    def test_appends_from_several_archives(self):
+        with SnapshotArchive(self.path) as a, SnapshotArchive(self.path) as b:
+            a.append('a', sample_image(1), timestamp=1)
+            b.append('b', sample_image(2), timestamp=2)
+            a.append('a', sample_image(3), timestamp=3)
+            self.assertEqual(len(a), 3)
+            b.refresh()
+            self.assertEqual(len(b), 3)
+        with SnapshotArchive(self.path, writable=False) as arc:
+            self.assertEqual([s.timestamp for s in arc], [1, 2, 3])
+
+    def test_appends_from_several_processes(self):
+        count = 20
+        writers = [subprocess.Popen([sys.executable, '-c', APPEND, self.path, 'w{}'.format(i), str(count)],
+            cwd=ROOT) for i in range(4)]
+        for p in writers:
+            self.assertEqual(p.wait(), 0)
+        with SnapshotArchive(self.path, writable=False) as arc:
+            self.assertEqual(sorted(arc.keys()), ['w0', 'w1', 'w2', 'w3'])
+            for key in arc.keys():
+                snapshots = arc.snapshots(key)
+                self.assertEqual(len(snapshots), count)
+                for i, s in enumerate(snapshots):
+                    self.assertEqual(bytes(arc.image(s).regions[0x03]), bytes(1000 + i))
+
+class DeviceKeyTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+
+    def tearDown(self):
+        icl01_sim.clear()
+
+    def test_serial_number(self):
+        icl01_sim.add_keyboard()
+        d, = icl01.enumerate_icl01(backend=icl01_sim)
+        self.assertEqual(icl01_archive.device_key(d), 'SIM0000')
+        d.close()
+
+    def test_path_without_serial_number(self):
+        d = icl01.ICL01Device([b'sim:0:0', b'sim:0:1'], backend=icl01_sim)
+        self.assertEqual(icl01_archive.device_key(d), 'sim:0:0')
+        d.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import asyncio
+import unittest
+
+import icl01
+import icl01_sim
+
+class AsyncDeviceTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard()
+        self.fw.custom_colors[:] = bytes(i & 0xff for i in range(10 * 512))
+        self.d, = icl01.enumerate_icl01(backend=icl01_sim)
+        self.ad = icl01.AsyncICL01Device(self.d)
+
+    def tearDown(self):
+        self.ad.close()
+        self.d.close()
+        icl01_sim.clear()
+
+    def colors(self, offset, size):
+        return bytes(self.fw.custom_colors[offset:offset+size])
+
+    def test_concurrent_queries(self):
+        self.fw.latency = 0.001
+        async def main():
+            return await asyncio.gather(*(self.ad.read(0x0a, 100, 100 * i) for i in range(20)))
+        replies = asyncio.run(main())
+        for i, reply in enumerate(replies):
+            self.assertEqual(bytes(reply), self.colors(100 * i, 100))
+        self.assertEqual(self.fw.pending(), 0)
+
+    def test_cancel_pending_query(self):
+        self.fw.latency = 0.02
+        async def main():
+            running = asyncio.ensure_future(self.ad.read(0x0a, 512))
+            waiting = asyncio.ensure_future(self.ad.read(0x0a, 512, 512))
+            await asyncio.sleep(0.01)
+            running.cancel()
+            waiting.cancel()
+            for task in (running, waiting):
+                with self.assertRaises(asyncio.CancelledError):
+                    await task
+            # Still usable once the cancelled query is done in the device thread
+            return await self.ad.read(0x0a, 56, 1024)
+        self.assertEqual(bytes(asyncio.run(main())), self.colors(1024, 56))
+        self.assertEqual(self.fw.pending(), 0)
+
+    def test_errors_are_propagated(self):
+        async def main():
+            # Custom colors can't be written outside configure mode
+            with self.assertRaises(icl01.ICL01QueryError):
+                await self.ad.write(0x0b, bytes(3))
+            with self.assertRaises(ValueError):
+                async with self.ad:
+                    await self.ad.write(0x0b, b'\x01\x02\x03')
+                    raise ValueError()
+            return await self.ad.read(0x0a, 3)
+        self.assertEqual(bytes(asyncio.run(main())), b'\x01\x02\x03')
+        # Configure mode was left on the way out
+        self.assertFalse(self.d.inconfig)
+        self.assertFalse(self.fw.inconfig)
+
+    def test_cancel_in_configure_mode(self):
+        self.fw.latency = 0.01
+        async def configure():
+            async with self.ad:
+                await self.ad.write(0x0b, bytes(512))
+        async def main():
+            task = asyncio.ensure_future(configure())
+            await asyncio.sleep(0.03)
+            task.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await task
+        asyncio.run(main())
+        self.assertFalse(self.d.inconfig)
+        self.assertFalse(self.fw.inconfig)
+        self.assertEqual(self.fw.stats[0x02], 1)
+
+if __name__ == '__main__':
+    unittest.main()
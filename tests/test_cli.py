@@ -0,0 +1,75 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import icl01
+import icl01_sim
+from icl01 import DeviceImage
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class CommandLineTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.dir = tempfile.TemporaryDirectory()
+        self.image = os.path.join(self.dir.name, 'backup.img')
+
+    def tearDown(self):
+        self.dir.cleanup()
+        icl01_sim.clear()
+
+    def run_main(self, *argv):
+        out, err = io.StringIO(), io.StringIO()
+        with contextlib.redirect_stdout(out), contextlib.redirect_stderr(err):
+            try:
+                status = icl01.main(['--sim'] + list(argv))
+            except SystemExit as e:
+                status = e.code
+        return status, out.getvalue(), err.getvalue()
+
+    def test_info(self):
+        status, out, err = self.run_main('info')
+        self.assertEqual(status, 0)
+        self.assertIn("Board size: ", out)
+
+    def test_dump_and_restore(self):
+        self.assertEqual(self.run_main('dump', '-o', self.image)[0], 0)
+        status, out, err = self.run_main('restore', '--dry-run', self.image)
+        self.assertEqual(status, 0, err)
+
+    def test_restore_without_capabilities(self):
+        with open(self.image, 'wb') as f:
+            DeviceImage({0x05: bytes(DeviceImage.region_size(0x05, None))}).write(f)
+        status, out, err = self.run_main('restore', self.image)
+        self.assertEqual(status, 2)
+        self.assertIn("no capabilities region (0x03)", err)
+        self.assertIn("regions: 0x05", err)
+        self.assertNotIn("Traceback", err)
+
+    def test_restore_not_an_image(self):
+        with open(self.image, 'wb') as f:
+            f.write(b'not an image')
+        status, out, err = self.run_main('restore', self.image)
+        self.assertEqual(status, 2)
+        self.assertIn("Not an ICL01 image", err)
+
+    def test_info_into_closed_pipe(self):
+        # Like piping into head, the reader is gone before the output is flushed
+        r, w = os.pipe()
+        os.close(r)
+        try:
+            p = subprocess.run([sys.executable, 'icl01.py', '--sim', 'info'], cwd=ROOT,
+                    stdout=w, stderr=subprocess.PIPE)
+        finally:
+            os.close(w)
+        self.assertEqual(p.returncode, 1)
+        self.assertEqual(p.stderr, b'')
+
+if __name__ == '__main__':
+    unittest.main()
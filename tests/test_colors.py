@@ -0,0 +1,111 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import unittest
+
+import icl01
+import icl01_sim
+from icl01 import Color, ColorFrame
+
+class ColorFrameTest(unittest.TestCase):
+    def test_sequence(self):
+        frame = ColorFrame.from_colors([Color(1, 2, 3), Color(4, 5, 6), Color(7, 8, 9)])
+        self.assertEqual(len(frame), 3)
+        self.assertEqual(frame.data, b'\x01\x02\x03\x04\x05\x06\x07\x08\x09')
+        self.assertEqual(repr(frame[-1]), repr(Color(7, 8, 9)))
+        self.assertEqual(frame[1:], ColorFrame(b'\x04\x05\x06\x07\x08\x09'))
+        self.assertEqual([c.pack() for c in frame], [b'\x01\x02\x03', b'\x04\x05\x06', b'\x07\x08\x09'])
+        with self.assertRaises(IndexError):
+            frame[3]
+
+    def test_copies_are_independent(self):
+        frame = ColorFrame.filled(4, Color(0, 0, 0))
+        for other in (frame.copy(), ColorFrame.from_colors(frame), frame.roll(0), frame.roll(4)):
+            other[0] = Color(0xff, 0, 0)
+            self.assertEqual(frame.data, bytes(12))
+
+    def test_operations(self):
+        frame = ColorFrame.from_colors([Color(0x10, 0x20, 0x30), Color(0xff, 0, 0x80)])
+        self.assertEqual(frame.roll(1).data, b'\xff\x00\x80\x10\x20\x30')
+        self.assertEqual(frame.scale(.5).data, b'\x08\x10\x18\x80\x00\x40')
+        self.assertEqual(frame.gamma(1.).data, frame.data)
+        self.assertEqual(frame.blend(ColorFrame(bytes(6)), 1.).data, bytes(6))
+
+    def test_slice_assignment(self):
+        frame = ColorFrame(3)
+        frame[1:] = [Color(1, 2, 3), Color(4, 5, 6)]
+        self.assertEqual(frame.data, b'\x00\x00\x00\x01\x02\x03\x04\x05\x06')
+        frame[:1] = ColorFrame(b'\x07\x08\x09')
+        self.assertEqual(frame[0].pack(), b'\x07\x08\x09')
+        for colors in ([], [Color(1, 2, 3)] * 3, b'\x01\x02\x03'):
+            with self.assertRaises(ValueError):
+                frame[1:] = colors
+        self.assertEqual(len(frame), 3)
+        with self.assertRaises(IndexError):
+            frame[3] = Color(1, 2, 3)
+
+    def test_arrays_require_numpy(self):
+        saved = icl01._numpy_module
+        icl01._numpy_module = None
+        try:
+            frame = ColorFrame(2)
+            with self.assertRaisesRegex(ImportError, 'numpy'):
+                frame.array
+            with self.assertRaisesRegex(ImportError, 'numpy'):
+                ColorFrame.from_array([[1, 2, 3]])
+            # Other operations don't need it
+            self.assertEqual(frame.blend(ColorFrame(b'\x02' * 6), .5).data, b'\x01' * 6)
+            self.assertEqual(ColorFrame.from_palette([Color(1, 2, 3)], [0, 0]).data, b'\x01\x02\x03' * 2)
+        finally:
+            icl01._numpy_module = saved
+
+class DeviceColorsTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard()
+        self.d, = icl01.enumerate_icl01(backend=icl01_sim)
+        self.size = self.fw.map_size
+
+    def tearDown(self):
+        self.d.close()
+        icl01_sim.clear()
+
+    def sample(self, seed):
+        return ColorFrame(bytes((seed + i) & 0xff for i in range(self.size * Color.size)))
+
+    def test_computer_colors_formats(self):
+        frame = self.sample(1)
+        for colors in (frame, bytes(frame.data), bytearray(frame.data), list(frame)):
+            self.fw.computer_colors[:] = bytes(len(self.fw.computer_colors))
+            self.d.write_computer_colors(colors)
+            self.assertEqual(bytes(self.fw.computer_colors), bytes(frame.data))
+        self.d.write_computer_colors(bytes(frame.data[:6]), start=self.size - 2)
+        self.assertEqual(bytes(self.fw.computer_colors[-6:]), bytes(frame.data[:6]))
+        with self.assertRaises(AssertionError):
+            self.d.write_computer_colors(bytes(frame.data) + b'\x00\x00\x00')
+
+    def test_custom_colors_round_trip(self):
+        profiles = self.d.read_custom_colors()
+        self.assertEqual(len(profiles), 10)
+        self.assertEqual(len(profiles[0]), self.size)
+        profiles = [self.sample(i) for i in range(10)]
+        with self.d:
+            self.d.write_custom_colors(profiles)
+        self.assertEqual(self.d.read_custom_colors(), profiles)
+
+        # Written back as read
+        with self.d:
+            self.d.write_custom_colors(self.d.read_custom_colors())
+        self.assertEqual(self.d.read_custom_colors(), profiles)
+
+    def test_custom_colors_profile_formats(self):
+        frame = self.sample(7)
+        for profile, colors in enumerate((frame, bytes(frame.data), list(frame))):
+            with self.d:
+                self.d.write_custom_colors(colors, profile=profile)
+            self.assertEqual(self.d.read_custom_colors(profile), frame)
+        with self.d:
+            self.d.write_custom_colors(bytes(frame.data[:3]), profile=3, start=169)
+        self.assertEqual(bytes(self.fw.custom_colors[3*512+507:3*512+510]), bytes(frame.data[:3]))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import socket
+import tempfile
+import threading
+import unittest
+
+import icl01
+import icl01_daemon
+import icl01_registry
+import icl01_sim
+from icl01 import Color, ColorFrame, MappingTable
+from icl01_daemon import HDR, Client, DaemonError
+
+class DaemonTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard(reboot_time=.05)
+        self.dir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.dir.name, 'icl01.sock')
+        self.registry = icl01_registry.DeviceRegistry(backend=icl01_sim).start()
+        self.server = icl01_daemon.Server(self.path, self.registry)
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(.05, ), daemon=True)
+        self.thread.start()
+        self.client = Client(self.path)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.registry.close()
+        self.dir.cleanup()
+        icl01_sim.clear()
+
+    def frame(self, seed=0):
+        return ColorFrame(bytes((seed + i) & 0xff for i in range(self.fw.map_size * Color.size)))
+
+    def test_devices_and_regions(self):
+        device, = self.client.devices()
+        self.assertEqual(device['serial'], 'SIM0000')
+        table = self.client.read_mapping()
+        self.assertEqual(table.data, self.fw.current_mapping)
+        table = MappingTable(bytearray(table.data))
+        table[0] = icl01.ActionKey(0, 0x05)
+        self.assertEqual(self.client.write_mapping(table)['transactions'], 1)
+        self.assertEqual(self.fw.current_mapping[:3], b'\x20\x00\x05')
+
+    def test_colors(self):
+        frame = self.frame(1)
+        for colors in (frame, bytes(frame.data), list(frame)):
+            self.fw.computer_colors[:] = bytes(len(self.fw.computer_colors))
+            self.client.write_computer_colors(colors)
+            self.assertEqual(bytes(self.fw.computer_colors), bytes(frame.data))
+        self.client.write_computer_colors(frame[:2], start=self.fw.map_size - 2)
+        self.assertEqual(bytes(self.fw.computer_colors[-6:]), bytes(frame.data[:6]))
+
+        with self.assertRaisesRegex(DaemonError, "RGB"):
+            self.client.call('colors', b'\x01\x02\x03\x04')
+        with self.assertRaisesRegex(DaemonError, "don't fit"):
+            self.client.write_computer_colors(frame[:2], start=self.fw.map_size - 1)
+        self.client.cancel_computer_colors()
+
+    def test_frames(self):
+        frames = self.client.frames()
+        frame = self.frame(2)
+        self.assertEqual(frames.push(frame), len(frame.data))
+        self.assertEqual(bytes(self.fw.computer_colors), bytes(frame.data))
+        self.assertEqual(frames.push(frame), 0)
+        frames.close()
+
+    def test_reboot(self):
+        key = self.client.devices()[0]['key']
+        self.assertEqual(self.client.reboot(timeout=5), key)
+        self.assertEqual(self.client.devices()[0]['key'], key)
+
+    def test_reboot_without_re_enumeration(self):
+        self.fw.reboot_time = None
+        self.assertIsNone(self.client.reboot(timeout=.1))
+
+    def test_oversized_message(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.sendall(HDR.pack(2, icl01_daemon.PAYLOAD_MAX + 1) + b'{}')
+        # Dropped without reading nor allocating the payload
+        sock.settimeout(5)
+        try:
+            data = sock.recv(16)
+        except ConnectionResetError:
+            # Closed with the JSON left unread
+            data = b''
+        self.assertEqual(data, b'')
+        sock.close()
+        # Other connections keep working
+        self.assertEqual(len(self.client.devices()), 1)
+
+    def test_message_not_an_object(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.connect(self.path)
+        sock.settimeout(5)
+        for data in (b'[]', b'1', b'"devices"', b'{"method": "devices", "args": []}'):
+            sock.sendall(HDR.pack(len(data), 3) + data + b'\x01\x02\x03')
+            reply, payload = icl01_daemon._recv_message(sock)
+            self.assertRegex(reply['error'], "^DaemonError: .*JSON objects")
+        # Still in sync
+        icl01_daemon._send_message(sock, {'method': 'devices'})
+        reply, payload = icl01_daemon._recv_message(sock)
+        self.assertEqual(reply['result'][0]['serial'], 'SIM0000')
+        sock.close()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,52 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import unittest
+
+import icl01
+import icl01_sim
+from icl01 import Color, ColorFrame
+
+class FrameDifferTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard()
+        self.d, = icl01.enumerate_icl01(backend=icl01_sim)
+        self.differ = icl01.FrameDiffer(self.d)
+        self.frame = ColorFrame.filled(self.fw.map_size, Color(0, 0, 0x40))
+
+    def tearDown(self):
+        self.d.close()
+        icl01_sim.clear()
+
+    def test_only_changed_keys_are_sent(self):
+        self.assertEqual(self.differ.push(self.frame), len(self.frame.data))
+        frame = ColorFrame(bytearray(self.frame.data))
+        frame[10] = Color(0xff, 0, 0)
+        self.assertEqual(self.differ.push(frame), Color.size)
+        self.assertEqual(self.differ.push(frame), 0)
+        self.assertEqual(bytes(self.fw.computer_colors), bytes(frame.data))
+
+    def test_failed_frame_is_sent_again_in_full(self):
+        self.differ.push(self.frame)
+        frame = ColorFrame(bytearray(self.frame.data))
+        frame[0] = frame[120] = Color(0xff, 0, 0)
+
+        write = self.d.write
+        calls = []
+        def failing_write(cmd, data, offset=0):
+            calls.append(offset)
+            if len(calls) == 2:
+                raise IOError("Device is gone")
+            return write(cmd, data, offset)
+        self.d.write = failing_write
+        with self.assertRaises(IOError):
+            self.differ.push(frame)
+        del self.d.write
+
+        # Key 0 changed on the keyboard, key 120 didn't
+        self.assertEqual(self.fw.computer_colors[:3], b'\xff\x00\x00')
+        self.differ.push(self.frame)
+        self.assertEqual(bytes(self.fw.computer_colors), bytes(self.frame.data))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,53 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import unittest
+
+import icl01
+import icl01_sim
+
+def read_colors(d):
+    return bytes(d.read(0x0a, 512))
+
+class FleetTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fws = [icl01_sim.add_keyboard(latency=0.005) for i in range(4)]
+        for i, fw in enumerate(self.fws):
+            fw.custom_colors[:512] = bytes([i]) * 512
+        self.devices = list(icl01.enumerate_icl01(backend=icl01_sim))
+
+    def tearDown(self):
+        for d in self.devices:
+            d.close()
+        icl01_sim.clear()
+
+    def test_results_in_order(self):
+        results = icl01.run_fleet(self.devices, read_colors, max_workers=2)
+        self.assertEqual([r.device for r in results], self.devices)
+        self.assertEqual([r.result for r in results], [bytes([i]) * 512 for i in range(4)])
+        self.assertEqual([r.error for r in results], [None] * 4)
+
+    def test_hung_device_is_isolated(self):
+        self.fws[0].hang()
+        self.fws[2].corrupt_rate = 1.
+        # A single worker: the others wait for the hung device to time out
+        results = icl01.run_fleet(self.devices, read_colors, max_workers=1, timeout=0.2)
+        self.assertIsInstance(results[0].error, TimeoutError)
+        self.assertIsNone(results[0].result)
+        self.assertEqual(results[1].result, bytes([1]) * 512)
+        self.assertIsInstance(results[2].error, IOError)
+        self.assertNotIsInstance(results[2].error, TimeoutError)
+        self.assertEqual(results[3].result, bytes([3]) * 512)
+        # Each device gets its own timeout
+        for r in results[1:]:
+            self.assertLess(r.elapsed, 0.2)
+
+    def test_configure(self):
+        results = icl01.run_fleet(self.devices, 'write', 0x0b, b'\x01\x02\x03', configure=True)
+        self.assertEqual([r.error for r in results], [None] * 4)
+        for fw in self.fws:
+            self.assertEqual(bytes(fw.custom_colors[:3]), b'\x01\x02\x03')
+            self.assertFalse(fw.inconfig)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,172 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import socket
+import tempfile
+import threading
+import unittest
+from unittest import mock
+
+import icl01
+import icl01_hidraw
+import icl01_sim
+
+UEVENT = """DRIVER=hid-generic
+HID_ID=0003:0000{vid:04X}:0000{pid:04X}
+HID_NAME=Ironclad
+HID_PHYS=usb-0000:00:14.0-{port}/input{intf}
+HID_UNIQ={serial}
+MODALIAS=hid:b0003g0001v0000{vid:04X}p0000{pid:04X}
+"""
+
+class FakeNodes:
+    """hidraw nodes standing as SOCK_SEQPACKET sockets, answered by the simulated firmware"""
+    def __init__(self):
+        self.firmware = icl01_sim.SimulatedICL01()
+        self.opened = []
+        self.remotes = []
+
+    def open(self, path):
+        local, remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.opened.append(path)
+        self.remotes.append(remote)
+        threading.Thread(target=self._serve, args=(remote, ), daemon=True).start()
+        fd = os.dup(local.fileno())
+        local.close()
+        return fd
+
+    def _serve(self, remote):
+        while True:
+            try:
+                request = remote.recv(icl01_sim.REPORT_SIZE)
+            except OSError:
+                return
+            if not request:
+                return
+            if request[0] == 4:
+                remote.send(self.firmware.process(request))
+
+    def device(self):
+        return icl01_hidraw.HidrawDevice(self.open)
+
+    def close(self):
+        for remote in self.remotes:
+            remote.close()
+
+class HidrawDeviceTest(unittest.TestCase):
+    def setUp(self):
+        self.local, self.remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self.d = icl01_hidraw.HidrawDevice(lambda path: os.dup(self.local.fileno()))
+        self.d.open_path(b'/dev/hidraw3')
+
+    def tearDown(self):
+        self.d.close()
+        self.local.close()
+        self.remote.close()
+
+    def test_framing(self):
+        self.assertEqual(self.d.write(b'\x04\x01\x02'), 3)
+        self.assertEqual(self.remote.recv(128), b'\x04\x01\x02')
+        self.remote.send(b'\x04' + bytes(range(63)))
+        self.remote.send(b'\x05\xff')
+        self.assertEqual(self.d.read(64, 100), b'\x04' + bytes(range(63)))
+        self.assertEqual(self.d.read(64, 100), b'\x05\xff')
+
+    def test_read_timeout(self):
+        self.assertEqual(self.d.read(64, 20), b'')
+        self.remote.send(b'\x04\x02')
+        self.assertEqual(self.d.read(64, 0), b'\x04\x02')
+
+    def test_closed(self):
+        self.d.close()
+        with self.assertRaises(IOError):
+            self.d.read(64, 10)
+        with self.assertRaises(IOError):
+            self.d.write(b'\x04')
+
+    def test_feature_report(self):
+        calls = []
+        def ioctl(fd, request, buffer):
+            calls.append((fd, request, bytes(buffer)))
+        with mock.patch.object(icl01_hidraw.fcntl, 'ioctl', ioctl):
+            self.assertEqual(self.d.send_feature_report(b'\x05\x01\x02'), 3)
+        # HIDIOCSFEATURE(3) from linux/hidraw.h
+        self.assertEqual(calls, [(self.d.fd, 0xc0034806, b'\x05\x01\x02')])
+        self.assertEqual(icl01_hidraw.HIDIOCSFEATURE(64), 0xc0404806)
+
+class EnumerateTest(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.sysfs = self.dir.name
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def node(self, name, uevent):
+        os.makedirs(os.path.join(self.sysfs, name, 'device'))
+        with open(os.path.join(self.sysfs, name, 'device', 'uevent'), 'w') as f:
+            f.write(uevent)
+
+    def test_enumerate(self):
+        self.node('hidraw5', UEVENT.format(vid=0x320f, pid=0x5041, port=2, intf=1, serial='B2'))
+        self.node('hidraw4', UEVENT.format(vid=0x320f, pid=0x5041, port=2, intf=0, serial='B2'))
+        self.node('hidraw1', UEVENT.format(vid=0x320f, pid=0x5041, port=1, intf=1, serial='A1'))
+        self.node('hidraw0', UEVENT.format(vid=0x320f, pid=0x5041, port=1, intf=0, serial='A1'))
+        self.node('hidraw2', UEVENT.format(vid=0x046d, pid=0xc52b, port=3, intf=0, serial=''))
+        self.node('hidraw3', "DRIVER=hid-generic\n")
+
+        found = icl01_hidraw.enumerate(0x320f, 0x5041, sysfs=self.sysfs)
+        self.assertEqual([d['path'] for d in found],
+                [b'/dev/hidraw0', b'/dev/hidraw1', b'/dev/hidraw4', b'/dev/hidraw5'])
+        self.assertEqual(found[1], {
+            'path': b'/dev/hidraw1',
+            'vendor_id': 0x320f,
+            'product_id': 0x5041,
+            'serial_number': 'A1',
+            'product_string': 'Ironclad',
+            'interface_number': 1,
+            'usb_path': 'usb-0000:00:14.0-1',
+        })
+        self.assertEqual(len(icl01_hidraw.enumerate(sysfs=self.sysfs)), 5)
+        self.assertEqual(icl01_hidraw.enumerate(sysfs=os.path.join(self.sysfs, 'missing')), [])
+
+class UeventTest(unittest.TestCase):
+    def test_parse(self):
+        message = (b'add@/devices/pci0000:00/0000:00:14.0/usb1/1-1/1-1:1.1/0003:320F:5041.0002/hidraw/hidraw1\0'
+                b'ACTION=add\0DEVPATH=/devices/.../hidraw/hidraw1\0SUBSYSTEM=hidraw\0'
+                b'MAJOR=241\0MINOR=1\0DEVNAME=hidraw1\0SEQNUM=4242\0')
+        self.assertEqual(icl01_hidraw.parse_uevent(message), ('add', b'/dev/hidraw1'))
+        self.assertEqual(icl01_hidraw.parse_uevent(message.replace(b'ACTION=add', b'ACTION=remove')),
+                ('remove', b'/dev/hidraw1'))
+        self.assertIsNone(icl01_hidraw.parse_uevent(message.replace(b'ACTION=add', b'ACTION=change')))
+        self.assertIsNone(icl01_hidraw.parse_uevent(message.replace(b'SUBSYSTEM=hidraw', b'SUBSYSTEM=usb')))
+        self.assertIsNone(icl01_hidraw.parse_uevent(b'libudev\0garbage'))
+
+class BackendTest(unittest.TestCase):
+    def setUp(self):
+        self.nodes = FakeNodes()
+        self.d = icl01.ICL01Device([b'/dev/hidraw0', b'/dev/hidraw1'], backend=self.nodes)
+
+    def tearDown(self):
+        self.d.close()
+        self.nodes.close()
+
+    def test_transfers(self):
+        self.assertEqual(self.d.read_capabilities().map_size, self.nodes.firmware.map_size)
+        self.assertEqual(self.nodes.opened, [b'/dev/hidraw1'])
+        size = self.nodes.firmware.map_size * 3
+        self.assertEqual(bytes(self.d.read(0x08, size)), bytes(self.nodes.firmware.current_mapping))
+
+        self.d.window = 8
+        with self.d:
+            self.d.write(0x09, bytes(size))
+        self.assertEqual(bytes(self.nodes.firmware.current_mapping), bytes(size))
+
+    def test_reader(self):
+        self.d.start_reader()
+        self.assertEqual(self.d.read_capabilities().map_size, self.nodes.firmware.map_size)
+        self.assertGreater(self.d.readers[1].stats['replies'], 0)
+        self.assertEqual(self.d.readers[1].stats['dropped'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
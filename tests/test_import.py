@@ -0,0 +1,23 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import subprocess
+import sys
+import unittest
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+class ImportTest(unittest.TestCase):
+    def test_import_has_no_side_effect(self):
+        code = ("import sys, icl01; "
+                "print(' '.join(m for m in ('hid', 'hut', 'asyncio', 'concurrent.futures') if m in sys.modules))")
+        out = subprocess.run([sys.executable, '-c', code], cwd=ROOT, capture_output=True, text=True, check=True)
+        self.assertEqual(out.stdout.strip(), '')
+        self.assertEqual(out.stderr, '')
+
+    def test_hut_is_loaded_on_demand(self):
+        import icl01
+        self.assertEqual(str(icl01.ActionKey(0x02, 0x04)), "LeftShift+A")
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,61 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import os
+import tempfile
+import unittest
+
+import icl01
+import icl01_sim
+from icl01 import LatencyModel
+
+class LatencyModelTest(unittest.TestCase):
+    def test_warm_up_seeds(self):
+        model = LatencyModel()
+        self.assertEqual(model.timeout(0x0a), LatencyModel.SEEDS[0x0a])
+        self.assertEqual(model.timeout(0x15), model.default)
+        self.assertEqual(LatencyModel(seeds={}).timeout(0x0a), model.default)
+
+        for i in range(model.min_samples - 1):
+            model.record(0x0a, .002)
+        self.assertEqual(model.timeout(0x0a), LatencyModel.SEEDS[0x0a])
+        model.record(0x0a, .01)
+        self.assertAlmostEqual(model.timeout(0x0a), .03)
+
+    def test_floor_ceiling_and_misses(self):
+        model = LatencyModel(min_samples=1)
+        model.record(0x08, .001)
+        self.assertEqual(model.timeout(0x08), model.floor)
+        model.missed(0x08)
+        self.assertEqual(model.timeout(0x08), model.floor)
+        model.missed(0x08)
+        model.missed(0x08)
+        self.assertAlmostEqual(model.timeout(0x08), model.floor * 4)
+        model.record(0x08, 5.)
+        self.assertEqual(model.timeout(0x08), model.ceiling)
+
+    def test_save_and_load(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'timeouts.json')
+            model = LatencyModel()
+            for i in range(model.min_samples):
+                model.record(0x08, .01)
+            model.save(path, 'SIM0000')
+            LatencyModel().save(path, 'SIM0001')
+            loaded = LatencyModel.load(path, 'SIM0000')
+            self.assertAlmostEqual(loaded.timeout(0x08), .03)
+            self.assertEqual(LatencyModel.load(path, 'SIM0002').samples, {})
+
+    def test_device_feeds_the_model(self):
+        icl01_sim.clear()
+        icl01_sim.add_keyboard()
+        d, = icl01.enumerate_icl01(backend=icl01_sim, latency_model=True)
+        try:
+            d.read(0x0a, 10 * 512)
+            self.assertGreaterEqual(len(d.latency_model.samples[0x0a]), d.latency_model.min_samples)
+            self.assertEqual(d.latency_model.timeout(0x0a), d.latency_model.floor)
+        finally:
+            d.close()
+            icl01_sim.clear()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,41 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import unittest
+
+import icl01
+import icl01_sim
+from icl01 import Color, ColorFrame
+
+class LightingEngineTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard()
+        self.d, = icl01.enumerate_icl01(backend=icl01_sim)
+        self.frame = ColorFrame.filled(self.fw.map_size, Color(0, 0, 0x40))
+
+    def tearDown(self):
+        self.d.close()
+        icl01_sim.clear()
+
+    def test_frames_then_cancel(self):
+        engine = icl01.LightingEngine(self.d, lambda index, t: self.frame.roll(index), fps=200, diff=True)
+        stats = engine.run(frames=5)
+        self.assertEqual(stats.frames, 5)
+        self.assertFalse(self.fw.live)
+        self.assertIsNone(engine.differ.last)
+
+    def test_first_error_is_raised(self):
+        def render(index, t):
+            if index == 2:
+                # Cancelling the live colors fails too
+                self.fw.unplugged = True
+                raise RuntimeError("render failed")
+            return self.frame
+
+        engine = icl01.LightingEngine(self.d, render, fps=200, diff=True)
+        with self.assertRaisesRegex(RuntimeError, "render failed"):
+            engine.run()
+        self.assertEqual(engine.stats.frames, 2)
+
+if __name__ == '__main__':
+    unittest.main()
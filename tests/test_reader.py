@@ -0,0 +1,84 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import threading
+import time
+import unittest
+
+import icl01
+import icl01_sim
+
+class ReportReaderTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard()
+        self.d, = icl01.enumerate_icl01(backend=icl01_sim)
+        self.d.start_reader()
+
+    def tearDown(self):
+        self.d.close()
+        icl01_sim.clear()
+
+    def test_reports_go_to_subscribers(self):
+        received = []
+        event = threading.Event()
+        def callback(report):
+            received.append(report)
+            event.set()
+        self.d.subscribe(callback)
+        self.fw.inject(b'\x03\x05\x04')
+        self.assertEqual(self.d.read_capabilities().map_size, 126)
+        self.assertTrue(event.wait(1.))
+        self.assertEqual(received[0][:3], b'\x03\x05\x04')
+
+    def test_subscriber_errors_are_counted(self):
+        received = []
+        event = threading.Event()
+        def broken(report):
+            raise ValueError()
+        def callback(report):
+            received.append(report)
+            event.set()
+        self.d.subscribe(broken)
+        self.d.subscribe(callback)
+        self.fw.inject(b'\x03\x05\x04')
+        self.assertTrue(event.wait(1.))
+        reader = self.d.readers[1]
+        self.assertEqual(reader.stats['subscriber_errors'], 1)
+        self.assertTrue(reader.is_alive())
+        # Replies still get through
+        self.assertEqual(self.d.read_capabilities().map_size, 126)
+        self.fw.inject(b'\x03\x05\x04')
+        self.assertEqual(self.d.query(0x03, 0, 8)[:2], b'\xaa\x55')
+        self.assertEqual(len(received), 2)
+        self.assertEqual(reader.stats['subscriber_errors'], 2)
+
+    def test_unexpected_replies_are_dropped(self):
+        self.fw.inject(icl01_sim.MSG_HDR.pack(4, 0, 0x05, 0, 0x40, 0, b''))
+        self.assertEqual(self.d.read_capabilities().map_size, 126)
+        reader = self.d.readers[1]
+        for i in range(100):
+            if reader.stats['dropped']:
+                break
+            time.sleep(0.01)
+        self.assertEqual(reader.stats['dropped'], 1)
+
+    def test_reader_error_is_raised(self):
+        self.d.read_capabilities()
+        reader = self.d.readers[1]
+        # Only the reader sees the keyboard going away
+        self.fw.unplugged = True
+        reader.join(1.)
+        self.assertIsNotNone(reader.error)
+        self.fw.unplugged = False
+        start = time.monotonic()
+        with self.assertRaises(IOError) as cm:
+            self.d.query(0x03, 0, 8)
+        # Neither a timeout nor waiting for one
+        self.assertNotIsInstance(cm.exception, icl01.ICL01TimeoutError)
+        self.assertIsNotNone(cm.exception.__cause__)
+        with self.assertRaises(IOError):
+            self.d.query(0x03, 0, 8)
+        self.assertLess(time.monotonic() - start, 0.5)
+
+if __name__ == '__main__':
+    unittest.main()
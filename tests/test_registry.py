@@ -0,0 +1,91 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import asyncio
+import unittest
+
+import icl01
+import icl01_registry
+import icl01_sim
+
+class DevicePoolTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard()
+        self.pool = icl01_registry.DevicePool(backend=icl01_sim)
+
+    def tearDown(self):
+        self.pool.close()
+        icl01_sim.clear()
+
+    def test_devices_are_kept_across_enumerations(self):
+        d, = self.pool.enumerate()
+        self.assertEqual(self.pool.enumerate(), [d])
+        self.assertIs(self.pool.get('SIM0000'), d)
+        with self.pool.use('SIM0000') as used:
+            self.assertIs(used, d)
+            used.read_capabilities()
+
+        icl01_sim.remove_keyboard(self.fw)
+        self.assertEqual(self.pool.enumerate(), [])
+        with self.assertRaises(KeyError):
+            self.pool.use('SIM0000')
+
+class DeviceRegistryTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard(reboot_time=.05)
+        self.registry = icl01_registry.DeviceRegistry(backend=icl01_sim).start()
+
+    def tearDown(self):
+        self.registry.close()
+        icl01_sim.clear()
+
+    def test_reboot(self):
+        d, = self.registry.devices.values()
+        events = []
+        self.registry.subscribe(lambda action, key, device: events.append(action))
+        back = self.registry.reboot(d, timeout=5)
+        self.assertIsNotNone(back)
+        self.assertIsNot(back, d)
+        self.assertIs(self.registry.get('SIM0000'), back)
+        self.assertEqual(events[-2:], ['remove', 'add'])
+
+    def test_wait_for_timeout(self):
+        self.assertIsNone(self.registry.wait_for('SIM0001', timeout=.05))
+
+    def test_arrival(self):
+        d, = self.registry.devices.values()
+        key = self.registry.device_key(d)
+
+        async def reboot():
+            loop = asyncio.get_running_loop()
+            self.assertIs(await self.registry.arrival(key), d)
+            after = self.registry.generation(key)
+            waiting = asyncio.ensure_future(self.registry.arrival(key, timeout=5, after=after))
+            await asyncio.sleep(0)
+            d.reboot()
+            back = await waiting
+            # Waited without any executor thread
+            self.assertIsNone(loop._default_executor)
+            return back
+
+        back = asyncio.run(reboot())
+        self.assertIsNotNone(back)
+        self.assertIsNot(back, d)
+        self.assertEqual(self.registry._waiters, [])
+
+    def test_arrival_timeout_and_cancel(self):
+        async def wait():
+            self.assertIsNone(await self.registry.arrival('SIM0001', timeout=.05))
+            waiting = asyncio.ensure_future(self.registry.arrival('SIM0001'))
+            await asyncio.sleep(0)
+            self.assertEqual(len(self.registry._waiters), 1)
+            waiting.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await waiting
+
+        asyncio.run(wait())
+        self.assertEqual(self.registry._waiters, [])
+
+if __name__ == '__main__':
+    unittest.main()
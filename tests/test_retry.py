@@ -0,0 +1,85 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import unittest
+
+import icl01
+import icl01_sim
+
+class RetryPolicyTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard(reboot_time=0.05)
+        self.d, = icl01.enumerate_icl01(backend=icl01_sim,
+                retry=icl01.RetryPolicy(reboot_delay=0.2),
+                latency_model=icl01.LatencyModel(seeds={}, default=0.02))
+
+    def tearDown(self):
+        self.d.close()
+        icl01_sim.clear()
+
+    def test_delay(self):
+        policy = icl01.RetryPolicy(backoff=0.01, max_backoff=0.03)
+        self.assertEqual([policy.delay(i) for i in range(1, 5)], [0.01, 0.02, 0.03, 0.03])
+
+    def test_reads_survive_lost_replies(self):
+        self.fw.drop_rate = 0.1
+        for i in range(100):
+            self.assertEqual(self.d.read(0x0a, 48, 48 * i), bytes(48))
+        self.assertGreater(self.d.stats['retries'], 0)
+        self.assertEqual(self.d.stats['resyncs'], self.d.stats['retries'])
+        self.assertEqual(self.d.stats['failures'], 0)
+        self.assertEqual(self.d.stats['recoveries'], 0)
+
+    def test_writes_survive_corrupted_replies(self):
+        self.fw.corrupt_rate = 0.1
+        data = bytes(i & 0xff for i in range(10 * 512))
+        with self.d:
+            self.d.write(0x0b, data)
+        self.assertEqual(bytes(self.fw.custom_colors), data)
+        self.assertGreater(self.d.stats['retries'], 0)
+        self.assertEqual(self.d.stats['failures'], 0)
+
+    def test_recovery_reopens_the_device(self):
+        self.d.start_reader()
+        self.d.begin_configure()
+        handle = self.d.devices[1]
+        self.fw.hang()
+        data = bytes(range(3)) * 100
+        self.d.write(0x0b, data)
+        self.assertEqual(self.d.stats['recoveries'], 1)
+        self.assertEqual(self.fw.stats['reboot'], 1)
+        self.assertEqual(self.d.stats['failures'], 0)
+        # Fresh handles, reader restarted and configure mode entered again
+        self.assertIsNot(self.d.devices[1], handle)
+        self.assertIsNotNone(self.d.readers[1])
+        self.assertTrue(self.fw.inconfig)
+        self.assertEqual(bytes(self.fw.custom_colors[:len(data)]), data)
+        self.d.end_configure()
+        self.assertFalse(self.fw.inconfig)
+
+    def test_hard_failure_once_the_budget_is_spent(self):
+        self.d.retry = icl01.RetryPolicy(attempts=2, backoff=0.001, reboot_delay=0.2)
+        self.fw.hang()
+        # Hung again as soon as it comes back
+        self.fw.reboot_time = None
+        reboot = self.fw._feature
+        def hang_after_reboot(interface, data):
+            ret = reboot(interface, data)
+            self.fw.hang()
+            return ret
+        self.fw._feature = hang_after_reboot
+        with self.assertRaises(icl01.ICL01TimeoutError):
+            self.d.read(0x0a, 16)
+        # Attempts before and after the single recovery
+        self.assertEqual(self.d.stats['retries'], 4)
+        self.assertEqual(self.d.stats['recoveries'], 1)
+        self.assertEqual(self.d.stats['failures'], 1)
+
+    def test_status_errors_are_not_retried(self):
+        with self.assertRaises(icl01.ICL01QueryError):
+            self.d.write(0x0b, bytes(16))
+        self.assertEqual(self.d.stats['retries'], 0)
+        self.assertEqual(self.d.stats['failures'], 0)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,56 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import unittest
+
+import icl01
+import icl01_sim
+
+class ShadowTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard()
+        self.d, = icl01.enumerate_icl01(backend=icl01_sim, shadow=True)
+
+    def tearDown(self):
+        self.d.close()
+        icl01_sim.clear()
+
+    def test_reads_come_from_the_shadow(self):
+        self.d.read(0x0a, 512)
+        reads = self.fw.stats[0x0a]
+        self.assertEqual(self.d.read(0x0a, 512, 512), bytes(512))
+        self.assertEqual(self.fw.stats[0x0a], reads)
+
+    def test_only_changed_chunks_are_written(self):
+        with self.d:
+            self.d.write(0x0b, b'\x01\x02\x03', 600)
+            self.d.write(0x0b, b'\x04', 601)
+            self.assertEqual(self.fw.stats[0x0b], 0)
+        self.assertEqual(self.fw.stats[0x0b], 1)
+        self.assertEqual(bytes(self.fw.custom_colors[600:603]), b'\x01\x04\x03')
+        self.assertEqual(bytes(self.d.read(0x0a, 3, 600)), b'\x01\x04\x03')
+
+    def test_refused_write_is_not_shadowed(self):
+        # Custom colors can't be written outside configure mode
+        with self.assertRaises(icl01.ICL01QueryError):
+            self.d.write(0x0b, b'\xff' * 3, 0)
+        self.assertEqual(bytes(self.d.read(0x0a, 3)), bytes(3))
+
+    def test_failed_flush_leaves_configure_mode(self):
+        self.d.begin_configure()
+        self.d.write(0x0b, b'\xff' * 3, 0)
+        self.d.write_current_mapping_table([icl01.ActionKey(0, 0x05)])
+        # The keyboard left configure mode behind our back, the writes are refused
+        self.fw.inconfig = False
+        with self.assertRaises(icl01.ICL01QueryError):
+            self.d.end_configure()
+        self.assertFalse(self.d.inconfig)
+        self.assertEqual(self.fw.stats[0x02], 1)
+        self.assertFalse(self.d.shadow[0x0a].valid)
+        self.assertFalse(self.d.shadow[0x08].valid)
+        # Read again from the keyboard
+        self.assertEqual(bytes(self.d.read(0x0a, 3)), bytes(3))
+        self.assertEqual(self.d.read_current_mapping_table()[0], icl01.ActionKey(0, 0x04))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,82 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import unittest
+
+import icl01
+import icl01_sim
+from icl01 import ActionKey, DesiredState, Transaction
+
+class DesiredStateTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard()
+        self.d, = icl01.enumerate_icl01(backend=icl01_sim, shadow=True)
+        mapping = [ActionKey(0, 0x04 + i) for i in range(self.fw.map_size)]
+        mapping[1] = ActionKey(0x02, 0)
+        # First and third chunks of the second profile
+        colors = bytearray(512)
+        colors[0:3] = b'\xff\x00\x00'
+        colors[120:123] = b'\x00\xff\x00'
+        self.desired = DesiredState(mapping=mapping, custom_colors=[None, colors])
+
+    def tearDown(self):
+        self.d.close()
+        icl01_sim.clear()
+
+    def assertShadowConsistent(self):
+        for region in set(self.d.shadow.values()):
+            if region.valid:
+                self.assertEqual(region.dirty, set())
+                memory = self.fw.region(icl01_sim.SimulatedICL01.WRITE_REGIONS[region.write_cmd])
+                self.assertEqual(bytes(region.data), bytes(memory[:region.size]))
+
+    def test_dry_run(self):
+        mapping = bytes(self.fw.current_mapping)
+        plan = self.d.apply(self.desired, dry_run=True)
+        self.assertEqual(plan, [
+            Transaction(0x09, 4, b'\x02\x00'),
+            Transaction(0x0b, 512, b'\xff'),
+            Transaction(0x0b, 633, b'\xff'),
+        ])
+        self.assertEqual(plan.round_trips, 5)
+        # Nothing was sent
+        for cmd in (0x01, 0x02, 0x09, 0x0b):
+            self.assertEqual(self.fw.stats[cmd], 0)
+        self.assertEqual(bytes(self.fw.current_mapping), mapping)
+        self.assertEqual(bytes(self.fw.custom_colors), bytes(10 * 512))
+        self.assertEqual(self.d.plan(self.desired), plan)
+
+    def test_second_apply_is_empty(self):
+        plan = self.d.apply(self.desired)
+        self.assertEqual(len(plan), 3)
+        self.assertEqual(self.fw.stats[0x0b], 2)
+        self.assertEqual(self.fw.custom_colors[512:515], b'\xff\x00\x00')
+        self.assertEqual(self.fw.custom_colors[632:635], b'\x00\xff\x00')
+        self.assertEqual(self.d.apply(self.desired), [])
+        # Not even a configure session
+        self.assertEqual(self.fw.stats[0x01], 1)
+        self.assertEqual(self.fw.stats[0x0b], 2)
+        self.assertShadowConsistent()
+
+    def test_failure_partway(self):
+        process = self.fw.process
+        def refuse_second_colors_write(request):
+            # Refused as if the keyboard left configure mode
+            if request[3] == 0x0b and self.fw.stats[0x0b] == 1:
+                self.fw.inconfig = False
+            return process(request)
+        self.fw.process = refuse_second_colors_write
+        with self.assertRaises(icl01.ICL01QueryError):
+            self.d.apply(self.desired)
+        self.assertFalse(self.d.inconfig)
+        self.assertShadowConsistent()
+        # Only the custom colors are read again, the rest of the plan is done
+        self.assertTrue(self.d.shadow[0x08].valid)
+        self.assertFalse(self.d.shadow[0x0a].valid)
+        self.fw.process = process
+        plan = self.d.apply(self.desired)
+        self.assertEqual(plan, [Transaction(0x0b, 633, b'\xff')])
+        self.assertShadowConsistent()
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import io
+import json
+import time
+import unittest
+
+import icl01
+import icl01_sim
+import icl01_trace
+
+class TracerTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard()
+        self.tracer = icl01_trace.ChromeTrace()
+        self.d, = icl01.enumerate_icl01(backend=icl01_sim, tracer=self.tracer)
+
+    def tearDown(self):
+        self.d.close()
+        icl01_sim.clear()
+
+    def test_transfers(self):
+        self.d.read(0x08, self.fw.map_size * 3)
+        self.assertEqual(self.tracer.transfers[('read', 0x08)], 1)
+        self.assertEqual(self.tracer.bytes[('read', 0x08)], self.fw.map_size * 3)
+        self.assertGreater(self.tracer.round_trips[0x08], 1)
+        self.assertIn("read 0x08: 1 calls", str(self.tracer))
+
+        stream = io.StringIO()
+        self.tracer.export(stream)
+        events = json.loads(stream.getvalue())['traceEvents']
+        self.assertIn('read 0x08', [e['name'] for e in events])
+
+    def test_reader_drops_are_traced(self):
+        reader = self.d.start_reader()
+        # Reply to a request which was never sent
+        self.fw.inject(b'\x04\x00\x00\x08\x00\x40\x00')
+        deadline = time.monotonic() + 2.
+        while not reader.stats['dropped'] and time.monotonic() < deadline:
+            time.sleep(.01)
+        self.assertEqual(reader.stats['dropped'], 1)
+        self.assertEqual(self.tracer.discarded_reports, 1)
+        self.assertIn('discarded', [e['name'] for e in self.tracer.events])
+
+        # Replies still reach their queries
+        self.assertEqual(self.d.read_capabilities().map_size, self.fw.map_size)
+        self.assertEqual(self.tracer.discarded_reports, 1)
+
+    def test_reader_reports_are_traced(self):
+        received = []
+        self.d.subscribe(received.append)
+        # Evision notification
+        self.fw.inject(b'\x03\x05\x04')
+        self.assertEqual(self.d.read_capabilities().map_size, self.fw.map_size)
+        # Read before the reply, as without reader
+        self.assertEqual(len(received), 1)
+        self.assertEqual(self.d.readers[1].stats['reports'], 1)
+        self.assertEqual(self.tracer.discarded_reports, 1)
+
+    def test_reports_are_traced_without_reader(self):
+        self.fw.inject(b'\x03\x05\x04')
+        self.assertEqual(self.d.read_capabilities().map_size, self.fw.map_size)
+        self.assertEqual(self.tracer.discarded_reports, 1)
+
+if __name__ == '__main__':
+    unittest.main()
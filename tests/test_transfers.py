@@ -0,0 +1,102 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+
+import unittest
+
+import icl01
+import icl01_sim
+
+class PipelinedTransferTest(unittest.TestCase):
+    def setUp(self):
+        icl01_sim.clear()
+        self.fw = icl01_sim.add_keyboard()
+        self.d, = icl01.enumerate_icl01(backend=icl01_sim, window=8)
+
+    def tearDown(self):
+        self.d.close()
+        icl01_sim.clear()
+
+    def test_round_trip(self):
+        data = bytes(i & 0xff for i in range(512))
+        with self.d:
+            self.d.write(0x0b, data, 512)
+        self.assertEqual(self.d.read(0x0a, 512, 512), data)
+        self.assertEqual(self.d.window, 8)
+
+    def test_status_error_keeps_window(self):
+        # Custom colors can't be written outside configure mode
+        with self.assertRaises(icl01.ICL01QueryError):
+            self.d.write(0x0b, bytes(512))
+        # Replies of the requests in flight were consumed
+        self.assertEqual(self.fw.pending(), 0)
+        self.assertEqual(self.d.window, 8)
+        self.assertEqual(self.d.read(0x0a, 512), bytes(512))
+        self.assertEqual(self.d.window, 8)
+
+    def test_status_error_with_reader(self):
+        self.d.start_reader()
+        with self.assertRaises(icl01.ICL01QueryError):
+            self.d.write(0x0b, bytes(512))
+        self.assertEqual(self.d.read(0x0a, 512), bytes(512))
+        self.assertEqual(self.d.window, 8)
+
+    def test_lost_replies_lower_the_window(self):
+        self.fw.queue_depth = 2
+        self.fw.service_time = 0.002
+        self.d.latency_model = icl01.LatencyModel(default=0.05)
+        data = bytes(i & 0xff for i in range(512))
+        with self.d:
+            self.d.write(0x0b, data)
+        # A failed transfer is redone in strict mode, the window is kept
+        self.assertEqual(self.d.window, 8)
+        self.assertIsNone(self.d.inflight)
+
+        for i in range(icl01.ICL01Device.PIPELINE_FAILURES - 1):
+            self.assertEqual(self.d.read(0x0a, 512), data)
+        self.assertEqual(self.d.inflight, 4)
+        for i in range(icl01.ICL01Device.PIPELINE_FAILURES):
+            self.assertEqual(self.d.read(0x0a, 512), data)
+        self.assertEqual(self.d.inflight, 2)
+
+        # Raised again after clean transfers
+        for i in range(icl01.ICL01Device.PIPELINE_RECOVERY):
+            self.assertEqual(self.d.read(0x0a, 512), data)
+        self.assertEqual(self.d.inflight, 4)
+        self.fw.queue_depth = None
+        for i in range(icl01.ICL01Device.PIPELINE_RECOVERY):
+            self.assertEqual(self.d.read(0x0a, 512), data)
+        self.assertIsNone(self.d.inflight)
+
+    def test_lost_replies_are_sent_again(self):
+        self.fw.drop_rate = 0.05
+        self.d.retry = icl01.RetryPolicy()
+        self.d.latency_model = icl01.LatencyModel(seeds={}, default=0.02)
+        for i in range(5):
+            self.assertEqual(bytes(self.d.read(0x0a, 10 * 512)), bytes(self.fw.custom_colors))
+        self.assertGreater(self.d.stats['retries'], 0)
+        self.assertEqual(self.d.stats['failures'], 0)
+        self.assertEqual(self.d.window, 8)
+        self.assertIsNone(self.d.inflight)
+        self.assertEqual(self.fw.pending(), 0)
+
+    def test_corrupted_replies_are_sent_again(self):
+        self.fw.corrupt_rate = 0.05
+        self.d.retry = icl01.RetryPolicy()
+        self.d.latency_model = icl01.LatencyModel(seeds={}, default=0.02)
+        data = bytes(i & 0xff for i in range(10 * 512))
+        with self.d:
+            self.d.write(0x0b, data)
+        self.assertEqual(bytes(self.fw.custom_colors), data)
+        self.assertEqual(bytes(self.d.read(0x0a, 10 * 512)), data)
+        self.assertGreater(self.d.stats['retries'], 0)
+        self.assertIsNone(self.d.inflight)
+
+    def test_lost_replies_beyond_the_budget(self):
+        self.d.retry = icl01.RetryPolicy(attempts=2, reboot=False)
+        self.d.latency_model = icl01.LatencyModel(seeds={}, default=0.02)
+        self.fw.hang()
+        with self.assertRaises(icl01.ICL01TimeoutError):
+            self.d.read(0x0a, 512)
+        self.assertEqual(self.d.stats['failures'], 2)
+
+if __name__ == '__main__':
+    unittest.main()